@@ -0,0 +1,59 @@
+#!python3 -OO
+"""
+CLI for measuring how the checks scale, see ``lib/benchmark.py``.
+"""
+
+from argparse import ArgumentParser
+
+from lib.benchmark import run, save_results, load_results, compare, \
+    format_results
+from lib.util import log
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="run all checks on synthetic users and homes"
+    )
+    parser.add_argument('--sizes', default='1000,10000,100000',
+                        help="comma separated numbers of users")
+    parser.add_argument('--output', default='benchmark.json',
+                        help="file to write the results to (JSON)")
+    parser.add_argument('--baseline',
+                        help="results of an earlier run to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="relative slowdown considered a regression")
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--fuse', action='store_true',
+                        help="do consecutive per user checks in one pass")
+    parser.add_argument('--correct', action='store_true',
+                        help="do corrections (in the temporary directory)"
+                             " instead of simulating them")
+    for ratio, default in (('wrong_mode', 0.1), ('wrong_owner', 0.1),
+                           ('wrong_group', 0.1), ('missing', 0.01),
+                           ('obsolete', 0.01)):
+        parser.add_argument('--%s-ratio' % ratio.replace('_', '-'),
+                            type=float, default=default)
+    arguments = parser.parse_args()
+
+    results = run(
+        [int(size) for size in arguments.sizes.split(',')],
+        simulate=not arguments.correct,
+        workers=arguments.workers,
+        fuse=arguments.fuse,
+        wrong_mode_ratio=arguments.wrong_mode_ratio,
+        wrong_owner_ratio=arguments.wrong_owner_ratio,
+        wrong_group_ratio=arguments.wrong_group_ratio,
+        missing_ratio=arguments.missing_ratio,
+        obsolete_ratio=arguments.obsolete_ratio,
+    )
+    save_results(results, arguments.output)
+
+    for line in format_results(results):
+        log(line)
+
+    if arguments.baseline:
+        regressions = compare(results, load_results(arguments.baseline),
+                              arguments.tolerance)
+        for regression in regressions:
+            log("REGRESSION: %s", regression)
+        if regressions:
+            exit(1)
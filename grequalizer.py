@@ -10,16 +10,43 @@ from lib.util import log
 def help_and_exit():
     log("script for maintaining an UNIX groups accounts and home directories")
     log("")
-    log("usage: [python3] ./sftponly.py [config file]")
+    log("usage: [python3] ./sftponly.py [config file] [config file ...]")
+    log("       [python3] ./sftponly.py --daemon [config file]")
+    log("       [python3] ./sftponly.py --apply-plan [plan file]")
     log("  explicit call of 'python3' turns on debug")
+    log("  several config files (e.g. one per group) are run one after")
+    log("    another, loading users, groups and homes only once")
+    log("  --daemon keeps running and reacts to changes of homes and accounts")
+    log("  --apply-plan applies the corrections recorded in a plan file")
+    log("    (see option 'plan_file') whose preconditions still hold")
     exit(0)
 
 if __name__ == "__main__":
     if '--help' in argv or '-h' in argv:
         help_and_exit()
 
-    try:
-        runner = ChecksRunner(argv[1])
-    except IndexError as exception:
+    arguments = argv[1:]
+
+    if '--apply-plan' in arguments:
+        arguments.remove('--apply-plan')
+        from lib.plan import Plan, PlanApplier
+        try:
+            plan = Plan.load(arguments[0])
+        except IndexError as exception:
+            help_and_exit()
+        exit(0 if PlanApplier(plan).apply() else 1)
+
+    daemon = '--daemon' in arguments
+    if daemon:
+        arguments.remove('--daemon')
+
+    if not arguments or (daemon and len(arguments) > 1):
         help_and_exit()
-    runner.auto()
+
+    if daemon:
+        from lib.daemon import ChecksDaemon
+        ChecksDaemon(ChecksRunner(arguments[0])).run()
+    elif len(arguments) > 1:
+        exit(ChecksRunner.auto_many(arguments))
+    else:
+        ChecksRunner(arguments[0]).auto()
@@ -1,13 +1,19 @@
 # encoding: utf-8
 
 from sys import argv
-from pwd import getpwall
-from grp import getgrnam
-from inspect import getmembers, isclass
+from time import time
 from os.path import join as path_join, dirname
+from struct import error as struct_error
 
-from lib.util import debug, log
+from lib.util import debug, log, warning, is_enabled, set_level, \
+    reset_levels, DEBUG
 from lib.config import ConfigDict, OptionsDict
+from lib.homes import HomesSnapshot
+from lib.nss import NssIndex, NssSnapshot
+from lib.templates import TemplateExpander
+from lib.state import RunState
+from lib.metrics import RunMetrics
+from lib.registry import CheckRegistry
 import lib.checks as checks_module
 
 class ChecksRunner():
@@ -18,11 +24,30 @@ class ChecksRunner():
     config_section = 'main'
     """section where configration will be retreived from"""
 
-    def __init__(self, config_file):
+    registry = CheckRegistry()
+    """``CheckRegistry`` of all checks in ``lib.checks``"""
+
+    def __init__(self, config_file, nss_loader=None, shared=None):
         """
         Initializes instance variables and esp. sets the config file.
+
+        ``nss_loader`` is called to get the ``NssIndex`` of all users
+        and groups (e.g. to inject synthetic users), by default they are
+        enumerated or loaded from the NSS snapshot, if configured.
+
+        ``shared`` is a ``SharedResources`` to take users, groups and
+        snapshots of homes from, if already loaded by another runner.
         """
 
+        self.nss_loader = nss_loader
+        """see above"""
+
+        self.shared = shared
+        """see above"""
+
+        self.accounts_changed = False
+        """whether checks changed passwd entries (when not simulating)"""
+
         self.home_path = None
         """see full config example for explanation"""
 
@@ -32,29 +57,155 @@ class ChecksRunner():
         self.users = None
         """see full config example for explanation"""
 
-        self.group = None
+        self.group_name = None
         """see full config example for explanation"""
 
+        self.group = None
+        """``grp.struct_group`` for ``group_name``"""
+
         self.simulate = None
         """see full config example for explanation"""
 
         self.minimum_users_count = None
         """see full config example for explanation"""
 
+        self.workers = None
+        """see full config example for explanation"""
+
+        self.prefetch_in_flight = None
+        """see full config example for explanation"""
+
+        self.passwd = None
+        """PasswdEditor if configured (see full config example)"""
+
+        self.nss = None
+        """NssIndex of all users and groups, shared by all checks"""
+
+        self.nss_snapshot = None
+        """NssSnapshot if configured (see full config example)"""
+
+        self.fuse_per_user_checks = False
+        """see full config example for explanation"""
+
+        self.metrics_prometheus_file = None
+        """see full config example for explanation"""
+
+        self.metrics_json_file = None
+        """see full config example for explanation"""
+
+        self.load_seconds = 0.0
+        """time spent in ``load``"""
+
+        self.metrics = None
+        """``RunMetrics`` of the last run of ``do_checks``"""
+
+        self.plan_file = None
+        """see full config example for explanation"""
+
+        self.plan = None
+        """
+        ``Plan`` of the last run of ``do_checks`` if configured (and of the
+        targeted runs since in daemon mode)
+        """
+
+        self.nss_snapshot_refresh = None
+        """see full config example for explanation"""
+
+        self.nss_snapshot_timeout = None
+        """see full config example for explanation"""
+
+        self.nss_snapshot_max_age = None
+        """see full config example for explanation"""
+
+        self.templates = None
+        """TemplateExpander, shared by all checks"""
+
         self.configs_filename = config_file
         """path to configuration file"""
 
         self.configs = None
         """ConfigDict with configuration loaded from self.config_section"""
 
+        self.homes = None
+        """HomesSnapshot of the base of home_path, shared by all checks"""
+
+        self.state = None
+        """RunState if incremental mode is configured"""
+
+        self.full_sweep_interval = None
+        """see full config example for explanation"""
+
+        self.changed_users = None
+        """
+        users changed since the last run (in incremental mode),
+        ``None`` to check all users
+        """
+
+        self.changed_directories = None
+        """
+        set of directories changed since the last run (in incremental
+        mode), ``None`` to check all directories
+        """
+
+        self.unsettled = set()
+        """
+        login names and directories found incorrect but not corrected,
+        these will be checked again in the next incremental run
+        """
+
+        self.targeted = False
+        """
+        if True, all per user and per directory checks (not only the
+        incremental ones) are limited to ``changed_users`` and
+        ``changed_directories`` (e.g. in daemon mode)
+        """
+
     def auto(self):
         """
         Run all actions in the correct order. (Calls this from outside)
         """
         debug("started")
+        self.load()
+        self.do_checks()
+        self._save_state()
+        if self.accounts_changed and self.shared is not None:
+            self.shared.forget_accounts()
+
+    @classmethod
+    def auto_many(cls, config_files):
+        """
+        Runs ``auto`` for several configurations (e.g. one per group)
+        one after another, loading users, groups and the homes' base
+        directories only once (see ``SharedResources``).
+
+        A configuration which aborts (e.g. because of too few users)
+        does not keep the others from running. Returns the exit status,
+        the one of the last configuration that aborted or 0.
+        """
+        from lib.shared import SharedResources
+
+        shared = SharedResources()
+        status = 0
+        for config_file in config_files:
+            log("running configuration '%s'", config_file)
+            try:
+                cls(config_file, shared=shared).auto()
+            except SystemExit as exception:
+                if exception.code:
+                    log("configuration '%s' aborted", config_file)
+                    status = exception.code
+        return status
+
+    def load(self):
+        """
+        Loads configuration, users, homes and state of the last run.
+        """
+        start = time()
         self._load_configs()
         self._load_users()
-        self.do_checks()
+        self._load_homes()
+        self._load_state()
+        self.load_seconds = time() - start
 
     def _load_configs(self):
         """
@@ -66,8 +217,24 @@ class ChecksRunner():
             self.configs_filename
         )
         self.configs = configs
+        reset_levels()
+        self._set_log_levels()
         self._check_required_configs()
 
+    def _set_log_levels(self):
+        """
+        Sets the log level of all output and of the channels of checks
+        with a level of their own (option ``log_level``).
+        """
+        for section, options in self.configs.items():
+            level = options.get('log_level', None)
+            if not level:
+                continue
+            if section == self.config_section:
+                set_level(level)
+            else:
+                set_level(level, section)
+
     def _check_required_configs(self):
         """
         Checks if all required configurations are present.
@@ -85,56 +252,392 @@ class ChecksRunner():
         self.simulate = options.get_bool('simulate')
         self.limit_to_group = options.get_bool('limit_to_primary_group')
         if self.limit_to_group:
-            self.group = getgrnam(options.get_str('primary_group_name'))
+            self.group_name = options.get_str('primary_group_name')
         self.minimum_users_count = options.get_int('minimum_users_count')
+        self.workers = options.get_int('workers', 1)
+        self.prefetch_in_flight = options.get_int('prefetch_in_flight', 1)
+        if options.get_str('passwd_backend', 'usermod') == 'native':
+            from lib.passwd import PasswdEditor
+            self.passwd = PasswdEditor(
+                options.get_str('passwd_file', '/etc/passwd')
+            )
+        state_path = options.get('state_file', None)
+        if state_path:
+            self.state = RunState(state_path)
+        self.full_sweep_interval = options.get_int('full_sweep_interval',
+                                                   7 * 24 * 60 * 60)
+        self.fuse_per_user_checks = options.get_bool('fuse_per_user_checks',
+                                                     False)
+        self.metrics_prometheus_file = options.get('metrics_prometheus_file',
+                                                   None)
+        self.metrics_json_file = options.get('metrics_json_file', None)
+        self.plan_file = options.get('plan_file', None)
+        snapshot_path = options.get('nss_snapshot_file', None)
+        if snapshot_path:
+            self.nss_snapshot = NssSnapshot(snapshot_path)
+        self.nss_snapshot_refresh = options.get_int('nss_snapshot_refresh',
+                                                    60 * 60)
+        self.nss_snapshot_timeout = options.get_int('nss_snapshot_timeout',
+                                                    60)
+        self.nss_snapshot_max_age = options.get_int('nss_snapshot_max_age',
+                                                    24 * 60 * 60)
 
     @classmethod
-    def get_checks(cls):
+    def get_checks(cls, sections=None):
         """
-        Acquires all checks (classes) in the module 'checks'.
+        Acquires the checks (classes) for ``sections`` (e.g. the
+        configuration), all checks in the module 'checks' if ``None``.
+
+        Only the modules of these checks are imported.
         """
-        checks = [	t[1] for t in
-                        getmembers(checks_module, isclass)
-                            if not t[0].startswith("Abstract") ]
-        debug("found checks: %s" % str([s.__name__ for s in checks]))
+        checks = [entry.load()
+                  for entry in cls.registry.entries_for(sections)]
+        if is_enabled(DEBUG):
+            debug("found checks: %s", [s.__name__ for s in checks])
         return checks
 
     @classmethod
-    def get_checks_sorted(cls):
+    def get_checks_sorted(cls, sections=None):
         """
         Sames as get_checks but checks are sorted,
         starting with most important.
         """
-        checks = cls.get_checks()
+        checks = cls.get_checks(sections)
         checks.sort(key=lambda check: check.order)
-        debug("sorted checks: %s" % str([s.__name__ for s in checks]))
+        if is_enabled(DEBUG):
+            debug("sorted checks: %s", [s.__name__ for s in checks])
         return checks
 
-    def _load_users(self):
-        users = getpwall()
+    def _select_users(self, nss):
+        """
+        Returns the users to check from an ``NssIndex``.
+        """
+        users = nss.users
         if self.limit_to_group:
+            self.group = nss.getgrnam(self.group_name)
             users = [u for u in users if u.pw_gid == self.group.gr_gid]
+        return users
+
+    def _load_nss_snapshot(self, refresh=False):
+        """
+        Returns the ``NssIndex`` from the NSS snapshot, refreshed first
+        if it is older than configured (or ``refresh`` is set).
+
+        Refreshed users and groups are only stored if there are enough
+        users, a snapshot that is too old is refused.
+        """
+        snapshot = self.nss_snapshot
+        try:
+            nss = snapshot.load()
+        except (ValueError, struct_error) as exception:
+            warning("cannot load NSS snapshot '%s': %s", snapshot.path,
+                    exception)
+            nss = None
+
+        if refresh or nss is None or \
+                snapshot.age() > self.nss_snapshot_refresh:
+            fresh_nss = NssSnapshot.enumerate(self.nss_snapshot_timeout)
+            if fresh_nss is not None:
+                users_count = len(self._select_users(fresh_nss))
+                if users_count < self.minimum_users_count:
+                    log("too few users enumerated, keeping NSS snapshot "
+                        "(got %u, need %u)", users_count,
+                        self.minimum_users_count)
+                else:
+                    if not self.simulate:
+                        snapshot.update(fresh_nss)
+                    return fresh_nss
+
+        if nss is None:
+            log("no NSS snapshot and enumerating users failed")
+            exit(1)
+        if snapshot.age() > self.nss_snapshot_max_age:
+            log("NSS snapshot too old (%us, at most %us allowed)",
+                snapshot.age(), self.nss_snapshot_max_age)
+            exit(1)
+        return nss
+
+    def _load_users(self, refresh_nss=False):
+        """
+        Indexes all users and groups and selects the users to check.
+
+        ``refresh_nss`` forces a refresh of the NSS snapshot.
+        """
+        source = self.nss_snapshot.path if self.nss_snapshot else None
+        templates = None
+        if self.shared is not None and not refresh_nss:
+            templates = self.shared.expander(source)
+
+        if templates is not None:
+            debug("using users and groups loaded before")
+            self.nss = templates.nss
+        elif self.nss_loader:
+            self.nss = self.nss_loader()
+        elif self.nss_snapshot:
+            self.nss = self._load_nss_snapshot(refresh_nss)
+        else:
+            self.nss = NssIndex.load()
+
+        if templates is None:
+            templates = TemplateExpander(self.nss)
+            if self.shared is not None:
+                self.shared.add_expander(source, templates)
+        self.templates = templates
+        self.templates.compile_options(self.configs)
+        users = self._select_users(self.nss)
         if len(users) < self.minimum_users_count:
-            log("too few users found... check configuration (got %u, need %u)" % (
-            len(users), self.minimum_users_count))
+            log("too few users found... check configuration (got %u, need %u)",
+                len(users), self.minimum_users_count)
             exit(1)
         self.users = users
 
+    def _load_homes(self):
+        """
+        Takes the snapshot of the homes all checks will work on.
+        """
+        if self.shared is not None:
+            self.homes = self.shared.homes_snapshot(self.home_path,
+                                                    self.prefetch_in_flight)
+            return
+        self.homes = HomesSnapshot.for_home_path(self.home_path,
+                                                 self.prefetch_in_flight)
+        self.homes.load()
 
-    def do_checks(self):
-        for check_cls in ChecksRunner.get_checks_sorted():
+    def _user_digest(self, user):
+        """
+        Returns the digest of a users passwd and group entry.
+        """
+        try:
+            group_name = self.nss.getgrgid(user.pw_gid).gr_name
+        except KeyError:
+            group_name = None
+        return RunState.user_digest(user, group_name)
+
+    def _home_fingerprint(self, path):
+        """
+        Returns the fingerprint of a home directory from the snapshot.
+        """
+        return RunState.home_fingerprint(self.homes.stat_directory(path))
 
-            options = self.configs.get(check_cls.config_section, None)
+    def _load_state(self):
+        """
+        Loads the state of the last run (in incremental mode) and
+        determines which users and directories changed since.
+        """
+        self.changed_users = None
+        self.changed_directories = None
 
-            if not options:
-                debug("no configuration for %s! Skipping." % check_cls)
-                continue
+        if self.state is None:
+            return
 
-            debug("doing check for %s" % check_cls)
-            check = check_cls(
-                self.home_path,
+        state = self.state
+        state.load()
+        if state.needs_full_sweep(RunState.config_digest_for(self.configs),
+                                  self.full_sweep_interval):
+            log("doing a full sweep")
+            return
+
+        self.changed_users = [
+            user for user in self.homes.prefetched(
                 self.users,
-                self.simulate,
-                self.configs[check_cls.config_section]
+                lambda user: self.templates.expand(self.home_path, user)
+            )
+            if state.users.get(user.pw_name) != self._user_digest(user)
+            or state.homes.get(self.templates.expand(self.home_path, user))
+                != self._home_fingerprint(
+                    self.templates.expand(self.home_path, user))
+        ]
+        self.changed_directories = set(
+            directory for directory in self.homes.directories()
+            if state.homes.get(directory) !=
+                self._home_fingerprint(directory)
+        )
+        log("incremental run: %u of %u users and %u directories changed",
+            len(self.changed_users), len(self.users),
+            len(self.changed_directories))
+
+    def _save_state(self):
+        """
+        Records the state after this run (in incremental mode).
+
+        Users and directories which are not correct (see ``unsettled``)
+        are left out, so that they will be checked again.
+        """
+        if self.state is None or self.simulate:
+            return
+
+        state = self.state
+        if self.changed_users is None:
+            state.full_sweep_time = time()
+        state.config_digest = RunState.config_digest_for(self.configs)
+
+        unsettled = self.unsettled
+        state.users = {}
+        state.homes = {}
+        for user in self.users:
+            home = self.templates.expand(self.home_path, user)
+            if user.pw_name in unsettled or home in unsettled:
+                continue
+            state.users[user.pw_name] = self._user_digest(user)
+            state.homes[home] = self._home_fingerprint(home)
+        for directory in self.homes.directories():
+            if directory not in unsettled:
+                state.homes[directory] = self._home_fingerprint(directory)
+
+        state.save()
+
+    def _users_and_directories_for(self, check):
+        """
+        Returns the users and directories (``None`` for all) to hand to
+        a check (``incremental`` can depend on its options).
+        """
+        if self.changed_users is None:
+            return self.users, None
+        if check.incremental or (self.targeted and not isinstance(
+                check,
+                checks_module.AbstractAllUsersAndAllDirectoriesCheck)):
+            return self.changed_users, self.changed_directories
+        return self.users, None
+
+    def do_checks(self):
+        self._forget_unsettled()
+        self.metrics = RunMetrics(self.configs_filename, self.simulate)
+        self.metrics.load_seconds = self.load_seconds
+        self.metrics.users = len(self.users)
+        self.metrics.stat_latencies = self.homes.latencies
+        # in daemon mode, the checks of each batch of changes add to the
+        # plan of the last run of all checks instead of replacing it
+        if self.plan_file and not (self.targeted and self.plan is not None):
+            from lib.plan import Plan
+            self.plan = Plan(
+                self.configs_filename,
+                self.passwd.passwd_path if self.passwd else None
+            )
+
+        fused_checks = []
+        for check_cls in ChecksRunner.get_checks_sorted(
+                self._enabled_sections()):
+            check = self.create_check(check_cls)
+            if check is None:
+                continue
+            if self.fuse_per_user_checks and isinstance(
+                    check, checks_module.AbstractPerUserCheck):
+                if fused_checks and fused_checks[0].users is not check.users:
+                    self._run_fused_checks(fused_checks)
+                    fused_checks = []
+                fused_checks.append(check)
+                continue
+            self._run_fused_checks(fused_checks)
+            fused_checks = []
+            self._run_check(check)
+        self._run_fused_checks(fused_checks)
+
+        self._write_passwd()
+        self.metrics.finish()
+        self._write_metrics()
+        if self.plan is not None:
+            self.plan.save(self.plan_file)
+
+    def _enabled_sections(self):
+        """
+        Returns the configuration sections not disabled by ``check =
+        no``, so that the modules of disabled checks are not imported.
+        """
+        return [section for section, options in self.configs.items()
+                if 'check' not in options or options.get_bool('check')]
+
+    def _forget_unsettled(self):
+        """
+        Drops the users and directories checked again by this run from
+        ``unsettled`` (all of them in full runs), checks add the ones
+        still incorrect again.
+        """
+        if self.changed_users is None:
+            self.unsettled = set()
+            return
+        for user in self.changed_users:
+            self.unsettled.discard(user.pw_name)
+            self.unsettled.discard(self.templates.expand(self.home_path,
+                                                         user))
+        self.unsettled.difference_update(self.changed_directories)
+
+    def create_check(self, check_cls):
+        """
+        Creates a check, returns ``None`` if not configured.
+        """
+        options = self.configs.get(check_cls.config_section, None)
+
+        if not options:
+            debug("no configuration for %s! Skipping.", check_cls)
+            return None
+
+        check = check_cls(
+            self.home_path,
+            self.users,
+            self.simulate,
+            options,
+            homes=self.homes,
+            workers=self.workers,
+            passwd=self.passwd,
+            nss=self.nss,
+            templates=self.templates,
+            plan=self.plan
+        )
+        check.users, check.directories = \
+            self._users_and_directories_for(check)
+        return check
+
+    def run_check(self, check_cls):
+        """
+        Creates and runs a check if configured.
+        """
+        check = self.create_check(check_cls)
+        if check is not None:
+            self._run_check(check)
+
+    def _run_check(self, check):
+        debug("doing check for %s", check.__class__)
+        check.check()
+        self._collect_results([check])
+
+    def _run_fused_checks(self, checks):
+        """
+        Runs per user checks in one pass over the users
+        (see ``FusedPerUserChecks``).
+        """
+        if not checks:
+            return
+        checks_module.FusedPerUserChecks(checks, self.workers).run()
+        self._collect_results(checks)
+
+    def _collect_results(self, checks):
+        """
+        Collects uncorrected items and metrics of checks that ran.
+        """
+        for check in checks:
+            self.unsettled.update(
+                getattr(item, 'pw_name', item) for item in check.uncorrected
             )
-            check.check()
+            if check.options.get_bool('check') and self.metrics:
+                self.metrics.add(check.metrics)
+            if check.changed_accounts:
+                self.accounts_changed = True
+
+    def _write_metrics(self):
+        """
+        Writes the metrics of the last run to the configured files.
+        """
+        if self.metrics_prometheus_file:
+            self.metrics.write_prometheus(self.metrics_prometheus_file)
+        if self.metrics_json_file:
+            self.metrics.write_json(self.metrics_json_file)
+
+    def _write_passwd(self):
+        """
+        Writes changes to passwd entries collected by the checks.
+        """
+        if not self.passwd or not self.passwd.changes:
+            return
+        log("writing %u changed entries to '%s'",
+            len(self.passwd.changes), self.passwd.passwd_path)
+        self.passwd.apply()
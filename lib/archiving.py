@@ -0,0 +1,78 @@
+"""
+Creating and verifying archives of directories.
+
+Functions in here are meant to be run in worker processes as well.
+"""
+
+from os import close, rename, unlink
+from os.path import join as path_join, dirname, basename
+from tempfile import mkstemp
+from tarfile import open as open_tar
+
+archive_formats = {
+    'tar': ('', '.tar'),
+    'gztar': ('gz', '.tar.gz'),
+    'bztar': ('bz2', '.tar.bz2'),
+    'xztar': ('xz', '.tar.xz'),
+}
+"""
+Dictionary of {format: (compression, file name extension)},
+format names as for ``shutil.make_archive``.
+"""
+
+def archive_path(base_name, archive_format):
+    """
+    Returns the path of the archive for ``base_name``.
+    """
+    return base_name + archive_formats[archive_format][1]
+
+def verify_archive(path):
+    """
+    Reads the whole archive at ``path`` in order to detect corruption.
+
+    Returns the number of members, raises an exception if the archive
+    cannot be read completely.
+    """
+    count = 0
+    with open_tar(path, 'r:*') as archive:
+        for member in archive:
+            count += 1
+            if not member.isfile():
+                continue
+            member_file = archive.extractfile(member)
+            while member_file.read(1 << 20):
+                pass
+    if not count:
+        raise ValueError("archive '%s' is empty" % path)
+    return count
+
+def create_archive(base_name, root_dir, base_dir, archive_format='bztar',
+                   compression_level=None):
+    """
+    Like ``shutil.make_archive`` but with configurable compression level
+    and verification of the written archive.
+
+    The archive is written under a temporary name and renamed when
+    verified, so a failed run never leaves a partial archive behind.
+
+    Returns the path of the verified archive.
+    """
+    compression, _ = archive_formats[archive_format]
+    path = archive_path(base_name, archive_format)
+
+    options = {}
+    if compression and compression_level is not None:
+        key = 'preset' if compression == 'xz' else 'compresslevel'
+        options[key] = compression_level
+
+    fd, temp_path = mkstemp(dir=dirname(path), prefix='.%s.' % basename(path))
+    close(fd)
+    try:
+        with open_tar(temp_path, 'w:' + compression, **options) as archive:
+            archive.add(path_join(root_dir, base_dir), arcname=base_dir)
+        verify_archive(temp_path)
+        rename(temp_path, path)
+    except BaseException:
+        unlink(temp_path)
+        raise
+    return path
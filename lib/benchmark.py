@@ -0,0 +1,403 @@
+"""
+Measuring how the checks scale, on synthetic users and homes.
+
+Users and groups are generated in memory and injected into the
+``ChecksRunner`` instead of the system's ones. Their homes are created
+in a temporary directory, with configurable ratios of wrong permissions,
+owners and groups as well as of missing and obsolete homes.
+"""
+
+from os import mkdir, chmod, chown, getuid, getpid, makedirs
+from os.path import join as path_join
+from sys import addaudithook, version as python_version
+from time import time, perf_counter, process_time
+from random import Random
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Lock
+from resource import getrusage, RUSAGE_SELF
+from json import dump as dump_json, load as load_json
+from pwd import struct_passwd
+from grp import struct_group
+
+from lib import ChecksRunner
+from lib.nss import NssIndex
+from lib.util import call_capturing_output, debug, log, warning
+
+group_name = 'grqbench'
+"""name of the primary group of all synthetic users"""
+
+first_id = 200000
+"""first uid/gid of the synthetic users and groups"""
+
+user_shell = '/bin/sh'
+"""shell of all synthetic users"""
+
+subprocess_events = ('subprocess.Popen', 'os.system', 'os.posix_spawn',
+                     'os.fork', 'os.exec', 'os.spawn')
+"""audit events that start a new process"""
+
+class OperationCounter():
+    """
+    Counts file system and process operations of this process via an
+    audit hook (see ``sys.addaudithook``).
+
+    Not all system calls raise audit events (e.g. ``stat`` does not),
+    the counts are for comparing runs, not for absolute numbers.
+    """
+
+    installed = None
+    """the instance whose hook is installed (hooks cannot be removed)"""
+
+    def __init__(self):
+
+        self.counts = {}
+        """Dictionary of {audit event: count} while counting"""
+
+        self.counting = False
+        """whether events are counted currently"""
+
+        self.lock = Lock()
+        """events might be raised in worker threads"""
+
+    @classmethod
+    def get(cls):
+        """
+        Returns the counter, installs its hook on first use.
+        """
+        if cls.installed is None:
+            cls.installed = cls()
+            addaudithook(cls.installed._hook)
+        return cls.installed
+
+    def _hook(self, event, args):
+        if not self.counting:
+            return
+        if event != 'open' and not event.startswith(('os.', 'shutil.',
+                                                     'subprocess.')):
+            return
+        with self.lock:
+            self.counts[event] = self.counts.get(event, 0) + 1
+
+    def start(self):
+        self.counts = {}
+        self.counting = True
+
+    def stop(self):
+        """
+        Stops counting and returns the counts.
+        """
+        self.counting = False
+        return self.counts
+
+def read_proc_io():
+    """
+    Returns the I/O counters (``syscr``, ``syscw``, ...) of this process
+    from ``/proc``, an empty dictionary if not available.
+    """
+    try:
+        with open('/proc/%u/io' % getpid(), 'r') as io_file:
+            return dict(
+                (key, int(value)) for key, value in
+                (line.split(':') for line in io_file)
+            )
+    except (OSError, ValueError):
+        return {}
+
+def measure(function, *args, **kwargs):
+    """
+    Calls ``function`` with its output suppressed and returns a
+    dictionary of measurements.
+
+    Raises the exception of ``function``, if any.
+    """
+    counter = OperationCounter.get()
+    io_before = read_proc_io()
+    counter.start()
+    cpu_before = process_time()
+    wall_before = perf_counter()
+
+    _, exception, _ = call_capturing_output(function, *args, **kwargs)
+
+    wall = perf_counter() - wall_before
+    cpu = process_time() - cpu_before
+    operations = counter.stop()
+    io_after = read_proc_io()
+
+    if exception is not None:
+        raise exception
+
+    return {
+        'wall_seconds': wall,
+        'cpu_seconds': cpu,
+        'read_syscalls': io_after.get('syscr', 0) - io_before.get('syscr', 0),
+        'write_syscalls': io_after.get('syscw', 0) - io_before.get('syscw', 0),
+        'audited_operations': sum(operations.values()),
+        'subprocesses': sum(count for event, count in operations.items()
+                            if event.startswith(subprocess_events)),
+        'operations': operations,
+        'max_rss_kib': getrusage(RUSAGE_SELF).ru_maxrss,
+    }
+
+class Fixture():
+    """
+    Synthetic users and their homes in a temporary directory.
+    """
+
+    def __init__(self, count, wrong_mode_ratio=0.1, wrong_owner_ratio=0.1,
+                 wrong_group_ratio=0.1, missing_ratio=0.01,
+                 obsolete_ratio=0.01, seed=0):
+
+        self.count = count
+        """number of users"""
+
+        self.wrong_mode_ratio = wrong_mode_ratio
+        self.wrong_owner_ratio = wrong_owner_ratio
+        self.wrong_group_ratio = wrong_group_ratio
+        self.missing_ratio = missing_ratio
+        self.obsolete_ratio = obsolete_ratio
+
+        self.random = Random(seed)
+        """so fixtures of the same size are equal"""
+
+        self.path = None
+        """the temporary directory (after ``create``)"""
+
+        self.nss = None
+        """``NssIndex`` of the synthetic users and group"""
+
+        self.config_path = None
+        """path to the configuration written by ``create``"""
+
+    def home_path(self, login_name):
+        return path_join(self.path, 'homes', login_name)
+
+    def create(self, simulate=True, workers=1, fuse=False):
+        """
+        Creates users, homes and a configuration.
+        """
+        self.path = mkdtemp(prefix='grequalizer-benchmark-')
+        makedirs(path_join(self.path, 'homes'))
+        mkdir(path_join(self.path, 'trash'))
+
+        users = [
+            struct_passwd((
+                'u%07u' % index, 'x', first_id + index, first_id,
+                '', self.home_path('u%07u' % index), user_shell
+            ))
+            for index in range(self.count)
+        ]
+        group = struct_group((group_name, 'x', first_id, []))
+        self.nss = NssIndex(users, [group])
+
+        self._write_passwd(users)
+        self._create_homes(users)
+        self._write_config(simulate, workers, fuse)
+
+    def _write_passwd(self, users):
+        """
+        Writes the users to a passwd file, for runs with corrections.
+        """
+        with open(path_join(self.path, 'passwd'), 'w') as passwd_file:
+            for user in users:
+                passwd_file.write(':'.join(str(field) for field in user))
+                passwd_file.write('\n')
+
+    def _create_homes(self, users):
+        random = self.random.random
+        can_chown = getuid() == 0
+        if not can_chown:
+            warning("not root, owners and groups will all be correct")
+
+        homes = [(user.pw_dir, user.pw_uid) for user in users
+                 if random() >= self.missing_ratio]
+        obsoletes = int(self.count * self.obsolete_ratio)
+        homes.extend(
+            (self.home_path('obsolete%07u' % index),
+             first_id + self.count + index)
+            for index in range(obsoletes)
+        )
+
+        for home, uid in homes:
+            mkdir(home)
+            chmod(home, 0o755 if random() < self.wrong_mode_ratio else 0o711)
+            if can_chown:
+                if random() < self.wrong_owner_ratio:
+                    uid += self.count + obsoletes
+                gid = first_id
+                if random() < self.wrong_group_ratio:
+                    gid += 1
+                chown(home, uid, gid)
+
+    def _write_config(self, simulate, workers, fuse):
+        self.config_path = path_join(self.path, 'benchmark.conf')
+        with open(self.config_path, 'w') as config_file:
+            config_file.write(config_template % {
+                'path': self.path,
+                'simulate': 'yes' if simulate else 'no',
+                'group_name': group_name,
+                'workers': workers,
+                'fuse': 'yes' if fuse else 'no',
+                'shell': user_shell,
+            })
+
+    def remove(self):
+        rmtree(self.path)
+
+config_template = """
+[main]
+home_path = %(path)s/homes/$u
+simulate = %(simulate)s
+limit_to_primary_group = yes
+primary_group_name = %(group_name)s
+minimum_users_count = 1
+workers = %(workers)u
+fuse_per_user_checks = %(fuse)s
+passwd_backend = native
+passwd_file = %(path)s/passwd
+
+[home_existence]
+check = yes
+correct = yes
+
+[home_permissions]
+check = yes
+correct = yes
+octal_permissions = 711
+
+[home_owner]
+check = yes
+correct = yes
+owner = $u
+
+[home_group]
+check = yes
+correct = yes
+group = $g
+
+[obsolete_homes]
+check = yes
+correct = yes
+trash_path = %(path)s/trash
+trash_octal_permissions = 000
+trash_format = tar
+archive_workers = 1
+
+[user_home]
+check = yes
+correct = yes
+home_path = %(path)s/homes/$u
+
+[user_shell]
+check = yes
+correct = yes
+shell = %(shell)s
+"""
+"""configuration for the benchmark, checks that need no further files"""
+
+def run_size(count, simulate=True, workers=1, fuse=False, **ratios):
+    """
+    Runs all checks on a fixture of ``count`` users and returns the
+    measurements for creating the fixture, loading, each check and
+    all checks together (when not simulating, on the homes corrected
+    by the single checks already).
+    """
+    fixture = Fixture(count, **ratios)
+    result = {'fixture': measure(fixture.create, simulate, workers, fuse)}
+    try:
+        runner = ChecksRunner(fixture.config_path,
+                              nss_loader=lambda: fixture.nss)
+        result['load'] = measure(runner.load)
+        result['checks'] = {}
+        for check_cls in ChecksRunner.get_checks_sorted(runner.configs):
+            name = '%s.%s' % (check_cls.__module__.rpartition('.')[2],
+                              check_cls.__name__)
+            result['checks'][name] = measure(runner.run_check, check_cls)
+            debug("%s: %.3fs", name, result['checks'][name]['wall_seconds'])
+        result['write_passwd'] = measure(runner._write_passwd)
+        result['all_checks'] = measure(runner.do_checks)
+    finally:
+        fixture.remove()
+    return result
+
+def run(sizes, simulate=True, workers=1, fuse=False, **ratios):
+    """
+    Runs the benchmark for all ``sizes`` and returns the results.
+    """
+    results = {
+        'time': time(),
+        'python': python_version,
+        'simulate': simulate,
+        'workers': workers,
+        'fuse': fuse,
+        'ratios': ratios,
+        'sizes': {},
+    }
+    for count in sizes:
+        log("benchmarking %u users", count)
+        results['sizes'][str(count)] = run_size(count, simulate, workers,
+                                                fuse, **ratios)
+    return results
+
+def save_results(results, path):
+    with open(path, 'w') as results_file:
+        dump_json(results, results_file, indent=2, sort_keys=True)
+
+def load_results(path):
+    with open(path, 'r') as results_file:
+        return load_json(results_file)
+
+def compare(results, baseline, tolerance=0.25, minimum_seconds=0.05):
+    """
+    Returns a list of strings describing the checks that got slower than
+    in ``baseline`` by more than ``tolerance`` (relative) or that need
+    more subprocesses or audited operations.
+
+    Wall times below ``minimum_seconds`` are considered noise.
+    """
+    regressions = []
+    for key in ('simulate', 'workers', 'fuse', 'ratios'):
+        if results[key] != baseline[key]:
+            regressions.append("baseline differs in '%s': %r -> %r" % (
+                key, baseline[key], results[key]))
+    for size, measured in sorted(results['sizes'].items()):
+        baseline_size = baseline['sizes'].get(size, None)
+        if baseline_size is None:
+            continue
+        measured_checks = dict(measured['checks'],
+                               all_checks=measured['all_checks'])
+        baseline_checks = dict(baseline_size['checks'],
+                               all_checks=baseline_size.get('all_checks'))
+        for name, current in sorted(measured_checks.items()):
+            previous = baseline_checks.get(name, None)
+            if previous is None:
+                continue
+            wall, previous_wall = current['wall_seconds'], \
+                                    previous['wall_seconds']
+            if wall > max(previous_wall * (1 + tolerance), minimum_seconds):
+                regressions.append("%s at %s users: %.3fs -> %.3fs" % (
+                    name, size, previous_wall, wall))
+            for key in ('subprocesses', 'audited_operations'):
+                if current[key] > previous[key]:
+                    regressions.append("%s at %s users: %s %u -> %u" % (
+                        name, size, key, previous[key], current[key]))
+    return regressions
+
+def format_results(results):
+    """
+    Returns a table of the results as list of lines.
+    """
+    lines = ["%-40s %8s %9s %9s %9s %9s %6s" % (
+        'check', 'users', 'wall [s]', 'cpu [s]', 'syscr', 'audited',
+        'procs')]
+    for size, measured in sorted(results['sizes'].items(),
+                                 key=lambda item: int(item[0])):
+        rows = [('(load)', measured['load'])]
+        rows.extend(sorted(measured['checks'].items()))
+        rows.append(('(all checks)', measured['all_checks']))
+        for name, current in rows:
+            lines.append("%-40s %8s %9.3f %9.3f %9u %9u %6u" % (
+                name, size, current['wall_seconds'], current['cpu_seconds'],
+                current['read_syscalls'], current['audited_operations'],
+                current['subprocesses']))
+    return lines
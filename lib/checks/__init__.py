@@ -1,12 +1,38 @@
 import abc
-from os import walk
-from os.path import join as path_join
-from pkgutil import walk_packages
-from inspect import getmembers, isclass
-from subprocess import call
-from grp import getgrgid
+from stat import S_ISDIR
+from subprocess import call, check_call, check_output, run, Popen
+from threading import local
+from time import perf_counter, process_time, thread_time
+
+from lib.util import debug, log, warning, call_capturing_output, \
+    replay_output, log_channel, set_log_channel, flush_output
+from lib.homes import HomesSnapshot
+from lib.nss import NssIndex
+from lib.templates import TemplateExpander
+from lib.metrics import CheckMetrics
+from lib.plan import passwd_fields
+from lib.tree import walk_tree, exclusion_regex
+
+subprocess_functions = (call, check_call, check_output, run, Popen)
+"""functions that start a process, to count them"""
+
+_current = local()
+"""``_current.context`` is the ``UserContext`` of the user checked
+by ``FusedPerUserChecks`` in this thread"""
+
+class UserContext():
+    """
+    Data about a user, shared by all checks of a ``FusedPerUserChecks``
+    pass while the user is checked.
+    """
+
+    def __init__(self, user):
 
-from lib.util import debug, log
+        self.user = user
+        """the user (``pwd.struct_passwd``)"""
+
+        self.expansions = {}
+        """Dictionary of {string: string expanded for ``user``}"""
 
 class AbstractCheckBase(metaclass=abc.ABCMeta):
     """
@@ -20,16 +46,49 @@ class AbstractCheckBase(metaclass=abc.ABCMeta):
     Lower numbers are executed earlier.
     """
 
-    def __init__(self, home_path, users, simulate, options):
+    incremental = True
+    """
+    Whether it suffices to check users and directories whose passwd or
+    group entry or whose home (``stat``) changed since the last run.
+
+    Checks for which it depends on their options override it with a
+    property.
+    """
+
+    def __init__(self, home_path, users, simulate, options, homes=None,
+                 workers=1, passwd=None, nss=None, templates=None,
+                 directories=None, plan=None):
 
         self.home_path = home_path
         """
         Path to users home directory, not expanded yet.
         """
 
+        if homes is None:
+            homes = HomesSnapshot.for_home_path(home_path)
+        self.homes = homes
+        """
+        ``HomesSnapshot`` shared by all checks of a run.
+
+        Use this instead of ``stat``'ing homes directly and ``refresh`` it
+        after changing a home.
+        """
+
         self.users = users
         """see full config example for explanation"""
 
+        self.directories = directories
+        """
+        Directories per directory checks are limited to (e.g. in
+        incremental runs), ``None`` for all existing directories.
+        """
+
+        self.uncorrected = []
+        """
+        Users or directories found incorrect but not corrected
+        (because correction is disabled in configuration).
+        """
+
         self.simulate = simulate
         """If True, nothing should ever be done."""
 
@@ -40,6 +99,46 @@ class AbstractCheckBase(metaclass=abc.ABCMeta):
         All options from section defined in attribute 'config_section'.
         """
 
+        self.workers = options.get_int('workers', workers)
+        """
+        Number of threads evaluating ``is_correct`` concurrently.
+
+        Can be overridden per check section, defaults to the one from
+        the main section.
+        """
+
+        self.passwd = passwd
+        """
+        ``PasswdEditor`` collecting changes to passwd entries for all
+        checks, ``None`` if ``usermod`` should be used.
+        """
+
+        if nss is None:
+            nss = NssIndex()
+        self.nss = nss
+        """
+        ``NssIndex`` to use for all lookups of users and groups.
+        """
+
+        if templates is None:
+            templates = TemplateExpander(nss)
+        self.templates = templates
+        """
+        ``TemplateExpander`` shared by all checks of a run.
+        """
+
+        self.plan = plan
+        """
+        ``Plan`` to record all corrections in (see ``execute_safely``),
+        ``None`` to not record them.
+        """
+
+        self.metrics = CheckMetrics(self.config_section)
+        """``CheckMetrics`` of this check"""
+
+        self.changed_accounts = False
+        """whether passwd entries were changed (not only simulated)"""
+
         self.post_init()
         """hook for subclasses"""
 
@@ -52,31 +151,31 @@ class AbstractCheckBase(metaclass=abc.ABCMeta):
         """
         pass
 
-    @classmethod
-    def group_name_for_user(cls, user):
+    def group_name_for_user(self, user):
         """
         Returns the group name of a users primary group.
         """
-        return getgrgid(user.pw_gid).gr_name
+        return self.nss.getgrgid(user.pw_gid).gr_name
 
-    @classmethod
-    def expand_string_for_user(cls, string, user):
+    def expand_string_for_user(self, string, user):
         """
         Expands variables in string according to users.
         """
-        return string.replace(
-                    "$u", user.pw_name
-                ).replace(
-                    "$h", user.pw_dir
-                ).replace(
-                    "$g", cls.group_name_for_user(user)
-                )
+        context = getattr(_current, 'context', None)
+        if context is None or context.user is not user:
+            return self.templates.expand(string, user)
+        try:
+            return context.expansions[string]
+        except KeyError:
+            expanded = self.templates.expand(string, user, memoize=False)
+            context.expansions[string] = expanded
+            return expanded
 
     def get_home_for_user(self, user):
         """
         Expands variables in path to users home path.
         """
-        return self.__class__.expand_string_for_user(
+        return self.expand_string_for_user(
             self.home_path,
             user
         )
@@ -90,29 +189,81 @@ class AbstractCheckBase(metaclass=abc.ABCMeta):
         """
         pass
 
-    def execute_safely(self, function, *args, **kwargs):
+    @staticmethod
+    def function_name(function):
+        """
+        Returns the qualified name of ``function``.
+        """
+        return "%s.%s" % (function.__module__, function.__name__)
+
+    @classmethod
+    def call_as_pretty_string(cls, function, args, kwargs):
+        """
+        Returns a human readable representation of a function call.
+        """
+        return "%s(%s, %s)" % (
+            cls.function_name(function),
+            ', '.join((repr(arg) for arg in args)),
+            ', '.join(( "%s=%s" % (repr(k), repr(v))
+                        for k, v in kwargs.items())),
+        )
+
+    def execute_safely(self, function, *args, preconditions=None,
+                       full_path=None, **kwargs):
         """
         Method prints what would be done if simulating or
         does it otherwise.
-        """
-        def call_as_pretty_string():
-            return "%s.%s(%s, %s)" % (
-                function.__module__,
-                function.__name__,
-                ', '.join((repr(arg) for arg in args)),
-                ', '.join(( "%s=%s" % (repr(k), repr(v))
-                            for k, v in kwargs.items())),
-            )
+
+        If a ``plan`` is set, the call is recorded there, together with
+        ``preconditions`` (see ``lib.plan.Plan``) under which it is
+        correct.
+
+        For calls with a path relative to a ``dir_fd``, ``full_path`` is
+        printed and recorded instead of the path and the descriptor.
+        """
+        logged_args, logged_kwargs = args, kwargs
+        if full_path is not None:
+            logged_args = (full_path, ) + args[1:]
+            logged_kwargs = dict(kwargs)
+            del logged_kwargs['dir_fd']
+        pretty_string = self.call_as_pretty_string(function, logged_args,
+                                                   logged_kwargs)
+        self.metrics.count_correction(self.function_name(function))
+        if self.plan is not None:
+            self.plan.record(self.config_section, function, logged_args,
+                             logged_kwargs, preconditions)
 
         if self.simulate:
-            log("simulating - would execute %s otherwise" % (
-                call_as_pretty_string()
-            ))
+            log("simulating - would execute %s otherwise", pretty_string)
             return None
         else:
-            log("executing " + call_as_pretty_string())
+            log("executing " + pretty_string)
+            if function in subprocess_functions:
+                self.metrics.subprocesses += 1
+                flush_output()
             return function(*args, **kwargs)
 
+    def submit_safely(self, executor, function, *args, preconditions=None,
+                      **kwargs):
+        """
+        Like ``execute_safely`` but submits the call to ``executor``
+        (e.g. a ``concurrent.futures.ProcessPoolExecutor``).
+
+        Returns the ``Future`` or ``None`` if simulating.
+        """
+        pretty_string = self.call_as_pretty_string(function, args, kwargs)
+        self.metrics.count_correction(self.function_name(function))
+        if self.plan is not None:
+            self.plan.record(self.config_section, function, args, kwargs,
+                             preconditions)
+
+        if self.simulate:
+            log("simulating - would execute %s otherwise", pretty_string)
+            return None
+        else:
+            log("submitting " + pretty_string)
+            return executor.submit(function, *args, **kwargs)
+
     def execute_subprocess_safely(self, *args, **kwargs):
         """
         Convenience wrapper around ``execute_safely`` to easily call
@@ -121,6 +272,69 @@ class AbstractCheckBase(metaclass=abc.ABCMeta):
         """
         self.execute_safely(call, *args, **kwargs)
 
+    def evaluate_correctness(self, items):
+        """
+        Yields tuples (item, is_correct(item)) in the order of ``items``.
+
+        With more than one worker, ``is_correct`` is evaluated
+        concurrently by a pool of threads. The output of every
+        evaluation is captured and replayed in order, so that the log
+        looks like the one from a serial run. Corrections are left to
+        the caller, i.e. they happen serially.
+        """
+        count_correctness = self.metrics.count_correctness
+        if self.workers <= 1:
+            for item in items:
+                is_correct = self.is_correct(item)
+                count_correctness(is_correct)
+                yield item, is_correct
+            return
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        items = list(items)
+        with ThreadPoolExecutor(self.workers, initializer=set_log_channel,
+                                initargs=(self.config_section, )) as executor:
+            evaluations = executor.map(
+                lambda item: call_capturing_output(self.is_correct, item),
+                items
+            )
+            for item, (result, exception, lines) in zip(items,
+                                                        evaluations):
+                replay_output(lines)
+                if exception:
+                    raise exception
+                count_correctness(result)
+                yield item, result
+
+    def change_passwd_entry_safely(self, user, field, value):
+        """
+        Sets ``field`` ('home' or 'shell') of the passwd entry of
+        ``user`` to ``value``.
+
+        If a ``PasswdEditor`` is configured, the change will be written
+        together with all others at the end of the run. Otherwise,
+        ``usermod`` is called.
+        """
+        preconditions = {
+            'user': user.pw_name,
+            field: getattr(user, passwd_fields[field]),
+        }
+        if not self.simulate:
+            self.changed_accounts = True
+        if self.passwd is not None:
+            self.execute_safely(
+                self.passwd.set_field, user.pw_name, field, value,
+                preconditions=preconditions
+            )
+        else:
+            self.execute_subprocess_safely([
+                'usermod',
+                {'home': '-d', 'shell': '-s'}[field],
+                value,
+                user.pw_name
+            ], preconditions=preconditions)
+
     def check(self):
         """
         Executes all checks according to configuration.
@@ -128,7 +342,13 @@ class AbstractCheckBase(metaclass=abc.ABCMeta):
         if not self.options.get_bool('check'):
             debug("check skipped: disabled in configuration")
             return
-        self._check()
+        wall, cpu = perf_counter(), process_time()
+        try:
+            with log_channel(self.config_section):
+                self._check()
+        finally:
+            self.metrics.add_time(perf_counter() - wall,
+                                  process_time() - cpu)
 
     @abc.abstractmethod
     def _check(self):
@@ -177,25 +397,29 @@ class AbstractPerDirectoryCheck(AbstractCheckBase):
         """
         Collects a set of all existing directories in the home_path.
         """
-        base_home_path = self.home_path.replace("$u", "")
-
-        assert "$h" not in base_home_path
-        assert "$g" not in base_home_path
-
-        for _, directory_names, _ in walk(base_home_path):
-            return (path_join(base_home_path, name)
-                        for name in directory_names)
+        return iter(self.homes.directories())
 
+    def get_directories_to_check(self):
+        """
+        Returns the existing directories, limited to ``directories``
+        if set.
+        """
+        if self.directories is None:
+            return self.get_existing_directories()
+        return (directory for directory in self.get_existing_directories()
+                    if directory in self.directories)
 
     def _check(self):
         """
         For every existing home directory, check if it's correct and
         correct if required and configured.
         """
-        for directory in self.get_existing_directories():
-            if not self.is_correct(directory):
+        for directory, is_correct in self.evaluate_correctness(
+                self.get_directories_to_check()):
+            if not is_correct:
                 if not self.options.get_bool('correct'):
                     debug("correction skipped: disabled in configuration")
+                    self.uncorrected.append(directory)
                     continue
                 self.correct(directory)
 
@@ -218,17 +442,87 @@ class AbstractPerUserCheck(AbstractCheckBase):
     Executes checks per existing user.
     """
 
+    def walk_home(self, home_path):
+        """
+        Yields the entries (``lib.tree.TreeEntry``) below ``home_path``
+        if the option ``recursive`` is set, except the ones matching the
+        option ``recursive_exclude``.
+
+        A home which cannot be walked (e.g. a symlink or not readable)
+        is skipped with a warning instead of aborting the check.
+
+        Close the generator when not exhausting it, e.g. via
+        ``contextlib.closing``.
+        """
+        if not self.options.get_bool('recursive', False):
+            return
+        try:
+            yield from walk_tree(home_path, exclusion_regex(
+                self.options.get_str('recursive_exclude', '')
+            ))
+        except OSError as exception:
+            warning("cannot walk '%s', skipping it: %s", home_path,
+                    exception)
+
+    @staticmethod
+    def is_changeable(entry):
+        """
+        Returns whether ``execute_in_home_safely`` changes an entry of
+        ``walk_home``, i.e. it is no file with more than one link.
+
+        Entries which are not are ignored by ``is_correct``, so that they
+        do not make a home incorrect in every run.
+        """
+        return entry.stat.st_nlink <= 1 or S_ISDIR(entry.stat.st_mode)
+
+    def execute_in_home_safely(self, function, entry, *args,
+                               preconditions=None, **kwargs):
+        """
+        Like ``execute_safely`` for an entry of ``walk_home``:
+        ``function`` gets the entry's name and the descriptor of its
+        directory (``dir_fd``), so no path is resolved again.
+
+        Files with more than one link are not changed, they might be
+        linked from outside the home (see ``is_changeable``).
+        """
+        if not self.is_changeable(entry):
+            warning("not changing '%s', it has %u links", entry.path,
+                    entry.stat.st_nlink)
+            return None
+        return self.execute_safely(
+            function, entry.name, *args, dir_fd=entry.dir_fd,
+            full_path=entry.path, preconditions=preconditions, **kwargs
+        )
+
     def _check(self):
         """
         For every user, check if the home directory is correct and
         correct with respect to the configuration.
         """
-        for user in self.users:
-            if not self.is_correct(user):
-                if not self.options.get_bool('correct'):
-                    debug("correction skipped: disabled in configuration")
-                    continue
-                self.correct(user)
+        users = self.homes.prefetched(self.users, self.get_home_for_user)
+        for user, is_correct in self.evaluate_correctness(users):
+            if not is_correct:
+                self.correct_if_configured(user)
+        self.finish()
+
+    def correct_if_configured(self, user):
+        """
+        Corrects for an incorrect user if enabled in the configuration.
+
+        Returns whether the correction was done.
+        """
+        if not self.options.get_bool('correct'):
+            debug("correction skipped: disabled in configuration")
+            self.uncorrected.append(user)
+            return False
+        self.correct(user)
+        return True
+
+    def finish(self):
+        """
+        Hook for subclasses, called after all users have been checked.
+        """
+        pass
 
     @abc.abstractmethod
     def is_correct(self, user):
@@ -244,56 +538,220 @@ class AbstractPerUserCheck(AbstractCheckBase):
         """
         pass
 
+class FusedPerUserChecks():
+    """
+    Does several per user checks (sharing the same users) in a single
+    pass over the users: for every user, all checks are done and
+    corrected in the given order before continuing with the next user.
+
+    The checks share the expanded templates, the snapshot of the homes
+    and the index of users and groups anyway, so a user's data is used
+    by all checks while it is still at hand.
+    """
+
+    def __init__(self, checks, workers=1):
+
+        self.checks = checks
+        """list of ``AbstractPerUserCheck``'s, sorted by ``order``"""
+
+        self.workers = workers
+        """number of threads evaluating correctness concurrently"""
+
+    @staticmethod
+    def timed(check, function, *args):
+        """
+        Returns a tuple of the result of ``function`` (called in the
+        log channel of ``check``), the elapsed time and the CPU time of
+        this thread.
+        """
+        wall, cpu = perf_counter(), thread_time()
+        with log_channel(check.config_section):
+            result = function(*args)
+        return result, perf_counter() - wall, thread_time() - cpu
+
+    def evaluate_user(self, checks, user):
+        """
+        Returns a tuple of the ``UserContext`` and a list of the
+        results of ``timed(check, check.is_correct, user)`` for all ``checks``.
+        """
+        context = UserContext(user)
+        _current.context = context
+        try:
+            return context, [self.timed(check, check.is_correct, user)
+                             for check in checks]
+        finally:
+            _current.context = None
+
+    def evaluations(self, checks, users):
+        """
+        Yields tuples (``UserContext``, list of timed correctness or
+        ``None``) in the order of ``users``.
+
+        With more than one worker, all checks of a user are evaluated
+        concurrently to other users, as in
+        ``AbstractCheckBase.evaluate_correctness``. Otherwise,
+        correctness is evaluated lazily (``None``).
+        """
+        if self.workers <= 1:
+            for user in users:
+                yield UserContext(user), None
+            return
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        users = list(users)
+        with ThreadPoolExecutor(self.workers) as executor:
+            evaluations = executor.map(
+                lambda user: call_capturing_output(
+                    self.evaluate_user, checks, user
+                ),
+                users
+            )
+            for result, exception, lines in evaluations:
+                replay_output(lines)
+                if exception:
+                    raise exception
+                yield result
+
+    def run(self):
+        """
+        Does all enabled checks.
+        """
+        checks = []
+        for check in self.checks:
+            if check.options.get_bool('check'):
+                checks.append(check)
+            else:
+                debug("check %s skipped: disabled in configuration",
+                      check.config_section)
+        if not checks:
+            return
+
+        debug("doing checks %s in one pass", ', '.join(
+            check.config_section for check in checks))
+        users = checks[0].homes.prefetched(checks[0].users,
+                                           checks[0].get_home_for_user)
+        for context, results in self.evaluations(checks, users):
+            user = context.user
+            _current.context = context
+            corrected = False
+            for index, check in enumerate(checks):
+                metrics = check.metrics
+                # after a correction, later checks need to see its effect
+                if results is None or corrected:
+                    is_correct, wall, cpu = self.timed(check,
+                                                       check.is_correct,
+                                                       user)
+                else:
+                    is_correct, wall, cpu = results[index]
+                metrics.add_time(wall, cpu)
+                metrics.count_correctness(is_correct)
+                if not is_correct:
+                    done, wall, cpu = self.timed(check,
+                                                 check.correct_if_configured,
+                                                 user)
+                    metrics.add_time(wall, cpu)
+                    corrected = done or corrected
+        _current.context = None
+
+        for check in checks:
+            _, wall, cpu = self.timed(check, check.finish)
+            check.metrics.add_time(wall, cpu)
+
 class AbstractAllUsersAndAllDirectoriesCheck(AbstractPerDirectoryCheck):
     """
     Somehow a hybrid from per user and per directory checks.
 
-    Checks and corrections get handed a iterable of users and existing
-    directories.
+    The homes of all users and all existing directories are compared
+    once, by merging both sorted. Checks and corrections get handed the
+    differences, i.e. tuples of (``MISSING`` or ``OBSOLETE``, directory).
+
+    Only the differences are streamed: the expanded homes of all users
+    are held in memory (sorted, see ``differences``), as users are not
+    enumerated in the order of their homes.
 
-    Might be memory intensive in large setups.
+    Earlier versions called ``is_correct(users, directories)`` and
+    ``correct(users, directories)`` with all users and directories,
+    checks written for that interface have to be adapted to
+    ``is_correct(kind, directory)`` and ``correct(differences)``.
     """
 
+    incremental = False
+
+    MISSING = 'missing'
+    """kind of difference: a users home does not exist"""
+
+    OBSOLETE = 'obsolete'
+    """kind of difference: a directory does not belong to any user"""
+
+    def differences(self):
+        """
+        Yields the differences between the homes of all users and the
+        existing directories, sorted by directory.
+
+        Besides the existing directories (which are sorted already),
+        only the sorted home paths are held in memory.
+        """
+        homes = sorted(self.get_home_for_user(u) for u in self.users)
+        directories = self.get_existing_directories()
+
+        home_index = 0
+        homes_count = len(homes)
+        for directory in directories:
+            while home_index < homes_count and homes[home_index] < directory:
+                home = homes[home_index]
+                home_index += 1
+                if home_index < homes_count and homes[home_index] == home:
+                    continue
+                yield self.MISSING, home
+            if home_index < homes_count and homes[home_index] == directory:
+                while home_index < homes_count and \
+                        homes[home_index] == directory:
+                    home_index += 1
+            else:
+                yield self.OBSOLETE, directory
+
+        previous = None
+        for home in homes[home_index:]:
+            if home != previous:
+                yield self.MISSING, home
+            previous = home
+
     def _check(self):
         """
-        Checks correctness and corrects if configured using iterables of
-        all users and existing directories.
+        Checks correctness of every difference and hands the incorrect
+        ones (as a stream) to ``correct`` if configured.
         """
-        directories = list(self.get_existing_directories() or [])
-        users = self.users
+        def is_incorrect(kind, directory):
+            is_correct = self.is_correct(kind, directory)
+            self.metrics.count_correctness(is_correct)
+            return not is_correct
+
+        incorrect = (
+            (kind, directory) for kind, directory in self.differences()
+            if is_incorrect(kind, directory)
+        )
+
+        if self.options.get_bool('correct'):
+            self.correct(incorrect)
+            return
 
-        if not self.is_correct(users, directories):
-            debug("correction required")
-            if not self.options.get_bool('correct'):
-                debug("correction skipped: disabled in configuration")
-                return
-            self.correct(users, directories)
+        for kind, directory in incorrect:
+            debug("correction for %s '%s' skipped: disabled in "
+                  "configuration", kind, directory)
+            self.uncorrected.append(directory)
 
     @abc.abstractmethod
-    def is_correct(self, users, directories):
+    def is_correct(self, kind, directory):
         """
-        Checks correctness with a list of users and directories.
+        Checks correctness of a difference (see ``differences``).
         """
         pass
 
     @abc.abstractmethod
-    def correct(self, users, directories):
+    def correct(self, differences):
         """
-        Corrects home directory for a list of users and directories..
+        Corrects an iterable of incorrect differences
+        (see ``differences``).
         """
         pass
-
-"""
-Import all checks dynamically
-Let's see when it crashes :)
-"""
-for module_loader, module_name, _ in walk_packages(__path__):
-    module = module_loader.find_module(module_name).load_module(module_name)
-    for cls_name, cls in getmembers(module):
-        if not isclass(cls):
-            continue
-        if not issubclass(cls, AbstractCheckBase):
-            continue
-        if cls_name.startswith("Abstract"):
-            continue
-        exec('from %s import *' % module_name)
@@ -0,0 +1,138 @@
+from time import strftime, localtime
+
+from lib.checks import AbstractPerDirectoryCheck
+from lib.usage import tree_usage, format_size, UsageCache
+from lib.util import debug, log, warning, atomic_write
+
+class DiskUsageCheck(AbstractPerDirectoryCheck):
+    """
+    Sums up the disk usage of every home, reports the largest ones and
+    flags the ones using more than a threshold.
+    """
+
+    config_section = "disk_usage"
+
+    order = 6000
+
+    incremental = False
+    """files deep inside homes can change without the home changing"""
+
+    @property
+    def threshold(self):
+        """
+        allocated bytes a home may use, ``None`` for no limit
+        """
+        megabytes = self.options.get('threshold_megabytes', None)
+        return None if megabytes is None else int(megabytes) << 20
+
+    @property
+    def cache_max_age(self):
+        """
+        seconds after which cached directories are read again
+        """
+        return self.options.get_int('cache_max_age', 86400)
+
+    def post_init(self):
+        """
+        Loads the cache of disk usage, if configured.
+        """
+
+        self.usages = {}
+        """Dictionary of {directory: ``lib.usage.TreeUsage``}"""
+
+        self.cache = None
+        """``UsageCache`` of the homes, if configured"""
+
+        cache_path = self.options.get('cache_file', None)
+        if cache_path:
+            self.cache = UsageCache(cache_path)
+            self.cache.load()
+
+    def is_correct(self, directory):
+        """
+        Sums up the disk usage of a home, which is correct if it does
+        not exceed the threshold.
+        """
+        cached = None
+        if self.cache is not None:
+            cached = self.cache.homes.get(directory, None)
+        try:
+            usage, tree_cache = tree_usage(directory, cached,
+                                           self.cache_max_age)
+        except FileNotFoundError:
+            debug("'%s' disappeared", directory)
+            return True
+        if self.cache is not None:
+            self.cache.homes[directory] = tree_cache
+        self.usages[directory] = usage
+        debug("'%s' uses %s (%s apparent) in %u inodes, read %u "
+              "directories, %u cached", directory,
+              format_size(usage.allocated), format_size(usage.apparent),
+              usage.inodes, usage.directories_read,
+              usage.directories_cached)
+
+        threshold = self.threshold
+        return threshold is None or usage.allocated <= threshold
+
+    def correct(self, directory):
+        """
+        Nothing can be corrected automatically, the home is flagged.
+        """
+        warning("'%s' uses %s, more than %s", directory,
+                format_size(self.usages[directory].allocated),
+                format_size(self.threshold))
+
+    def _check(self):
+        """
+        Sums up all homes, then writes the report and the cache (unless
+        simulating).
+        """
+        super(DiskUsageCheck, self)._check()
+
+        if self.simulate:
+            debug("simulating, neither writing report nor cache")
+            return
+
+        report_path = self.options.get('report_file', None)
+        if report_path:
+            self.write_report(report_path,
+                              self.options.get_int('report_top', 20))
+
+        if self.cache is not None:
+            if self.directories is None:
+                for directory in list(self.cache.homes):
+                    if directory not in self.usages:
+                        del self.cache.homes[directory]
+            self.cache.save()
+
+    def write_report(self, path, top):
+        """
+        Atomically writes the ``top`` homes by allocated size to
+        ``path``, marking the ones over the threshold with '!'.
+        """
+        threshold = self.threshold
+        ranking = sorted(self.usages.items(),
+                         key=lambda item: (-item[1].allocated, item[0]))
+        lines = [
+            "# disk usage of %u homes at %s, %s allocated in total" % (
+                len(ranking), strftime('%Y-%m-%d %H:%M:%S'),
+                format_size(sum(usage.allocated
+                                for _, usage in ranking))),
+            "#  %9s %9s %10s  %-19s  %s" % (
+                'allocated', 'apparent', 'inodes', 'newest mtime', 'home'),
+        ]
+        for directory, usage in ranking[:top]:
+            over = threshold is not None and usage.allocated > threshold
+            lines.append("%s  %9s %9s %10u  %s  %s" % (
+                '!' if over else ' ',
+                format_size(usage.allocated), format_size(usage.apparent),
+                usage.inodes,
+                strftime('%Y-%m-%d %H:%M:%S',
+                         localtime(usage.newest_mtime)),
+                directory,
+            ))
+
+        with atomic_write(path) as report_file:
+            report_file.write('\n'.join(lines) + '\n')
+        log("wrote disk usage of the %u largest of %u homes to '%s'",
+            min(top, len(ranking)), len(ranking), path)
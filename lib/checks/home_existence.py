@@ -1,7 +1,10 @@
 from os import mkdir
 
 from lib.checks import AbstractAllUsersAndAllDirectoriesCheck
-from lib.util import debug
+from lib.plan import path_precondition
+from lib.provisioning import provision_home, skeleton_entries, \
+    provisioning_methods
+from lib.util import debug, error
 
 class HomeExistenceCheck(AbstractAllUsersAndAllDirectoriesCheck):
     """
@@ -12,19 +15,135 @@ class HomeExistenceCheck(AbstractAllUsersAndAllDirectoriesCheck):
 
     order = 100
 
-    def missing_directories(self, users, directories):
+    @property
+    def provision(self):
         """
-        Returns a set of obsolete directories.
+        whether missing homes are created complete (see
+        ``lib.provisioning``) instead of empty
         """
-        existing_directories = set(directories)
-        users_directories = set(self.get_home_for_user(u) for u in users)
-        return users_directories - existing_directories
+        return self.options.get_bool('provision', False)
 
-    def correct(self, users, directories):
-        for directory in self.missing_directories(users, directories):
-            debug("creating missing directory '%s'" % directory)
-            self.execute_safely(mkdir, directory, 700)
+    @property
+    def permissions(self):
+        """
+        permissions of provisioned homes
+        """
+        return int(self.options.get_str('octal_permissions', '700'), 8)
+
+    @property
+    def skeleton_path(self):
+        """
+        directory to populate provisioned homes from, ``None`` for none
+        """
+        return self.options.get('skeleton_path', None)
+
+    @property
+    def skeleton_method(self):
+        """
+        how files get from the skeleton into homes (see
+        ``lib.provisioning.provisioning_methods``)
+        """
+        method = self.options.get_str('skeleton_method', 'copy')
+        if method not in provisioning_methods:
+            raise ValueError("Unknown skeleton_method '%s'" % method)
+        return method
+
+    @property
+    def provision_workers(self):
+        """
+        maximum number of homes to provision concurrently
+        """
+        return self.options.get_int('provision_workers', 1)
+
+    def correct(self, differences):
+        if self.provision:
+            self.provision_homes(directory for _, directory in differences)
+            return
+        for _, directory in differences:
+            debug("creating missing directory '%s'", directory)
+            self.execute_safely(
+                mkdir, directory, 0o700,
+                preconditions=path_precondition(directory, exists=False)
+            )
+            self.homes.refresh(directory)
+
+    def is_correct(self, kind, directory):
+        return kind != self.MISSING
+
+    def provision_arguments(self, user, directory):
+        """
+        Returns the arguments for ``provision_home`` for the home
+        ``directory`` of ``user``.
+        """
+        return (
+            directory,
+            self.permissions,
+            self.nss.getpwnam(self.expand_string_for_user(
+                self.options.get_str('owner', '$u'), user
+            )).pw_uid,
+            self.nss.getgrnam(self.expand_string_for_user(
+                self.options.get_str('group', '$g'), user
+            )).gr_gid,
+            self.skeleton_path,
+            self.skeleton_method,
+        )
+
+    def provision_homes(self, directories):
+        """
+        Provisions the missing home ``directories``, using a pool of
+        threads if configured.
+        """
+        users = {}
+        """Dictionary of {home: user}"""
+        for user in self.users:
+            users.setdefault(self.get_home_for_user(user), user)
+        skeleton_path = self.skeleton_path
+        skeleton_listed = False
+
+        def submit(directory):
+            nonlocal skeleton_listed
+            if skeleton_path and not skeleton_listed:
+                entries = skeleton_entries(skeleton_path, refresh=True)
+                debug("listed %u entries of skeleton '%s'", len(entries),
+                      skeleton_path)
+                skeleton_listed = True
+            debug("provisioning missing directory '%s'", directory)
+            arguments = self.provision_arguments(users[directory], directory)
+            preconditions = path_precondition(directory, exists=False)
+            if executor is None:
+                return self.execute_safely(provision_home, *arguments,
+                                           preconditions=preconditions)
+            return self.submit_safely(executor, provision_home, *arguments,
+                                      preconditions=preconditions)
+
+        def finish(directory, copied):
+            if copied is not None:
+                self.metrics.bytes_copied += copied
+            self.homes.refresh(directory)
+
+        def failed(directory, exception):
+            error("provisioning '%s' failed: %s", directory, exception)
+
+        if self.provision_workers <= 1 or self.simulate:
+            executor = None
+            for directory in directories:
+                try:
+                    finish(directory, submit(directory))
+                except Exception as exception:
+                    failed(directory, exception)
+            return
+
+        from concurrent.futures import ThreadPoolExecutor
 
-    def is_correct(self, users, directories):
-        debug("checking for missing directories")
-        return not bool(self.missing_directories(users, directories))
+        with ThreadPoolExecutor(self.provision_workers) as executor:
+            futures = []
+            for directory in directories:
+                try:
+                    futures.append((directory, submit(directory)))
+                except Exception as exception:
+                    failed(directory, exception)
+            for directory, future in futures:
+                try:
+                    finish(directory, future.result())
+                except Exception as exception:
+                    failed(directory, exception)
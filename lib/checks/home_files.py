@@ -1,12 +1,17 @@
-from os import getcwd, mkdir
-from os.path import join as path_join, isfile, isdir, dirname
+from os import getcwd, mkdir, stat
+from os.path import join as path_join, isdir, dirname
+from stat import S_ISREG
 from filecmp import cmp as compare_files
 from shutil import copymode
-from functools import lru_cache
-from subprocess import check_output, check_call
+from subprocess import check_call
 
 from lib.util import debug
 from lib.checks import AbstractPerUserCheck
+from lib.file_list import load_source_manifest
+from lib.fingerprints import FingerprintIndex
+from lib.copying import copy_file
+from lib.elf import DependencyResolver
+from lib.plan import path_precondition
 
 class FilesToHomeCheck(AbstractPerUserCheck):
     """
@@ -18,6 +23,9 @@ class FilesToHomeCheck(AbstractPerUserCheck):
 
     order = 5000
 
+    incremental = False
+    """files deep inside homes can change without the home changing"""
+
     @property
     def unexpanded_paths(self):
         """
@@ -26,20 +34,28 @@ class FilesToHomeCheck(AbstractPerUserCheck):
         Lazily load attribute in order to allow it to be not configured
         (when check is disabled).
         """
-        paths_file_name = self.options.get_str('file_list')
-        paths = []
-        for line in open(paths_file_name):
-            line = line.strip()
-            if not line or line.startswith('#'):
-                continue
-            paths.append(line)
-        return paths
+        if self.source_manifest is None:
+            self.source_manifest = load_source_manifest(
+                self.options.get_str('file_list')
+            )
+        return self.source_manifest.paths
 
     def post_init(self):
         """
         Load file paths from configured file into ``unexpanded_paths``.
         """
 
+        self.source_manifest = None
+        """``SourceManifest`` of the configured file list"""
+
+        self.fingerprints = None
+        """``FingerprintIndex`` of deployed files, if configured"""
+
+        fingerprints_path = self.options.get('fingerprints_file', None)
+        if fingerprints_path:
+            self.fingerprints = FingerprintIndex(fingerprints_path)
+            self.fingerprints.load()
+
         self.missing_files = {}
         """
         Dictionary of {user: file_name}
@@ -48,9 +64,8 @@ class FilesToHomeCheck(AbstractPerUserCheck):
         """
 
         debug(
-            "Loaded list of files for section '%s': %r" % (
-                self.config_section, self.unexpanded_paths
-            )
+            "Loaded list of files for section '%s': %r",
+            self.config_section, self.unexpanded_paths
         )
 
     def get_src_and_dst_path(self, user, path):
@@ -101,57 +116,131 @@ class FilesToHomeCheck(AbstractPerUserCheck):
             user, file_path
         )
 
-        debug("Comparing '{0}' and '{1}'".format(
-            src_file_path, dst_file_path
-        ))
+        debug("Comparing '%s' and '%s'", src_file_path, dst_file_path)
 
-        if not isfile(dst_file_path):
+        try:
+            dst_stat = stat(dst_file_path)
+        except OSError:
+            return False
+        if not S_ISREG(dst_stat.st_mode):
             return False
 
-        return compare_files(
-            src_file_path, dst_file_path
+        home_path = self.get_home_for_user(user)
+        fingerprints = self.fingerprints
+
+        if fingerprints is not None and fingerprints.matches(
+                home_path, file_path, src_file_path, dst_stat):
+            debug("...fingerprint matches.")
+            return True
+
+        if not compare_files(src_file_path, dst_file_path):
+            return False
+
+        if fingerprints is not None:
+            fingerprints.record(
+                home_path, file_path, src_file_path, dst_stat
+            )
+        return True
+
+    def record_deployed_file(self, user, file_path):
+        """
+        Records the fingerprint of a file just copied to the home.
+        """
+        if self.fingerprints is None or self.simulate:
+            return
+        src_file_path, dst_file_path = self.get_src_and_dst_path(
+            user, file_path
+        )
+        self.fingerprints.record(
+            self.get_home_for_user(user),
+            file_path,
+            src_file_path,
+            stat(dst_file_path)
         )
 
-    def ensure_parent_directories_in_home(self, user, path):
+    def ensure_parent_directories_in_home(self, user, path, ensured):
         """
         Ensures that all parent directories of ``path``
         exist in the home, including the equality of the mode.
+
+        ``ensured`` is a set of directories (relative to the real root)
+        already ensured for this home, it will be updated.
         """
         parent = dirname(path)
-        src_dir, dst_dir = self.get_src_and_dst_path(
-            user,
-            dirname(path)
-        )
+
+        if parent in ensured:
+            return
+
+        src_dir, dst_dir = self.get_src_and_dst_path(user, parent)
 
         if src_dir == "/":
             return
 
         if not isdir(dst_dir):
-            self.ensure_parent_directories_in_home(user, parent)
-            self.execute_safely(mkdir, dst_dir)
+            self.ensure_parent_directories_in_home(user, parent, ensured)
+            self.execute_safely(
+                mkdir, dst_dir,
+                preconditions=path_precondition(dst_dir, exists=False)
+            )
 
         self.execute_safely(copymode, src_dir, dst_dir)
+        ensured.add(parent)
+
+    @property
+    def copy_backend(self):
+        """
+        How to copy files: 'native' (in process) or 'rsync'.
+        """
+        return self.options.get_str('copy_backend', 'native')
+
+    def copy_to_home(self, src_file_path, dst_file_path):
+        """
+        Copies a file to a home using the configured backend.
+        """
+        # for plans: copy only what has been compared
+        preconditions = path_precondition(
+            src_file_path, stat(src_file_path), 'size', 'mtime_ns'
+        )
+        if self.copy_backend == 'rsync':
+            # we are using rsync and not cp, since cp won't overwrite
+            # a regular file with a special file (???)
+            #   --copy-links should be named --dereference ;)
+            self.execute_safely(check_call, ["rsync", "-a", "--copy-links",
+                                "--no-recursive", src_file_path,
+                                dst_file_path], preconditions=preconditions)
+            if not self.simulate:
+                self.metrics.bytes_copied += stat(src_file_path).st_size
+        else:
+            copied = self.execute_safely(copy_file, src_file_path,
+                                         dst_file_path,
+                                         preconditions=preconditions)
+            self.metrics.bytes_copied += copied or 0
 
     def correct(self, user):
         """
         Copies all missing files to the home,
         preserving parent direcotries, rights and ownership.
         """
+        ensured_directories = set()
         for missing_file in self.missing_files[user]:
             src_file_path, dst_file_path = self.get_src_and_dst_path(
                 user, missing_file
             )
 
-            self.ensure_parent_directories_in_home(user, src_file_path)
+            self.ensure_parent_directories_in_home(
+                user, src_file_path, ensured_directories
+            )
+            self.copy_to_home(src_file_path, dst_file_path)
+            self.record_deployed_file(user, missing_file)
 
-            # we are using rsync and not cp, since cp won't overwrite
-            # a regular file with a special file (???)
-            #   --copy-links should be named --dereference ;)
-            self.execute_safely(check_call, ["rsync", "-a", "--copy-links",
-                                "--no-recursive", src_file_path,
-                                dst_file_path])
+        del self.missing_files[user]
 
-        self.missing_files = {}
+    def finish(self):
+        """
+        Saves the fingerprints of deployed files.
+        """
+        if self.fingerprints is not None and not self.simulate:
+            self.fingerprints.save()
 
 class BinariesWithLibrariesToHomeCheck(FilesToHomeCheck):
     """
@@ -164,32 +253,35 @@ class BinariesWithLibrariesToHomeCheck(FilesToHomeCheck):
 
     order = 5010
 
-    @lru_cache()
-    def get_dependendencies_for_expanded_path(self, binary_path):
+    def post_init(self):
         """
-        Returns a list of paths to librarires that are required by
+        Additionally, sets up the resolver for dependencies.
         """
-        out = []
-        ldd_out = check_output(['ldd', binary_path]).decode('utf-8')
-        ldd_out_lines = ldd_out.split("\n")
-        for ldd_out_line in ldd_out_lines:
+        super(BinariesWithLibrariesToHomeCheck, self).post_init()
 
-            # ex:'	libacl.so.1 => /lib/x86_64-linux-gnu/libacl.so.1 (…)'
-            if '=> /' in ldd_out_line:
-                out.append(
-                    ldd_out_line.split(' ')[2]
-                )
-
-            # ex: "	/lib64/ld-linux-x86-64.so.2 (…)"
-            if ldd_out_line.startswith("\t/"):
-                out.append(
-                    ldd_out_line.split(" ")[0].strip()
-                )
+        self.dependency_resolver = DependencyResolver(
+            self.options.get('dependency_cache_file', None)
+        )
+        """``DependencyResolver`` for the listed binaries"""
 
-        debug("Dependencies for '{0}': {1}".format(binary_path, out))
+        self.dependency_resolver.load()
 
+    def get_dependendencies_for_expanded_path(self, binary_path):
+        """
+        Returns a list of paths to librarires that are required by
+        """
+        out = self.dependency_resolver.dependencies(binary_path)
+        debug("Dependencies for '%s': %s", binary_path, out)
         return out
 
+    def finish(self):
+        """
+        Additionally, saves the resolved dependencies.
+        """
+        super(BinariesWithLibrariesToHomeCheck, self).finish()
+        if not self.simulate:
+            self.dependency_resolver.save()
+
     def check_existance_and_fill_missing_files(self, user):
         """
         Checks if all binaries listed in the configuration and their
@@ -1,8 +1,8 @@
-from os import stat, chown
-from os.path import isdir
-from grp import getgrnam
+from os import chown
+from contextlib import closing
 
 from lib.checks import AbstractPerUserCheck
+from lib.plan import path_precondition
 from lib.util import debug
 
 class HomeGroupCheck(AbstractPerUserCheck):
@@ -12,6 +12,14 @@ class HomeGroupCheck(AbstractPerUserCheck):
 
     config_section = "home_group"
 
+    @property
+    def incremental(self):
+        """
+        files deep inside homes can change without the home changing, so
+        not if ``recursive``
+        """
+        return not self.options.get_bool('recursive', False)
+
     @property
     def group_unexpanded(self):
         """
@@ -27,37 +35,58 @@ class HomeGroupCheck(AbstractPerUserCheck):
         Returns the desired group for a certain user (expands variables
         from configuration).
         """
-        return getgrnam(
-            self.__class__.expand_string_for_user(
+        return self.nss.getgrnam(
+            self.expand_string_for_user(
                 self.group_unexpanded, user
             )
         ).gr_gid
 
-    @classmethod
     def group_uid_for_path(self, path):
         """
         Returns group for a path
         """
-        return stat(path).st_gid
+        return self.homes.stat_directory(path).st_gid
 
     def correct(self, user):
         home_path = self.get_home_for_user(user)
-        debug("setting group for %s to %s" % (home_path, user.pw_name))
-        if not isdir(home_path):
+        debug("setting group for %s to %s", home_path, user.pw_name)
+        home_stat = self.homes.stat_directory(home_path)
+        if home_stat is None:
             debug("...directory does not exist. Doing nothing.")
             return
-        self.execute_safely(
-            chown,
-            home_path,
-            -1,
-            self.group_uid_for_user(user)
-        )
+        gid = self.group_uid_for_user(user)
+        if home_stat.st_gid != gid:
+            self.execute_safely(
+                chown,
+                home_path,
+                -1,
+                gid,
+                preconditions=path_precondition(home_path, home_stat, 'gid')
+            )
+            self.homes.refresh(home_path)
+
+        for entry in self.walk_home(home_path):
+            if entry.stat.st_gid != gid:
+                self.execute_in_home_safely(
+                    chown, entry, -1, gid, follow_symlinks=False,
+                    preconditions=path_precondition(entry.path, entry.stat,
+                                                    'gid')
+                )
 
     def is_correct(self, user):
         home_path = self.get_home_for_user(user)
-        debug("checking directory group for %s" % user.pw_name)
-        if not isdir(home_path):
+        debug("checking directory group for %s", user.pw_name)
+        if not self.homes.isdir(home_path):
             debug("...directory does not exist. Ignoring.")
             return True
-        current_gid = self.__class__.group_uid_for_path(home_path)
-        return current_gid == self.group_uid_for_user(user)
+        gid = self.group_uid_for_user(user)
+        if self.group_uid_for_path(home_path) != gid:
+            return False
+
+        with closing(self.walk_home(home_path)) as entries:
+            for entry in entries:
+                if entry.stat.st_gid != gid and self.is_changeable(entry):
+                    debug("...'%s' has group %u", entry.path,
+                          entry.stat.st_gid)
+                    return False
+        return True
@@ -1,8 +1,8 @@
-from os import stat, chown
-from os.path import isdir
-from pwd import getpwnam
+from os import chown
+from contextlib import closing
 
 from lib.checks import AbstractPerUserCheck
+from lib.plan import path_precondition
 from lib.util import debug
 
 class HomeOwnerCheck(AbstractPerUserCheck):
@@ -12,6 +12,14 @@ class HomeOwnerCheck(AbstractPerUserCheck):
 
     config_section = "home_owner"
 
+    @property
+    def incremental(self):
+        """
+        files deep inside homes can change without the home changing, so
+        not if ``recursive``
+        """
+        return not self.options.get_bool('recursive', False)
+
     @property
     def owner_unexpanded(self):
         """
@@ -27,37 +35,58 @@ class HomeOwnerCheck(AbstractPerUserCheck):
         Returns the desired owner for a certain user (expands variables
         from configuration).
         """
-        return getpwnam(
-            self.__class__.expand_string_for_user(
+        return self.nss.getpwnam(
+            self.expand_string_for_user(
                 self.owner_unexpanded, user
             )
         ).pw_uid
 
-    @classmethod
     def owner_uid_for_path(self, path):
         """
         Returns owner for a path
         """
-        return stat(path).st_uid
+        return self.homes.stat_directory(path).st_uid
 
     def correct(self, user):
         home_path = self.get_home_for_user(user)
-        debug("setting owner for %s to %s" % (home_path, user.pw_name))
-        if not isdir(home_path):
+        debug("setting owner for %s to %s", home_path, user.pw_name)
+        home_stat = self.homes.stat_directory(home_path)
+        if home_stat is None:
             debug("...directory does not exist. Doing nothing.")
             return
-        self.execute_safely(
-            chown,
-            home_path,
-            self.owner_uid_for_user(user),
-            -1
-        )
+        uid = self.owner_uid_for_user(user)
+        if home_stat.st_uid != uid:
+            self.execute_safely(
+                chown,
+                home_path,
+                uid,
+                -1,
+                preconditions=path_precondition(home_path, home_stat, 'uid')
+            )
+            self.homes.refresh(home_path)
+
+        for entry in self.walk_home(home_path):
+            if entry.stat.st_uid != uid:
+                self.execute_in_home_safely(
+                    chown, entry, uid, -1, follow_symlinks=False,
+                    preconditions=path_precondition(entry.path, entry.stat,
+                                                    'uid')
+                )
 
     def is_correct(self, user):
         home_path = self.get_home_for_user(user)
-        debug("checking directory owner for %s" % user.pw_name)
-        if not isdir(home_path):
+        debug("checking directory owner for %s", user.pw_name)
+        if not self.homes.isdir(home_path):
             debug("...directory does not exist. Ignoring.")
             return True
-        current_uid = self.__class__.owner_uid_for_path(home_path)
-        return current_uid == self.owner_uid_for_user(user)
+        uid = self.owner_uid_for_user(user)
+        if self.owner_uid_for_path(home_path) != uid:
+            return False
+
+        with closing(self.walk_home(home_path)) as entries:
+            for entry in entries:
+                if entry.stat.st_uid != uid and self.is_changeable(entry):
+                    debug("...'%s' is owned by %u", entry.path,
+                          entry.stat.st_uid)
+                    return False
+        return True
@@ -1,8 +1,10 @@
-from os import stat, chmod
-from stat import S_IMODE
-from os.path import isdir
+from os import chmod
+from stat import S_IMODE, S_ISLNK
+from contextlib import closing
 
 from lib.checks import AbstractPerUserCheck
+from lib.plan import path_precondition
+from lib.tree import chmod_nofollow
 from lib.util import debug
 
 class HomePermissionCheck(AbstractPerUserCheck):
@@ -12,6 +14,14 @@ class HomePermissionCheck(AbstractPerUserCheck):
 
     config_section = "home_permissions"
 
+    @property
+    def incremental(self):
+        """
+        files deep inside homes can change without the home changing, so
+        not if ``recursive``
+        """
+        return not self.options.get_bool('recursive', False)
+
     @property
     def permissions(self):
         """
@@ -22,19 +32,57 @@ class HomePermissionCheck(AbstractPerUserCheck):
         """
         return int(self.options.get_str('octal_permissions'), 8)
 
+    @property
+    def forbidden_permissions(self):
+        """
+        permissions nothing below the home directories may have (if
+        ``recursive``)
+        """
+        return int(self.options.get_str(
+            'recursive_forbidden_octal_permissions', '002'
+        ), 8)
+
     def correct(self, user):
         home_path = self.get_home_for_user(user)
-        debug("setting permissions for %s to %o" % (
-            home_path, self.permissions))
-        if not isdir(home_path):
+        debug("setting permissions for %s to %o", home_path, self.permissions)
+        home_stat = self.homes.stat_directory(home_path)
+        if home_stat is None:
             debug("...directory does not exist. Doing nothing.")
             return
-        self.execute_safely(chmod, home_path, self.permissions)
+        if S_IMODE(home_stat.st_mode) != self.permissions:
+            self.execute_safely(
+                chmod, home_path, self.permissions,
+                preconditions=path_precondition(home_path, home_stat, 'mode')
+            )
+            self.homes.refresh(home_path)
+
+        forbidden = self.forbidden_permissions
+        for entry in self.walk_home(home_path):
+            mode = S_IMODE(entry.stat.st_mode)
+            if mode & forbidden and not S_ISLNK(entry.stat.st_mode):
+                self.execute_in_home_safely(
+                    chmod_nofollow, entry, mode & ~forbidden,
+                    preconditions=path_precondition(entry.path, entry.stat,
+                                                    'mode')
+                )
 
     def is_correct(self, user):
-        debug("checking directory permissions for %s" % user.pw_name)
+        debug("checking directory permissions for %s", user.pw_name)
         home_path = self.get_home_for_user(user)
-        if not isdir(home_path):
+        home_stat = self.homes.stat_directory(home_path)
+        if home_stat is None:
             debug("...directory does not exist. Ignoring.")
             return True
-        return S_IMODE(stat(home_path).st_mode) == self.permissions
+        if S_IMODE(home_stat.st_mode) != self.permissions:
+            return False
+
+        forbidden = self.forbidden_permissions
+        with closing(self.walk_home(home_path)) as entries:
+            for entry in entries:
+                if entry.stat.st_mode & forbidden and \
+                        not S_ISLNK(entry.stat.st_mode) and \
+                        self.is_changeable(entry):
+                    debug("...'%s' has permissions %o", entry.path,
+                          S_IMODE(entry.stat.st_mode))
+                    return False
+        return True
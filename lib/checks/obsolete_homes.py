@@ -1,10 +1,13 @@
 # encoding: utf-8
 
 from os import chmod, listdir
-from os.path import isfile, basename, dirname, join as path_join
-from shutil import make_archive, rmtree
+from os.path import isfile, getsize, basename, dirname, \
+    join as path_join
+from shutil import rmtree
 from lib.checks import AbstractAllUsersAndAllDirectoriesCheck
-from lib.util import debug, log
+from lib.archiving import create_archive, archive_path, archive_formats
+from lib.plan import path_precondition
+from lib.util import debug, error
 
 class ObsoleteHomesCheck(AbstractAllUsersAndAllDirectoriesCheck):
     """
@@ -35,79 +38,184 @@ class ObsoleteHomesCheck(AbstractAllUsersAndAllDirectoriesCheck):
         """
         return self.options.get_int('trash_octal_permissions')
 
-    def obsolete_directories(self, users, directories):
+    @property
+    def archive_format(self):
         """
-        Returns a set of obsolete directories.
+        format of archives in trash (see ``lib.archiving.archive_formats``)
+
+        Lazily load attribute in order to allow it to be not configured
+        (when check is disabled).
         """
-        existing_directories = set(directories)
-        users_directories = set(self.get_home_for_user(u) for u in users)
-        return existing_directories - users_directories
+        archive_format = self.options.get_str('trash_format', 'bztar')
+        if archive_format not in archive_formats:
+            raise ValueError("Unknown trash_format '%s'" % archive_format)
+        return archive_format
 
-    def is_correct(self, users, directories):
+    @property
+    def compression_level(self):
         """
-        Checks correctness with a list of users and directories.
+        compression level for archives in trash, ``None`` for default
         """
-        return not bool(self.obsolete_directories(users, directories))
+        level = self.options.get('trash_compression_level', None)
+        return None if level is None else int(level)
 
-    def correct(self, users, directories):
+    @property
+    def archive_workers(self):
         """
-        Corrects home directory for a list of users and directories..
+        maximum number of archives to create concurrently
         """
-        obsoletes = self.obsolete_directories(users, directories)
-        for directory_path in obsoletes:
-            self.do_trash_directory(directory_path)
+        return self.options.get_int('archive_workers', 1)
+
+    def is_correct(self, kind, directory):
+        """
+        Checks correctness of a difference (only obsolete directories
+        are incorrect).
+        """
+        return kind != self.OBSOLETE
+
+    def correct(self, differences):
+        """
+        Archives and deletes obsolete directories.
+        """
+        to_archive = []
+        for _, directory_path in differences:
+            if listdir(directory_path):
+                to_archive.append(directory_path)
+            else:
+                debug("not archiving empty directory '%s'", directory_path)
+                self.do_delete_directory(directory_path)
+
+        for directory_path, archive_file_path in \
+                self.do_archive_directories(to_archive):
+            if archive_file_path is None:
+                debug("keeping directory '%s'", directory_path)
+                continue
+            if not self.simulate:
+                self.metrics.bytes_archived += getsize(archive_file_path)
+            self.execute_safely(    chmod,
+                                    archive_file_path,
+                                    self.octal_permissions)
+            self.do_delete_directory(directory_path, archive_file_path)
 
     def trash_file_path(self, directory_path, suffix_number=0):
         """
-        Assembles & returns the path of the trash file.
+        Assembles & returns the path of the trash file (w/o extension).
         """
         candidate = path_join(self.trash_path, basename(directory_path))
 
         if suffix_number:
             candidate += "_%u" % suffix_number
 
-        if isfile(candidate):
+        if isfile(archive_path(candidate, self.archive_format)):
             return self.trash_file_path(directory_path, suffix_number+1)
         else:
             return candidate
 
-    def do_archive_directory(self, directory_path):
+    def directory_precondition(self, directory_path):
         """
-        Archives directory contents to trash if not empty.
-
-        Returns True on success, False otherwise
+        Returns the precondition that the directory did not change
+        (e.g. for plans, see ``lib.plan``).
         """
-        trash_file_path = self.trash_file_path(directory_path)
-        archive_path = self.execute_safely(
-            make_archive,
-            trash_file_path,
-            "bztar",
-            dirname(directory_path),
-            basename(directory_path)
+        return path_precondition(
+            directory_path,
+            self.homes.stat_directory(directory_path),
+            'mtime_ns'
         )
 
-        if not archive_path and not self.simulate:
-            log("ERROR: something went wrong - no archive " +
-                "file name found after archive creation!")
-            return False
-
-        self.execute_safely(    chmod,
-                                archive_path,
-                                self.octal_permissions)
-        return True
+    def archive_preconditions(self, arguments):
+        """
+        Returns the preconditions for ``create_archive(*arguments)``.
+        """
+        return [
+            self.directory_precondition(path_join(arguments[1],
+                                                  arguments[2])),
+            path_precondition(archive_path(arguments[0], arguments[3]),
+                              exists=False),
+        ]
 
-    def do_trash_directory(self, directory_path):
+    def archive_arguments(self, directory_path):
         """
-        Moves directory to trash.
+        Returns the arguments for ``create_archive`` for a directory.
         """
-        if listdir(directory_path):
-            debug("archiving directory '%s'" % directory_path)
-            if not self.do_archive_directory(directory_path):
-                return
-        else:
-            debug("not archiving empty directory '%s'" % directory_path)
+        return (
+            self.trash_file_path(directory_path),
+            dirname(directory_path),
+            basename(directory_path),
+            self.archive_format,
+            self.compression_level,
+        )
 
-        debug("deleting directory '%s'" % directory_path)
+    def do_archive_directories(self, directory_paths):
+        """
+        Archives directories to trash, using a pool of processes if
+        configured.
+
+        Yields tuples of (directory path, archive path) in order, where
+        ``archive path`` is ``None`` if archiving or verifying the
+        archive failed.
+        """
+        if self.archive_workers <= 1 or self.simulate:
+            for directory_path in directory_paths:
+                yield directory_path, self.do_archive_directory(
+                    directory_path)
+            return
+
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(self.archive_workers) as executor:
+            futures = []
+            for directory_path in directory_paths:
+                arguments = self.archive_arguments(directory_path)
+                futures.append((directory_path, self.submit_safely(
+                    executor,
+                    create_archive,
+                    *arguments,
+                    preconditions=self.archive_preconditions(arguments)
+                )))
+            for directory_path, future in futures:
+                try:
+                    yield directory_path, future.result()
+                except Exception as exception:
+                    self.log_archive_error(directory_path, exception)
+                    yield directory_path, None
+
+    def do_archive_directory(self, directory_path):
+        """
+        Archives directory contents to trash.
+
+        Returns the path of the verified archive on success (or of the
+        archive that would be created, if simulating), None otherwise
+        """
+        debug("archiving directory '%s'", directory_path)
+        arguments = self.archive_arguments(directory_path)
+        try:
+            path = self.execute_safely(
+                create_archive,
+                *arguments,
+                preconditions=self.archive_preconditions(arguments)
+            )
+        except Exception as exception:
+            self.log_archive_error(directory_path, exception)
+            return None
+        if self.simulate:
+            return archive_path(arguments[0], arguments[3])
+        return path
+
+    @staticmethod
+    def log_archive_error(directory_path, exception):
+        error("archiving '%s' failed (%s) - not deleting it!",
+              directory_path, exception)
+
+    def do_delete_directory(self, directory_path, archive_file_path=None):
+        """
+        Deletes an (archived) directory.
+        """
+        debug("deleting directory '%s'", directory_path)
+        preconditions = [self.directory_precondition(directory_path)]
+        if archive_file_path is not None:
+            preconditions.append(path_precondition(archive_file_path))
         self.execute_safely(    rmtree,
                                 directory_path,
-                                ignore_errors=True)
+                                ignore_errors=True,
+                                preconditions=preconditions)
+        self.homes.refresh(directory_path)
@@ -11,7 +11,7 @@ class UserHomeDirectoryCheck(AbstractPerUserCheck):
     order = 50
 
     def get_expanded_home_path_for_user(self, user):
-        return UserHomeDirectoryCheck.expand_string_for_user(
+        return self.expand_string_for_user(
             self.options.get_str('home_path'), user
         )
 
@@ -26,9 +26,6 @@ class UserHomeDirectoryCheck(AbstractPerUserCheck):
         """
         Corrects a users home directory passwd entry.
         """
-        self.execute_subprocess_safely([
-            'usermod',
-            '-d',
-            self.get_expanded_home_path_for_user(user),
-            user.pw_name
-        ])
+        self.change_passwd_entry_safely(
+            user, 'home', self.get_expanded_home_path_for_user(user)
+        )
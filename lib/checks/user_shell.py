@@ -11,7 +11,7 @@ class UserShellCheck(AbstractPerUserCheck):
     order = 50
 
     def get_expanded_shell_for_user(self, user):
-        return UserShellCheck.expand_string_for_user(
+        return self.expand_string_for_user(
             self.options.get_str('shell'), user
         )
 
@@ -26,9 +26,6 @@ class UserShellCheck(AbstractPerUserCheck):
         """
         Corrects a users shell passwd entry.
         """
-        self.execute_subprocess_safely([
-            'usermod',
-            '-s',
-            self.get_expanded_shell_for_user(user),
-            user.pw_name
-        ])
+        self.change_passwd_entry_safely(
+            user, 'shell', self.get_expanded_shell_for_user(user)
+        )
@@ -0,0 +1,91 @@
+"""
+In-process copying of files, as alternative to calling ``rsync``.
+"""
+
+from os import fstat, fchmod, fchown, utime, rename, unlink
+from os import close, read, write, sendfile
+from os.path import basename, dirname
+from stat import S_ISREG, S_IMODE
+from tempfile import mkstemp
+
+try:
+    from os import copy_file_range
+except ImportError:
+    copy_file_range = None
+
+def copy_file_contents(src_fd, dst_fd, size):
+    """
+    Copies ``size`` bytes from ``src_fd`` to ``dst_fd`` in the kernel if
+    possible. Returns the number of bytes copied.
+    """
+    copied = 0
+
+    if copy_file_range is not None:
+        try:
+            while copied < size:
+                count = copy_file_range(src_fd, dst_fd, size - copied)
+                if not count:
+                    break
+                copied += count
+            return copied
+        except OSError:
+            # e.g. not supported by the file system, try the next method
+            if copied:
+                raise
+
+    try:
+        while copied < size:
+            count = sendfile(dst_fd, src_fd, copied, size - copied)
+            if not count:
+                break
+            copied += count
+        return copied
+    except OSError:
+        if copied:
+            raise
+
+    chunk = read(src_fd, 1 << 20)
+    while chunk:
+        # write may write less than given (e.g. to a pipe or when full)
+        view = memoryview(chunk)
+        while view:
+            view = view[write(dst_fd, view):]
+        copied += len(chunk)
+        chunk = read(src_fd, 1 << 20)
+    return copied
+
+def copy_file(src_path, dst_path):
+    """
+    Copies a file like ``rsync -a --copy-links --no-recursive`` does.
+
+    Symbolic links are dereferenced, mode, owner and times are preserved
+    and whatever is at ``dst_path`` (e.g. a special file) is replaced
+    atomically. Only regular files can be copied.
+
+    Returns the number of bytes copied.
+    """
+    with open(src_path, 'rb') as src_file:
+        src_fd = src_file.fileno()
+        src_stat = fstat(src_fd)
+        if not S_ISREG(src_stat.st_mode):
+            raise ValueError("'%s' is no regular file" % src_path)
+
+        dst_fd, temp_path = mkstemp(
+            dir=dirname(dst_path), prefix='.%s.' % basename(dst_path)
+        )
+        try:
+            copied = copy_file_contents(src_fd, dst_fd, src_stat.st_size)
+            fchown(dst_fd, src_stat.st_uid, src_stat.st_gid)
+            # after chown, which might clear set-user/group-ID bits
+            fchmod(dst_fd, S_IMODE(src_stat.st_mode))
+            utime(dst_fd, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+            close(dst_fd)
+            dst_fd = None
+            rename(temp_path, dst_path)
+        except BaseException:
+            if dst_fd is not None:
+                close(dst_fd)
+            unlink(temp_path)
+            raise
+
+    return copied
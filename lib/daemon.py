@@ -0,0 +1,155 @@
+"""
+Long running mode, reacting to changes of homes and accounts.
+"""
+
+from os.path import dirname, join as path_join
+from time import time
+
+from lib.util import debug, log, flush_output
+from lib.inotify import Inotify, IN_ATTRIB, IN_CLOSE_WRITE, IN_CREATE, \
+    IN_DELETE, IN_MOVED_FROM, IN_MOVED_TO, IN_Q_OVERFLOW
+
+class ChecksDaemon():
+    """
+    Keeps users and homes of a ``ChecksRunner`` loaded and runs the
+    checks only for users and directories affected by changes.
+
+    Changes are detected via inotify on the base directory of the homes
+    and on the passwd and group files. Events are collected until no
+    new events arrive for ``debounce`` seconds.
+    """
+
+    home_events = IN_CREATE | IN_DELETE | IN_ATTRIB | IN_MOVED_FROM | \
+                    IN_MOVED_TO
+    """events in the base directory of the homes to react on"""
+
+    account_events = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    """events in the directories of passwd and group to react on"""
+
+    def __init__(self, runner, group_path='/etc/group'):
+
+        self.runner = runner
+        """``ChecksRunner`` to run the checks with"""
+
+        self.group_path = group_path
+        """path to the group file to watch"""
+
+        self.account_paths = None
+        """set of paths to the passwd and group file"""
+
+        self.debounce = None
+        """see full config example for explanation"""
+
+        self.last_full_run = None
+        """time of the last run of all checks for all users"""
+
+    def run(self):
+        """
+        Runs all checks once, then waits for changes forever.
+        """
+        runner = self.runner
+        runner.load()
+        options = runner.configs[runner.config_section]
+        self.debounce = float(options.get('daemon_debounce', 2))
+
+        passwd_path = runner.passwd.passwd_path if runner.passwd \
+                        else '/etc/passwd'
+        self.account_paths = set((passwd_path, self.group_path))
+
+        inotify = Inotify()
+        try:
+            inotify.add_watch(runner.homes.base_path, self.home_events)
+            for directory in set(dirname(p) for p in self.account_paths):
+                inotify.add_watch(directory, self.account_events)
+            self.run_all()
+            while True:
+                self.handle_events(self.collect_events(inotify))
+        finally:
+            inotify.close()
+
+    def collect_events(self, inotify):
+        """
+        Waits for events and returns all that arrive until there were
+        none for ``debounce`` seconds (or the next full run is due).
+        """
+        timeout = max(0, self.runner.full_sweep_interval -
+                            (time() - self.last_full_run))
+        flush_output()
+        events = inotify.read_events(timeout)
+        while events:
+            more_events = inotify.read_events(self.debounce)
+            if not more_events:
+                break
+            events.extend(more_events)
+        return events
+
+    def run_all(self):
+        """
+        Runs all checks for all users and directories.
+        """
+        runner = self.runner
+        runner.targeted = False
+        runner.changed_users = None
+        runner.changed_directories = None
+        runner.do_checks()
+        runner._save_state()
+        self.last_full_run = time()
+
+    def handle_events(self, events):
+        """
+        Runs checks for the users and directories affected by
+        ``events``.
+        """
+        if not events:
+            log("running all checks (full sweep interval passed)")
+            self.run_all()
+            return
+
+        runner = self.runner
+        base_path = runner.homes.base_path
+        accounts_changed = False
+        directories = set()
+
+        for watched_path, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                log("too many events, running all checks")
+                self.run_all()
+                return
+            if watched_path == base_path:
+                if name:
+                    directories.add(path_join(base_path, name))
+            elif path_join(watched_path, name) in self.account_paths:
+                accounts_changed = True
+
+        changed_users = set()
+        if accounts_changed:
+            old_digests = dict((u.pw_name, runner._user_digest(u))
+                               for u in runner.users)
+            runner._load_users(refresh_nss=True)
+            changed_users.update(
+                u for u in runner.users
+                if old_digests.get(u.pw_name) != runner._user_digest(u)
+            )
+            directories.update(
+                runner.templates.expand(runner.home_path, u)
+                for u in changed_users
+            )
+
+        for directory in directories:
+            runner.homes.refresh(directory)
+
+        changed_users.update(
+            u for u in runner.users
+            if runner.templates.expand(runner.home_path, u) in directories
+        )
+
+        debug("events affect %u users and %u directories",
+              len(changed_users), len(directories))
+        if not changed_users and not directories:
+            return
+
+        runner.targeted = True
+        runner.changed_users = [u for u in runner.users if u in changed_users]
+        runner.changed_directories = directories
+        runner.do_checks()
+        runner._save_state()
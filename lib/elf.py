@@ -0,0 +1,440 @@
+"""
+Resolving of dynamic libraries required by ELF binaries, without
+running ``ldd`` (which might execute the binary's loader).
+"""
+
+from os import stat
+from os.path import dirname, exists, realpath, join as path_join
+from struct import Struct
+from json import load as load_json, dump as dump_json
+
+from lib.util import debug, warning, atomic_write
+
+PT_LOAD = 1
+PT_DYNAMIC = 2
+PT_INTERP = 3
+
+DT_NULL = 0
+DT_NEEDED = 1
+DT_STRTAB = 5
+DT_SONAME = 14
+DT_RPATH = 15
+DT_RUNPATH = 29
+
+ELF_MAGIC = b'\x7fELF'
+LD_SO_CACHE_MAGIC = b'glibc-ld.so.cache1.1'
+
+class ElfInfo():
+    """
+    The information of an ELF file relevant for dynamic linking.
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+        """path to the ELF file"""
+
+        self.elf_class = None
+        """1 for 32 bit, 2 for 64 bit"""
+
+        self.machine = None
+        """architecture (``e_machine``)"""
+
+        self.interpreter = None
+        """path to the program interpreter (dynamic loader) if any"""
+
+        self.needed = []
+        """names of directly required libraries (``DT_NEEDED``)"""
+
+        self.soname = None
+        """the shared object name (``DT_SONAME``) if any"""
+
+        self.rpath = []
+        """directories from ``DT_RPATH``"""
+
+        self.runpath = []
+        """directories from ``DT_RUNPATH``"""
+
+        with open(path, 'rb') as elf_file:
+            self._parse(elf_file)
+
+    def _parse(self, elf_file):
+        """
+        Reads the headers and the dynamic section.
+        """
+        ident = elf_file.read(16)
+        if len(ident) < 16 or ident[:4] != ELF_MAGIC:
+            raise ValueError("'%s' is no ELF file" % self.path)
+
+        self.elf_class = ident[4]
+        byte_order = '<' if ident[5] == 1 else '>'
+        is_64 = self.elf_class == 2
+
+        header = Struct(byte_order + ('HHIQQQIHHHHHH' if is_64
+                                      else 'HHIIIIIHHHHHH'))
+        (_, self.machine, _, _, phoff, _, _, _, phentsize, phnum, _, _,
+         _) = header.unpack(elf_file.read(header.size))
+
+        if is_64:
+            program_header = Struct(byte_order + 'IIQQQQQQ')
+        else:
+            program_header = Struct(byte_order + 'IIIIIIII')
+
+        loads = []
+        dynamic = None
+        for index in range(phnum):
+            elf_file.seek(phoff + index * phentsize)
+            fields = program_header.unpack(
+                elf_file.read(program_header.size)
+            )
+            if is_64:
+                p_type, _, offset, vaddr, _, filesz, _, _ = fields
+            else:
+                p_type, offset, vaddr, _, filesz, _, _, _ = fields
+
+            if p_type == PT_LOAD:
+                loads.append((vaddr, offset, filesz))
+            elif p_type == PT_DYNAMIC:
+                dynamic = (offset, filesz)
+            elif p_type == PT_INTERP:
+                elf_file.seek(offset)
+                self.interpreter = elf_file.read(filesz).rstrip(
+                    b'\0').decode('utf-8', 'surrogateescape')
+
+        if dynamic is None:
+            return
+
+        entry = Struct(byte_order + ('qQ' if is_64 else 'iI'))
+        elf_file.seek(dynamic[0])
+        data = elf_file.read(dynamic[1])
+        entries = []
+        strtab_address = None
+        for tag, value in entry.iter_unpack(
+                data[:len(data) - len(data) % entry.size]):
+            if tag == DT_NULL:
+                break
+            if tag == DT_STRTAB:
+                strtab_address = value
+            entries.append((tag, value))
+
+        if strtab_address is None:
+            return
+
+        strtab_offset = None
+        for vaddr, offset, filesz in loads:
+            if vaddr <= strtab_address < vaddr + filesz:
+                strtab_offset = strtab_address - vaddr + offset
+                break
+        if strtab_offset is None:
+            return
+
+        def read_string(string_offset):
+            elf_file.seek(strtab_offset + string_offset)
+            chunks = []
+            while True:
+                chunk = elf_file.read(64)
+                end = chunk.find(b'\0')
+                if end >= 0 or not chunk:
+                    chunks.append(chunk[:end] if end >= 0 else chunk)
+                    break
+                chunks.append(chunk)
+            return b''.join(chunks).decode('utf-8', 'surrogateescape')
+
+        for tag, value in entries:
+            if tag == DT_NEEDED:
+                self.needed.append(read_string(value))
+            elif tag == DT_SONAME:
+                self.soname = read_string(value)
+            elif tag == DT_RPATH:
+                self.rpath.extend(read_string(value).split(':'))
+            elif tag == DT_RUNPATH:
+                self.runpath.extend(read_string(value).split(':'))
+
+    def is_compatible(self, other):
+        """
+        Returns whether ``other`` (an ``ElfInfo``) can be loaded together
+        with this file.
+        """
+        return (self.elf_class, self.machine) == \
+                (other.elf_class, other.machine)
+
+def read_ld_so_cache(path='/etc/ld.so.cache'):
+    """
+    Returns a dictionary of {library name: [paths]} from the cache of
+    ``ldconfig``.
+
+    Only the (current) glibc format is supported, also when embedded in
+    the old format.
+    """
+    libraries = {}
+    try:
+        with open(path, 'rb') as cache_file:
+            data = cache_file.read()
+    except FileNotFoundError:
+        return libraries
+
+    start = data.find(LD_SO_CACHE_MAGIC)
+    if start < 0:
+        warning("unsupported format of '%s'", path)
+        return libraries
+
+    nlibs, _ = Struct('=II').unpack_from(data, start + 20)
+    entry = Struct('=iIIIQ')
+    entries_start = start + 48
+
+    def read_string(offset):
+        offset += start
+        return data[offset:data.index(b'\0', offset)].decode(
+            'utf-8', 'surrogateescape')
+
+    for index in range(nlibs):
+        _, key, value, _, _ = entry.unpack_from(
+            data, entries_start + index * entry.size
+        )
+        libraries.setdefault(read_string(key), []).append(read_string(value))
+
+    return libraries
+
+class DependencyResolver():
+    """
+    Resolves the transitive closure of the libraries required by ELF
+    binaries, the same way the GNU dynamic loader would do.
+
+    Results can be cached on disk: a binary is not resolved again as long
+    as neither it, nor one of its dependencies, nor the ``ldconfig``
+    cache changed (in terms of inode and modification time).
+    """
+
+    default_directories = {
+        1: ('/lib', '/usr/lib'),
+        2: ('/lib64', '/usr/lib64', '/lib', '/usr/lib'),
+    }
+    """trusted directories of the loader, per ELF class"""
+
+    def __init__(self, cache_path=None, ld_so_cache_path='/etc/ld.so.cache'):
+
+        self.cache_path = cache_path
+        """path to the file results are cached in, ``None`` to disable"""
+
+        self.ld_so_cache_path = ld_so_cache_path
+        """path to the cache of ``ldconfig``"""
+
+        self.ld_so_cache = None
+        """lazily loaded, see ``read_ld_so_cache``"""
+
+        self.infos = {}
+        """Dictionary of {path: ElfInfo or None} for this run"""
+
+        self.resolved = {}
+        """
+        Dictionary of {binary path: [[path, inode, mtime_ns], ...]},
+        with the binary itself first, followed by its dependencies.
+        """
+
+        self.dependencies_of = {}
+        """
+        Dictionary of {binary path: paths of its dependencies} for this
+        run, so that ``resolved`` is validated once per binary and run
+        """
+
+        self.ld_so_cache_mtime_ns = self._mtime_ns(ld_so_cache_path)
+        """to invalidate cached results if ``ldconfig`` ran"""
+
+        self.modified = False
+        """whether ``resolved`` needs to be saved"""
+
+    @staticmethod
+    def _mtime_ns(path):
+        try:
+            return stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def load(self):
+        """
+        Loads cached results from ``cache_path``, if it exists and the
+        ``ldconfig`` cache did not change since.
+        """
+        if not self.cache_path or not exists(self.cache_path):
+            return
+        with open(self.cache_path, 'r') as cache_file:
+            cached = load_json(cache_file)
+        if cached.get('ld_so_cache_mtime_ns') != self.ld_so_cache_mtime_ns:
+            debug("ld.so.cache changed, dropping cached dependencies")
+            return
+        self.resolved = cached['binaries']
+        debug("loaded dependencies of %u binaries", len(self.resolved))
+
+    def save(self):
+        """
+        Atomically writes results to ``cache_path``.
+        """
+        if not self.cache_path or not self.modified:
+            return
+        with atomic_write(self.cache_path) as cache_file:
+            dump_json({
+                'ld_so_cache_mtime_ns': self.ld_so_cache_mtime_ns,
+                'binaries': self.resolved,
+            }, cache_file)
+        self.modified = False
+
+    def info(self, path):
+        """
+        Returns the (cached) ``ElfInfo`` for ``path``, ``None`` if it is
+        not a readable ELF file.
+        """
+        try:
+            return self.infos[path]
+        except KeyError:
+            pass
+        try:
+            info = ElfInfo(path)
+        except (FileNotFoundError, NotADirectoryError):
+            info = None
+        except (OSError, ValueError) as exception:
+            debug("cannot read '%s' as ELF: %s", path, exception)
+            info = None
+        self.infos[path] = info
+        return info
+
+    @staticmethod
+    def expand_search_path(directories, origin_info):
+        """
+        Expands ``$ORIGIN`` in ``directories`` with the directory of the
+        object that contained them.
+        """
+        origin = dirname(realpath(origin_info.path))
+        return [
+            directory.replace('${ORIGIN}', origin).replace('$ORIGIN', origin)
+            for directory in directories if directory
+        ]
+
+    def find_library(self, name, requester, loaders):
+        """
+        Returns the path to the library ``name`` required by
+        ``requester`` (an ``ElfInfo``), ``None`` if not found.
+
+        ``loaders`` is the list of ``ElfInfo``'s that caused
+        ``requester`` to be loaded, the binary first.
+        """
+        candidates = []
+        if '/' in name:
+            candidates.append(name)
+        elif not requester.runpath:
+            for info in [requester] + loaders[::-1]:
+                if not info.runpath:
+                    candidates.extend(
+                        path_join(directory, name) for directory in
+                        self.expand_search_path(info.rpath, info)
+                    )
+        if '/' not in name:
+            candidates.extend(
+                path_join(directory, name) for directory in
+                self.expand_search_path(requester.runpath, requester)
+            )
+            if self.ld_so_cache is None:
+                self.ld_so_cache = read_ld_so_cache(self.ld_so_cache_path)
+            candidates.extend(self.ld_so_cache.get(name, ()))
+            candidates.extend(
+                path_join(directory, name) for directory in
+                self.default_directories.get(requester.elf_class, ())
+            )
+
+        for candidate in candidates:
+            info = self.info(candidate)
+            if info is not None and requester.is_compatible(info):
+                return candidate
+        return None
+
+    def resolve(self, binary_path):
+        """
+        Returns the list of paths of all libraries required (directly
+        or indirectly) by ``binary_path``, including the loader.
+        """
+        binary = self.info(binary_path)
+        if binary is None:
+            return []
+
+        paths = []
+        seen = set()
+
+        if binary.interpreter:
+            # the loader is already loaded, also when required by name
+            interpreter = self.info(binary.interpreter)
+            if interpreter is None:
+                warning("interpreter '%s' required by '%s' not found",
+                        binary.interpreter, binary_path)
+            else:
+                paths.append(binary.interpreter)
+                if interpreter.soname:
+                    seen.add(interpreter.soname)
+
+        queue = [(name, binary, []) for name in binary.needed
+                    if name not in seen]
+        seen.update(binary.needed)
+
+        while queue:
+            name, requester, loaders = queue.pop(0)
+            path = self.find_library(name, requester, loaders)
+            if path is None:
+                warning("library '%s' required by '%s' not found",
+                        name, binary_path)
+                continue
+            library = self.info(path)
+            if library is None:
+                continue
+            if path not in paths:
+                paths.append(path)
+            for needed in library.needed:
+                if needed not in seen:
+                    seen.add(needed)
+                    queue.append((needed, library, loaders + [requester]))
+
+        return paths
+
+    @staticmethod
+    def _signature(path):
+        """
+        Returns [path, inode, mtime_ns] for ``path``.
+        """
+        stat_result = stat(path)
+        return [path, stat_result.st_ino, stat_result.st_mtime_ns]
+
+    def dependencies(self, binary_path):
+        """
+        Like ``resolve`` but using cached results where still valid.
+
+        Within a run, every binary is resolved or validated only once.
+        """
+        try:
+            return self.dependencies_of[binary_path]
+        except KeyError:
+            pass
+        paths = self._dependencies(binary_path)
+        self.dependencies_of[binary_path] = paths
+        return paths
+
+    def _dependencies(self, binary_path):
+        cached = self.resolved.get(binary_path, None)
+        if cached is not None:
+            try:
+                if all(self._signature(path) == [path, ino, mtime_ns]
+                       for path, ino, mtime_ns in cached):
+                    return [path for path, _, _ in cached[1:]]
+            except FileNotFoundError:
+                pass
+
+        if self.info(binary_path) is None:
+            return []
+
+        paths = self.resolve(binary_path)
+        try:
+            self.resolved[binary_path] = [
+                self._signature(path) for path in [binary_path] + paths
+            ]
+            self.modified = True
+        except FileNotFoundError as exception:
+            # removed meanwhile, resolve again next time
+            debug("not caching dependencies of '%s': %s", binary_path,
+                  exception)
+        return paths
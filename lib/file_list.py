@@ -0,0 +1,100 @@
+"""
+Loading of file lists, as used by the ``home_files`` checks.
+"""
+
+from os import stat, walk
+from os.path import isdir, join as path_join
+from glob import glob, has_magic
+
+from lib.util import debug
+
+class SourceManifest():
+    """
+    Deduplicated, sorted list of paths to files listed in a file list.
+
+    Entries in the file list can be
+      * paths to files,
+      * glob patterns (``**`` matches recursively),
+      * paths to directories (all files below will be listed) and
+      * paths containing variables, which will be kept as they are
+        (to be expanded per user).
+    """
+
+    def __init__(self, list_path):
+
+        self.list_path = list_path
+        """path to the file list"""
+
+        self.mtime_ns = stat(list_path).st_mtime_ns
+        """modification time of the file list when loaded"""
+
+        self.paths = self.expand_entries(self.read_entries())
+        """list of paths to the files (possibly containing variables)"""
+
+    def read_entries(self):
+        """
+        Returns all entries from the file list, skipping empty lines and
+        comments.
+        """
+        entries = []
+        with open(self.list_path) as list_file:
+            for line in list_file:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                entries.append(line)
+        return entries
+
+    @staticmethod
+    def files_in_directory(directory):
+        """
+        Yields paths to all non-directories below ``directory``.
+        """
+        for parent, _, file_names in walk(directory):
+            for file_name in file_names:
+                yield path_join(parent, file_name)
+
+    def expand_entries(self, entries):
+        """
+        Expands globs and directories in ``entries``.
+        """
+        paths = set()
+        for entry in entries:
+            if '$' in entry:
+                paths.add(entry)
+                continue
+
+            matches = glob(entry, recursive=True) if has_magic(entry) \
+                        else [entry]
+            for match in matches:
+                if isdir(match):
+                    paths.update(self.files_in_directory(match))
+                else:
+                    paths.add(match)
+        return sorted(paths)
+
+    def is_current(self):
+        """
+        Returns whether the file list did not change since loading.
+        """
+        try:
+            return stat(self.list_path).st_mtime_ns == self.mtime_ns
+        except FileNotFoundError:
+            return False
+
+source_manifests = {}
+"""Dictionary of {path to file list: SourceManifest}"""
+
+def load_source_manifest(list_path):
+    """
+    Returns the (cached) ``SourceManifest`` for the file list at
+    ``list_path``.
+
+    The file list is reloaded if it was modified since loading.
+    """
+    manifest = source_manifests.get(list_path, None)
+    if manifest is None or not manifest.is_current():
+        debug("loading file list '%s'", list_path)
+        manifest = SourceManifest(list_path)
+        source_manifests[list_path] = manifest
+    return manifest
@@ -0,0 +1,112 @@
+"""
+Fingerprints of files deployed to homes, so that unchanged files can be
+confirmed without reading their contents.
+"""
+
+from os.path import exists
+from hashlib import sha256
+from json import load as load_json, dump as dump_json
+
+from lib.util import debug, atomic_write
+
+def file_digest(path, chunk_size=1 << 20):
+    """
+    Returns the hex digest of the contents of the file at ``path``.
+    """
+    digest = sha256()
+    with open(path, 'rb') as file_object:
+        chunk = file_object.read(chunk_size)
+        while chunk:
+            digest.update(chunk)
+            chunk = file_object.read(chunk_size)
+    return digest.hexdigest()
+
+class FingerprintIndex():
+    """
+    Central index of what was deployed to which home.
+
+    For every deployed file, the index stores size, modification time,
+    inode and change time of the copy in the home as well as the digest
+    of the source it was deployed from. A file whose ``stat`` still
+    matches and whose source digest did not change is considered equal
+    to the source. Since the change time cannot be set by users, a copy
+    whose contents were changed will not match anymore.
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+        """path to the file the index is stored in"""
+
+        self.homes = {}
+        """
+        Dictionary of {home: {file path: fingerprint}}, where
+        ``file path`` is the path relative to the real root and
+        ``fingerprint`` is a list as returned by ``fingerprint``.
+        """
+
+        self.source_digests = {}
+        """Dictionary of {source path: digest} for this run"""
+
+    def load(self):
+        """
+        Loads the index from ``path``, if the file exists.
+        """
+        if not exists(self.path):
+            debug("no fingerprints in '%s' yet", self.path)
+            return
+        with open(self.path, 'r') as index_file:
+            self.homes = load_json(index_file)
+        debug("loaded fingerprints for %u homes", len(self.homes))
+
+    def save(self):
+        """
+        Atomically writes the index to ``path``.
+        """
+        with atomic_write(self.path) as index_file:
+            dump_json(self.homes, index_file)
+        debug("saved fingerprints for %u homes", len(self.homes))
+
+    def source_digest(self, src_path):
+        """
+        Returns the digest of the source file, calculated once per run.
+        """
+        try:
+            return self.source_digests[src_path]
+        except KeyError:
+            digest = file_digest(src_path)
+            self.source_digests[src_path] = digest
+            return digest
+
+    @staticmethod
+    def fingerprint(dst_stat, digest):
+        """
+        Returns the fingerprint for a deployed file.
+        """
+        return [
+            dst_stat.st_size,
+            dst_stat.st_mtime_ns,
+            dst_stat.st_ino,
+            dst_stat.st_ctime_ns,
+            digest,
+        ]
+
+    def matches(self, home, file_path, src_path, dst_stat):
+        """
+        Returns whether the deployed file (at ``file_path`` in ``home``,
+        ``stat``'ed as ``dst_stat``) is known to equal ``src_path``.
+        """
+        recorded = self.homes.get(home, {}).get(file_path, None)
+        if recorded is None:
+            return False
+        return recorded == self.fingerprint(
+            dst_stat, self.source_digest(src_path)
+        )
+
+    def record(self, home, file_path, src_path, dst_stat):
+        """
+        Remembers that the deployed file equals ``src_path``.
+        """
+        self.homes.setdefault(home, {})[file_path] = self.fingerprint(
+            dst_stat, self.source_digest(src_path)
+        )
@@ -0,0 +1,176 @@
+"""
+Snapshot of the home directories' metadata, shared by all checks of a run.
+"""
+
+from os import scandir, stat
+from os.path import dirname, normpath, join as path_join
+from stat import S_ISDIR
+from threading import Lock
+
+from lib.util import debug
+from lib.prefetch import LatencyHistogram, prefetch
+
+class HomesSnapshot():
+    """
+    Caches ``stat`` results of directories, keyed by their path.
+
+    The base directory of the homes is listed in a single ``scandir``
+    pass, so that checks do not need to ``stat`` every home on their
+    own. Checks that change a home are expected to call ``refresh``
+    so that later checks see the current state.
+
+    With ``in_flight`` > 1, the directories are ``stat``'ed
+    concurrently (see ``lib.prefetch``), e.g. when every call is a
+    round trip to an NFS server.
+    """
+
+    def __init__(self, base_path, in_flight=1):
+
+        self.base_path = normpath(base_path)
+        """directory containing the homes (e.g. ``/home/student``)"""
+
+        self.stats = None
+        """
+        Dictionary of {path: stat_result}, ``None`` for paths which are
+        known not to be directories.
+        """
+
+        self.load_lock = Lock()
+        """so that concurrent checks do not list the base twice"""
+
+        self.in_flight = in_flight
+        """maximum number of ``stat`` calls issued concurrently"""
+
+        self.latencies = LatencyHistogram()
+        """``LatencyHistogram`` of all ``stat`` calls"""
+
+    @classmethod
+    def for_home_path(cls, home_path, in_flight=1):
+        """
+        Creates a snapshot for the base directory of the (unexpanded)
+        ``home_path``, i.e. the directory before the first variable.
+        """
+        prefix = home_path.split('$', 1)[0]
+        if not prefix.endswith('/'):
+            prefix = dirname(prefix)
+        return cls(prefix, in_flight)
+
+    def load(self):
+        """
+        Lists the base directory and caches the stats of all directories
+        in it.
+        """
+        debug("taking snapshot of '%s'", self.base_path)
+        paths = []
+        try:
+            with scandir(self.base_path) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        paths.append(path_join(self.base_path, entry.name))
+        except FileNotFoundError:
+            debug("...base directory does not exist.")
+        stats = {}
+        for path, stat_result in prefetch(paths, self._timed_stat,
+                                          self.in_flight):
+            if stat_result is not None:
+                stats[path] = stat_result
+        self.stats = stats
+        debug("...found %u directories", len(stats))
+
+    def _ensure_loaded(self):
+        if self.stats is None:
+            with self.load_lock:
+                if self.stats is None:
+                    self.load()
+
+    def directories(self):
+        """
+        Returns a sorted list of paths of all existing directories in the
+        base directory.
+        """
+        self._ensure_loaded()
+        return sorted(
+            path for path, stat_result in self.stats.items()
+            if stat_result is not None and dirname(path) == self.base_path
+        )
+
+    def stat_directory(self, path):
+        """
+        Returns the ``stat`` result for ``path`` if it is an existing
+        directory, ``None`` otherwise.
+
+        Paths outside of the base directory are ``stat``'ed once and
+        cached as well.
+        """
+        self._ensure_loaded()
+        path = normpath(path)
+        try:
+            return self.stats[path]
+        except KeyError:
+            pass
+
+        if dirname(path) == self.base_path:
+            # the listing is complete, hence this is no directory
+            stat_result = None
+        else:
+            stat_result = self._timed_stat(path)
+        self.stats[path] = stat_result
+        return stat_result
+
+    def prefetched(self, items, path_of=None):
+        """
+        Yields ``items`` in order, each once the ``stat`` result of its
+        path (``path_of(item)`` or the item itself) is in the snapshot,
+        so that a loop over the items does not wait for every ``stat``
+        call in turn. Up to ``in_flight`` paths are ``stat``'ed ahead.
+        """
+        if self.in_flight <= 1:
+            yield from items
+            return
+        self._ensure_loaded()
+        if path_of is None:
+            path_of = lambda item: item
+        stats = self.stats
+        base_path = self.base_path
+
+        def needed(item_and_path):
+            _, path = item_and_path
+            return path not in stats and dirname(path) != base_path
+
+        for (item, path), stat_result in prefetch(
+                ((item, normpath(path_of(item))) for item in items),
+                lambda item_and_path: self._timed_stat(item_and_path[1]),
+                self.in_flight, needed):
+            if stat_result is not None or needed((item, path)):
+                stats[path] = stat_result
+            yield item
+
+    def isdir(self, path):
+        """
+        Like ``os.path.isdir`` but using the snapshot.
+        """
+        return self.stat_directory(path) is not None
+
+    def refresh(self, path):
+        """
+        Updates the snapshot for ``path`` (e.g. after a correction).
+        """
+        self._ensure_loaded()
+        self.stats[normpath(path)] = self._timed_stat(path)
+
+    def _timed_stat(self, path):
+        return self.latencies.timed(self._stat, path)
+
+    @staticmethod
+    def _stat(path):
+        """
+        Returns the ``stat`` result if ``path`` is a directory,
+        ``None`` otherwise.
+        """
+        try:
+            stat_result = stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        if not S_ISDIR(stat_result.st_mode):
+            return None
+        return stat_result
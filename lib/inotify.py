@@ -0,0 +1,84 @@
+"""
+Minimal binding to the Linux ``inotify(7)`` API.
+"""
+
+from ctypes import CDLL, get_errno
+from ctypes.util import find_library
+from os import read, close, strerror, fsencode, fsdecode
+from select import select
+from struct import Struct
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_CLOEXEC = 0o2000000
+
+event_header = Struct('iIII')
+"""struct inotify_event without the name: wd, mask, cookie, len"""
+
+class Inotify():
+    """
+    An inotify instance, to watch paths and read events from.
+    """
+
+    def __init__(self):
+
+        self.libc = CDLL(find_library('c') or 'libc.so.6', use_errno=True)
+        """the C library providing the inotify functions"""
+
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        """file descriptor of the instance"""
+
+        if self.fd < 0:
+            self._raise_errno('inotify_init1')
+
+        self.watches = {}
+        """Dictionary of {watch descriptor: watched path}"""
+
+    @staticmethod
+    def _raise_errno(function_name):
+        errno = get_errno()
+        raise OSError(errno, "%s: %s" % (function_name, strerror(errno)))
+
+    def add_watch(self, path, mask):
+        """
+        Watches ``path`` for events in ``mask``.
+        """
+        wd = self.libc.inotify_add_watch(self.fd, fsencode(path), mask)
+        if wd < 0:
+            self._raise_errno('inotify_add_watch')
+        self.watches[wd] = path
+        return wd
+
+    def read_events(self, timeout=None):
+        """
+        Returns a list of events as tuples (watched path, mask, name),
+        waiting at most ``timeout`` seconds (``None`` for no limit).
+        """
+        readable, _, _ = select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+
+        data = read(self.fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = event_header.unpack_from(data, offset)
+            offset += event_header.size
+            name = fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            events.append((self.watches.get(wd, None), mask, name))
+        return events
+
+    def close(self):
+        """
+        Closes the instance (removes all watches).
+        """
+        close(self.fd)
@@ -0,0 +1,238 @@
+"""
+Metrics of runs and checks, exported as JSON and in the text format of
+Prometheus (for the textfile collector of the node exporter).
+"""
+
+from os.path import basename
+from time import time
+from json import dump as dump_json
+
+from lib.util import atomic_write
+
+class CheckMetrics():
+    """
+    What a check did during a run.
+    """
+
+    def __init__(self, check_name):
+
+        self.check_name = check_name
+        """name of the check (its configuration section)"""
+
+        self.wall_seconds = 0.0
+        """elapsed time spent in the check"""
+
+        self.cpu_seconds = 0.0
+        """CPU time spent in the check"""
+
+        self.examined = 0
+        """number of items (users, directories, ...) checked"""
+
+        self.incorrect = 0
+        """number of items found incorrect"""
+
+        self.corrections = {}
+        """Dictionary of {function name: number of calls} (when
+        simulating, the number of calls that would have been done)"""
+
+        self.subprocesses = 0
+        """number of processes started"""
+
+        self.bytes_copied = 0
+        """number of bytes copied (to homes)"""
+
+        self.bytes_archived = 0
+        """size of the archives written"""
+
+    def add_time(self, wall_seconds, cpu_seconds):
+        self.wall_seconds += wall_seconds
+        self.cpu_seconds += cpu_seconds
+
+    def count_correctness(self, is_correct):
+        """
+        Counts an examined item.
+        """
+        self.examined += 1
+        if not is_correct:
+            self.incorrect += 1
+
+    def count_correction(self, function_name):
+        self.corrections[function_name] = \
+            self.corrections.get(function_name, 0) + 1
+
+    def as_dict(self):
+        return {
+            'wall_seconds': self.wall_seconds,
+            'cpu_seconds': self.cpu_seconds,
+            'examined': self.examined,
+            'incorrect': self.incorrect,
+            'corrections': self.corrections,
+            'subprocesses': self.subprocesses,
+            'bytes_copied': self.bytes_copied,
+            'bytes_archived': self.bytes_archived,
+        }
+
+class RunMetrics():
+    """
+    Metrics of all checks of a run.
+    """
+
+    check_metrics = (
+        ('check_duration_seconds', 'wall_seconds',
+         "Elapsed time spent in the check."),
+        ('check_cpu_seconds', 'cpu_seconds',
+         "CPU time spent in the check."),
+        ('check_examined_items', 'examined',
+         "Number of users or directories examined."),
+        ('check_incorrect_items', 'incorrect',
+         "Number of users or directories found incorrect."),
+        ('check_subprocesses', 'subprocesses',
+         "Number of processes started."),
+        ('check_copied_bytes', 'bytes_copied',
+         "Number of bytes copied to homes."),
+        ('check_archived_bytes', 'bytes_archived',
+         "Size of the archives of obsolete homes written."),
+    )
+    """(metric name, ``CheckMetrics`` attribute, help text) per metric"""
+
+    prefix = 'grequalizer_'
+    """prefix of all names of metrics"""
+
+    def __init__(self, config_file, simulate):
+
+        self.config_name = basename(config_file)
+        """name of the configuration file, to tell runs apart"""
+
+        self.simulate = simulate
+        """whether the run was simulating"""
+
+        self.start_time = time()
+        """time the run started"""
+
+        self.end_time = None
+        """time the run ended"""
+
+        self.load_seconds = 0.0
+        """time spent loading configuration, users and homes"""
+
+        self.users = 0
+        """number of users considered"""
+
+        self.stat_latencies = None
+        """``lib.prefetch.LatencyHistogram`` of the ``stat`` calls on
+        homes, if known"""
+
+        self.checks = []
+        """list of ``CheckMetrics``, in order of execution"""
+
+    def add(self, check_metrics):
+        self.checks.append(check_metrics)
+
+    def finish(self):
+        self.end_time = time()
+
+    def as_dict(self):
+        return {
+            'config': self.config_name,
+            'simulate': self.simulate,
+            'start_time': self.start_time,
+            'duration_seconds': self.end_time - self.start_time,
+            'load_seconds': self.load_seconds,
+            'users': self.users,
+            'stat_latency_seconds': None if self.stat_latencies is None
+                                    else self.stat_latencies.as_dict(),
+            'checks': dict(
+                (metrics.check_name, metrics.as_dict())
+                for metrics in self.checks
+            ),
+        }
+
+    @staticmethod
+    def _escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+            '\n', '\\n')
+
+    def _labels(self, **labels):
+        labels = dict(labels, config=self.config_name)
+        return '{%s}' % ','.join(
+            '%s="%s"' % (key, self._escape(value))
+            for key, value in sorted(labels.items())
+        )
+
+    def prometheus_lines(self):
+        """
+        Returns the metrics in the Prometheus text format, as list of
+        lines.
+        """
+        lines = []
+
+        def add_metric(name, help_text, samples):
+            name = self.prefix + name
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s gauge' % name)
+            for labels, value in samples:
+                lines.append('%s%s %s' % (name, self._labels(**labels),
+                                          repr(float(value))))
+
+        add_metric('run_start_time_seconds', "Time the last run started.",
+                   [({}, self.start_time)])
+        add_metric('run_duration_seconds', "Elapsed time of the last run.",
+                   [({}, self.end_time - self.start_time)])
+        add_metric('run_load_seconds',
+                   "Time spent loading configuration, users and homes.",
+                   [({}, self.load_seconds)])
+        add_metric('run_users', "Number of users considered.",
+                   [({}, self.users)])
+        add_metric('run_simulate', "Whether the last run was simulating.",
+                   [({}, self.simulate)])
+
+        for name, attribute, help_text in self.check_metrics:
+            add_metric(name, help_text, [
+                ({'check': metrics.check_name}, getattr(metrics, attribute))
+                for metrics in self.checks
+            ])
+
+        add_metric('check_corrections',
+                   "Number of corrections done (or simulated), by function.",
+                   [({'check': metrics.check_name, 'function': function},
+                     count)
+                    for metrics in self.checks
+                    for function, count in sorted(
+                        metrics.corrections.items())])
+
+        if self.stat_latencies is not None:
+            name = self.prefix + 'stat_latency_seconds'
+            lines.append('# HELP %s %s' % (
+                name, "Latency of stat calls on homes."))
+            lines.append('# TYPE %s histogram' % name)
+            for bound, count in self.stat_latencies.cumulative_counts():
+                lines.append('%s_bucket%s %s' % (
+                    name, self._labels(le=bound), repr(float(count))))
+            lines.append('%s_sum%s %s' % (name, self._labels(),
+                                          repr(self.stat_latencies.sum)))
+            lines.append('%s_count%s %s' % (
+                name, self._labels(),
+                repr(float(self.stat_latencies.count))))
+        return lines
+
+    @staticmethod
+    def _write_atomically(path, write):
+        with atomic_write(path) as metrics_file:
+            write(metrics_file)
+
+    def write_prometheus(self, path):
+        """
+        Atomically writes the metrics to ``path`` (e.g. in the directory
+        of the textfile collector of the node exporter).
+        """
+        self._write_atomically(path, lambda metrics_file: metrics_file.write(
+            '\n'.join(self.prometheus_lines()) + '\n'
+        ))
+
+    def write_json(self, path):
+        """
+        Atomically writes the metrics to ``path`` as JSON.
+        """
+        self._write_atomically(path, lambda metrics_file: dump_json(
+            self.as_dict(), metrics_file, indent=2, sort_keys=True
+        ))
@@ -0,0 +1,294 @@
+"""
+In-memory index of user and group entries (name service switch) and
+a persistent snapshot of it.
+"""
+
+from os import open as os_open, close, fsync, pwrite, fchmod, O_RDWR
+from os.path import exists
+from pwd import getpwall, getpwnam, getpwuid, struct_passwd
+from grp import getgrall, getgrnam, getgrgid, struct_group
+from mmap import mmap, ACCESS_READ
+from struct import Struct, error as struct_error
+from time import time
+
+from lib.util import debug, warning, atomic_write
+
+class NssIndex():
+    """
+    Answers lookups of users and groups by name and id from dictionaries
+    filled by one enumeration of all users and groups.
+
+    Entries not found in the index are looked up individually (and then
+    cached), so an empty index behaves like the functions of the
+    ``pwd`` and ``grp`` modules.
+    """
+
+    def __init__(self, users=(), groups=()):
+
+        self.users = list(users)
+        """all enumerated users (``pwd.struct_passwd``)"""
+
+        self.groups = list(groups)
+        """all enumerated groups (``grp.struct_group``)"""
+
+        self.users_by_name = {}
+        self.users_by_uid = {}
+        self.groups_by_name = {}
+        self.groups_by_gid = {}
+
+        # like the C library, return the first match for ambiguous keys
+        for user in reversed(self.users):
+            self.users_by_name[user.pw_name] = user
+            self.users_by_uid[user.pw_uid] = user
+        for group in reversed(self.groups):
+            self.groups_by_name[group.gr_name] = group
+            self.groups_by_gid[group.gr_gid] = group
+
+    @classmethod
+    def load(cls):
+        """
+        Creates an index of all users and groups.
+        """
+        debug("enumerating users and groups")
+        index = cls(getpwall(), getgrall())
+        debug("...got %u users and %u groups",
+              len(index.users), len(index.groups))
+        return index
+
+    @staticmethod
+    def _lookup(entries, key, fallback):
+        """
+        Returns ``entries[key]``, calls ``fallback(key)`` and caches its
+        result on misses.
+        """
+        try:
+            return entries[key]
+        except KeyError:
+            entry = fallback(key)
+            entries[key] = entry
+            return entry
+
+    def getpwnam(self, name):
+        """
+        Like ``pwd.getpwnam``.
+        """
+        return self._lookup(self.users_by_name, name, getpwnam)
+
+    def getpwuid(self, uid):
+        """
+        Like ``pwd.getpwuid``.
+        """
+        return self._lookup(self.users_by_uid, uid, getpwuid)
+
+    def getgrnam(self, name):
+        """
+        Like ``grp.getgrnam``.
+        """
+        return self._lookup(self.groups_by_name, name, getgrnam)
+
+    def getgrgid(self, gid):
+        """
+        Like ``grp.getgrgid``.
+        """
+        return self._lookup(self.groups_by_gid, gid, getgrgid)
+
+def _enumerate(connection):
+    """
+    Sends all users and groups through ``connection`` (run in a child
+    process by ``NssSnapshot.enumerate``).
+    """
+    connection.send((
+        [tuple(user) for user in getpwall()],
+        [tuple(group) for group in getgrall()],
+    ))
+    connection.close()
+
+class NssSnapshot():
+    """
+    Users and groups stored in a file, so that runs do not need to
+    enumerate them via the name service (e.g. LDAP or NIS) each time.
+
+    The file consists of a header, followed by the users and the groups
+    in the format of passwd and group files, respectively (with 'x' as
+    password, hashes are not stored). Loading maps the file into memory
+    and parses all entries at once into an ``NssIndex``, there are no
+    lookups in the file itself.
+    """
+
+    magic = b'GRQNSS1\0'
+
+    header = Struct('=8sdIIQQQQ')
+    """magic, creation time, user count, group count, offset and length
+    of the users, offset and length of the groups"""
+
+    created_offset = 8
+    """offset of the creation time in the header"""
+
+    def __init__(self, path):
+
+        self.path = path
+        """path to the file the snapshot is stored in"""
+
+        self.created = None
+        """time of the enumeration the snapshot contains"""
+
+    def age(self):
+        """
+        Returns the age of the snapshot in seconds.
+        """
+        return time() - self.created
+
+    @staticmethod
+    def _decode_lines(data):
+        if not data:
+            return []
+        return data.decode('utf-8', 'surrogateescape').split('\n')
+
+    @staticmethod
+    def user_from_line(line):
+        name, password, uid, gid, gecos, directory, shell = line.split(':')
+        return struct_passwd((name, password, int(uid), int(gid), gecos,
+                              directory, shell))
+
+    @staticmethod
+    def group_from_line(line):
+        name, password, gid, members = line.split(':')
+        return struct_group((name, password, int(gid),
+                             members.split(',') if members else []))
+
+    @staticmethod
+    def user_to_line(user):
+        name, _, uid, gid, gecos, directory, shell = user
+        return '%s:x:%u:%u:%s:%s:%s' % (name, uid, gid, gecos, directory,
+                                        shell)
+
+    @staticmethod
+    def group_to_line(group):
+        name, _, gid, members = group
+        return '%s:x:%u:%s' % (name, gid, ','.join(members))
+
+    def load(self):
+        """
+        Returns an ``NssIndex`` of the snapshot, ``None`` if there is no
+        snapshot yet.
+        """
+        if not exists(self.path):
+            debug("no NSS snapshot in '%s' yet", self.path)
+            return None
+
+        with open(self.path, 'rb') as snapshot_file, \
+                mmap(snapshot_file.fileno(), 0, access=ACCESS_READ) as data:
+            (magic, self.created, user_count, group_count, users_offset,
+             users_length, groups_offset, groups_length) = \
+                    self.header.unpack_from(data)
+            if magic != self.magic:
+                raise ValueError("'%s' is no NSS snapshot" % self.path)
+            users = [self.user_from_line(line) for line in self._decode_lines(
+                data[users_offset:users_offset + users_length])]
+            groups = [self.group_from_line(line) for line in
+                      self._decode_lines(
+                data[groups_offset:groups_offset + groups_length])]
+
+        if (len(users), len(groups)) != (user_count, group_count):
+            raise ValueError("NSS snapshot '%s' is truncated" % self.path)
+
+        debug("loaded %u users and %u groups from NSS snapshot",
+              len(users), len(groups))
+        return NssIndex(users, groups)
+
+    @staticmethod
+    def enumerate(timeout):
+        """
+        Enumerates all users and groups in a child process and returns
+        an ``NssIndex``, ``None`` if that takes longer than ``timeout``
+        seconds or fails.
+        """
+        from multiprocessing import get_context
+
+        context = get_context('fork')
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=_enumerate, args=(sender, ),
+                                  daemon=True)
+        debug("enumerating users and groups (at most %us)", timeout)
+        process.start()
+        sender.close()
+        try:
+            if not receiver.poll(timeout):
+                warning("enumerating users and groups timed out")
+                return None
+            users, groups = receiver.recv()
+        except EOFError:
+            warning("enumerating users and groups failed")
+            return None
+        finally:
+            receiver.close()
+            if process.is_alive():
+                process.kill()
+            process.join()
+        return NssIndex(
+            (struct_passwd(user) for user in users),
+            (struct_group(group) for group in groups)
+        )
+
+    def update(self, index, created=None):
+        """
+        Stores ``index`` in the snapshot.
+
+        If users and groups did not change, only the creation time is
+        updated in place, otherwise the file is replaced atomically.
+        """
+        if created is None:
+            created = time()
+        users = [self.user_to_line(user) for user in index.users]
+        groups = [self.group_to_line(group) for group in index.groups]
+
+        try:
+            previous = self.load()
+        except (ValueError, struct_error) as exception:
+            warning("%s, replacing it", exception)
+            previous = None
+
+        if previous is not None:
+            previous_users = [self.user_to_line(u) for u in previous.users]
+            previous_groups = [self.group_to_line(g) for g in previous.groups]
+            # snapshots of older versions may contain password hashes
+            stored_blank = all(u.pw_passwd == 'x' for u in previous.users) \
+                and all(g.gr_passwd == 'x' for g in previous.groups)
+            if (users, groups) == (previous_users, previous_groups) and \
+                    stored_blank:
+                debug("NSS snapshot is up to date")
+                fd = os_open(self.path, O_RDWR)
+                try:
+                    fchmod(fd, 0o600)
+                    pwrite(fd, Struct('=d').pack(created),
+                           self.created_offset)
+                    fsync(fd)
+                finally:
+                    close(fd)
+                self.created = created
+                return
+            users_set, groups_set = set(users), set(groups)
+            previous_users, previous_groups = set(previous_users), \
+                                                set(previous_groups)
+            debug("NSS snapshot changes: users +%u -%u, groups +%u -%u",
+                len(users_set - previous_users),
+                len(previous_users - users_set),
+                len(groups_set - previous_groups),
+                len(previous_groups - groups_set))
+
+        users_data = '\n'.join(users).encode('utf-8', 'surrogateescape')
+        groups_data = '\n'.join(groups).encode('utf-8', 'surrogateescape')
+        users_offset = self.header.size
+        groups_offset = users_offset + len(users_data)
+
+        with atomic_write(self.path, 'wb', 0o600) as snapshot_file:
+            snapshot_file.write(self.header.pack(
+                self.magic, created, len(users), len(groups),
+                users_offset, len(users_data),
+                groups_offset, len(groups_data)
+            ))
+            snapshot_file.write(users_data)
+            snapshot_file.write(groups_data)
+        self.created = created
+        debug("saved NSS snapshot of %u users and %u groups",
+              len(users), len(groups))
@@ -0,0 +1,114 @@
+"""
+Native editing of the passwd file, as an alternative to ``usermod``.
+"""
+
+from os import fchmod, fchown, fstat, fsync, rename, unlink
+from os import open as os_open, close, O_RDONLY, O_DIRECTORY
+from os.path import dirname, join as path_join
+from fcntl import lockf, LOCK_EX, LOCK_UN
+from tempfile import mkstemp
+
+from lib.util import debug, error
+
+class PasswdEditor():
+    """
+    Collects changes to passwd entries and applies all of them in one
+    locked, atomic rewrite of the passwd file.
+    """
+
+    fields = {
+        'home': 5,
+        'shell': 6,
+    }
+    """indices of the editable fields in a passwd line"""
+
+    def __init__(self, passwd_path='/etc/passwd'):
+
+        self.passwd_path = passwd_path
+        """path to the file to edit"""
+
+        self.changes = {}
+        """Dictionary of {login name: {field index: value}}"""
+
+    @property
+    def lock_path(self):
+        """
+        Path to the lock file, as used by ``lckpwdf(3)`` for /etc/passwd.
+        """
+        return path_join(dirname(self.passwd_path), '.pwd.lock')
+
+    def set_field(self, name, field, value):
+        """
+        Remembers to set ``field`` (see ``fields``) of the entry for
+        ``name`` to ``value``.
+        """
+        self.changes.setdefault(name, {})[self.fields[field]] = value
+
+    def edited_lines(self, lines):
+        """
+        Yields ``lines`` with all collected changes applied.
+        """
+        pending = set(self.changes)
+        for line in lines:
+            fields = line.rstrip('\n').split(':')
+            name = fields[0]
+            if len(fields) != 7 or name not in pending:
+                yield line
+                continue
+            pending.remove(name)
+            for index, value in self.changes[name].items():
+                fields[index] = value
+            debug("new passwd entry for %s: %s", name, fields)
+            yield ':'.join(fields) + '\n'
+
+        for name in sorted(pending):
+            error("no entry for '%s' in '%s' - not changed.",
+                  name, self.passwd_path)
+
+    def apply(self):
+        """
+        Writes all collected changes at once.
+
+        While holding the passwd lock, the edited file is written to
+        a temporary file next to the original one, synced and renamed
+        over the original.
+        """
+        if not self.changes:
+            return
+
+        with open(self.lock_path, 'a') as lock_file:
+            lockf(lock_file, LOCK_EX)
+            try:
+                self._rewrite()
+            finally:
+                lockf(lock_file, LOCK_UN)
+
+        self.changes = {}
+
+    def _rewrite(self):
+        """
+        Does the actual rewrite for ``apply``.
+        """
+        directory = dirname(self.passwd_path) or '.'
+        with open(self.passwd_path, 'r') as passwd_file:
+            lines = passwd_file.readlines()
+            original_stat = fstat(passwd_file.fileno())
+
+        fd, temp_path = mkstemp(dir=directory, prefix='.passwd.')
+        try:
+            with open(fd, 'w') as temp_file:
+                temp_file.writelines(self.edited_lines(lines))
+                temp_file.flush()
+                fchmod(fd, original_stat.st_mode & 0o7777)
+                fchown(fd, original_stat.st_uid, original_stat.st_gid)
+                fsync(fd)
+            rename(temp_path, self.passwd_path)
+        except BaseException:
+            unlink(temp_path)
+            raise
+
+        directory_fd = os_open(directory, O_RDONLY | O_DIRECTORY)
+        try:
+            fsync(directory_fd)
+        finally:
+            close(directory_fd)
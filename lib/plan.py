@@ -0,0 +1,358 @@
+"""
+Plans of corrections: recorded by the checks (usually when simulating),
+reviewed by humans and applied later without checking everything again.
+"""
+
+from os import stat, open as os_open, close, O_RDONLY, O_DIRECTORY
+from os.path import dirname, basename
+from stat import S_IMODE
+from pwd import getpwnam
+from time import time
+from importlib import import_module
+from json import dump as dump_json, load as load_json
+
+from lib.util import debug, log, error, atomic_write
+
+operations = {
+    'posix.chmod': (0, False),
+    'posix.chown': (0, False),
+    'lib.tree.chmod_nofollow': (0, False),
+    'posix.mkdir': (0, True),
+    'shutil.rmtree': (0, True),
+    'shutil.copymode': (1, False),
+    'lib.copying.copy_file': (1, True),
+    'subprocess.call': (None, False),
+    'subprocess.check_call': (None, False),
+    'lib.archiving.create_archive': (None, True),
+    'lib.provisioning.provision_home': (0, True),
+}
+"""
+Dictionary of {operation name: (index of the argument with the path the
+function changes or ``None`` if unknown, whether it adds or removes
+entries of the directory of that path)} of operations in plans
+
+Operations are named by the module and name of their function, which
+is only imported when a plan is applied (see ``operation_function``).
+"""
+
+passwd_operation = 'lib.passwd.set_field'
+"""operation name of changes of passwd entries (``PasswdEditor``)"""
+
+dir_fd_operations = ('posix.chmod', 'posix.chown', 'lib.tree.chmod_nofollow')
+"""operations done relative to a file descriptor of the directory when
+applying a plan"""
+
+stat_fields = {
+    'mode': lambda stat_result: S_IMODE(stat_result.st_mode),
+    'uid': lambda stat_result: stat_result.st_uid,
+    'gid': lambda stat_result: stat_result.st_gid,
+    'size': lambda stat_result: stat_result.st_size,
+    'mtime_ns': lambda stat_result: stat_result.st_mtime_ns,
+}
+"""fields of preconditions on paths, extracted from ``stat`` results"""
+
+passwd_fields = {
+    'home': 'pw_dir',
+    'shell': 'pw_shell',
+}
+"""fields of preconditions on users, attributes of passwd entries"""
+
+def operation_function(operation):
+    """
+    Imports and returns the function of one of the ``operations``.
+    """
+    module_name, function_name = operation.rsplit('.', 1)
+    return getattr(import_module(module_name), function_name)
+
+def path_precondition(path, stat_result=None, *fields, **expected):
+    """
+    Returns a precondition on ``path``, with the values of ``fields``
+    taken from ``stat_result`` and/or given as keyword arguments
+    (including ``exists``).
+    """
+    precondition = {'path': path}
+    for field in fields:
+        precondition[field] = stat_fields[field](stat_result)
+    precondition.update(expected)
+    return precondition
+
+class Plan():
+    """
+    Serializable list of steps: operation (see ``operations``),
+    arguments, the check that produced it and the preconditions
+    observed when it was planned.
+
+    Preconditions are dictionaries with either a ``path`` and expected
+    values for ``exists`` and the ``stat_fields`` or a ``user`` and
+    expected values for the ``passwd_fields``.
+    """
+
+    def __init__(self, config_file=None, passwd_file=None):
+
+        self.config_file = config_file
+        """configuration of the run that planned the steps"""
+
+        self.passwd_file = passwd_file
+        """for changes of passwd entries, ``None`` to use ``usermod``"""
+
+        self.created = time()
+        """when the plan was made"""
+
+        self.steps = []
+        """list of dictionaries (see class documentation)"""
+
+    def record(self, check, function, args, kwargs, preconditions=None):
+        """
+        Adds a step for a call of ``function`` to the plan.
+
+        ``preconditions`` can be a single precondition or a list of them.
+        """
+        operation = '%s.%s' % (function.__module__, function.__name__)
+        if operation not in operations and operation != passwd_operation:
+            raise ValueError("'%s' cannot be planned" % operation)
+        if preconditions is None:
+            preconditions = []
+        elif isinstance(preconditions, dict):
+            preconditions = [preconditions]
+        self.steps.append({
+            'check': check,
+            'operation': operation,
+            'args': list(args),
+            'kwargs': kwargs,
+            'preconditions': preconditions,
+        })
+
+    def save(self, path):
+        """
+        Writes the plan to ``path`` as JSON.
+        """
+        with atomic_write(path) as plan_file:
+            dump_json({
+                'config_file': self.config_file,
+                'passwd_file': self.passwd_file,
+                'created': self.created,
+                'steps': self.steps,
+            }, plan_file, indent=1)
+        log("saved plan of %u steps to '%s'", len(self.steps), path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as plan_file:
+            data = load_json(plan_file)
+        plan = cls(data['config_file'], data['passwd_file'])
+        plan.created = data['created']
+        plan.steps = data['steps']
+        return plan
+
+    @staticmethod
+    def accesses(step):
+        """
+        Returns a tuple (directory, paths read, paths written) for a
+        step, where ``directory`` is the one of the changed path and
+        ``paths written`` is ``None`` if unknown.
+
+        Paths of preconditions are read, except the ones expected not
+        to exist, which are written (created).
+        """
+        operation = step['operation']
+        reads, writes = set(), set()
+        for precondition in step['preconditions']:
+            if 'user' in precondition:
+                writes.add(('user', precondition['user']))
+            elif precondition.get('exists', True):
+                reads.add(precondition['path'])
+            else:
+                writes.add(precondition['path'])
+        if operation == passwd_operation:
+            return None, reads, writes
+
+        subject_index, changes_entries = operations[operation]
+        if subject_index is None:
+            created = set(path for path in writes if isinstance(path, str))
+            if not created:
+                return None, reads, None
+            subjects = created
+        else:
+            subjects = set((step['args'][subject_index], ))
+        writes.update(subjects)
+        for subject in subjects:
+            (writes if changes_entries else reads).add(dirname(subject))
+        return dirname(min(subjects)), reads, writes
+
+    def groups(self):
+        """
+        Returns the steps grouped by check, operation and the directory
+        of the changed path, as list of tuples (operation, directory,
+        steps).
+
+        Groups are ordered by their first step, steps within a group
+        keep their order. A step only joins a group if no step in a
+        later group accesses a path it accesses (and at least one of
+        both writes it). Steps changing unknown paths (e.g. starting
+        processes) are not grouped and no step is moved before them.
+        """
+        groups = []
+        latest_group = {}
+        """Dictionary of {key: index of the latest group with key}"""
+        last_read = {}
+        last_written = {}
+        """Dictionaries of {path: index of the last group accessing it}"""
+        barrier = -1
+
+        for step in self.steps:
+            directory, reads, writes = self.accesses(step)
+            key = (step['check'], step['operation'], directory)
+            index = latest_group.get(key, -1)
+
+            if writes is None:
+                index = barrier = len(groups)
+                groups.append((step['operation'], directory, []))
+                writes = set()
+            elif index <= barrier or index < max(
+                    [last_written.get(path, -1) for path in reads | writes] +
+                    [last_read.get(path, -1) for path in writes]):
+                index = len(groups)
+                groups.append((step['operation'], directory, []))
+                latest_group[key] = index
+
+            groups[index][2].append(step)
+            for path in reads:
+                last_read[path] = max(last_read.get(path, -1), index)
+            for path in writes:
+                last_written[path] = max(last_written.get(path, -1), index)
+
+        return groups
+
+class PlanApplier():
+    """
+    Applies a ``Plan``: every step whose preconditions still hold is
+    executed, others are skipped and reported.
+    """
+
+    def __init__(self, plan):
+
+        self.plan = plan
+        """the ``Plan`` to apply"""
+
+        self.passwd = None
+        """``PasswdEditor`` if the plan changes passwd entries natively"""
+
+        if plan.passwd_file:
+            from lib.passwd import PasswdEditor
+            self.passwd = PasswdEditor(plan.passwd_file)
+
+        self.applied = 0
+        self.skipped = 0
+        self.failed = 0
+
+    @staticmethod
+    def unmet_preconditions(preconditions, directory=None, dir_fd=None):
+        """
+        Returns a list of descriptions of unmet preconditions.
+
+        With ``dir_fd`` (a file descriptor of ``directory``), paths in
+        ``directory`` are looked up relative to it.
+        """
+        unmet = []
+        for precondition in preconditions:
+            if 'user' in precondition:
+                try:
+                    user = getpwnam(precondition['user'])
+                except KeyError:
+                    unmet.append("user '%s' does not exist" %
+                                 precondition['user'])
+                    continue
+                for field, attribute in passwd_fields.items():
+                    if field in precondition and \
+                            getattr(user, attribute) != precondition[field]:
+                        unmet.append("%s of '%s' is not %r" % (
+                            field, user.pw_name, precondition[field]))
+                continue
+
+            path = precondition['path']
+            try:
+                if dir_fd is not None and dirname(path) == directory:
+                    stat_result = stat(basename(path), dir_fd=dir_fd,
+                                       follow_symlinks=False)
+                else:
+                    stat_result = stat(path, follow_symlinks=False)
+            except FileNotFoundError:
+                stat_result = None
+            exists = precondition.get('exists', True)
+            if (stat_result is not None) != exists:
+                unmet.append("'%s' %s" % (path, "does not exist" if exists
+                                          else "exists"))
+                continue
+            if stat_result is None:
+                continue
+            for field, value_of in stat_fields.items():
+                if field in precondition and \
+                        value_of(stat_result) != precondition[field]:
+                    unmet.append("%s of '%s' is not %r" % (
+                        field, path, precondition[field]))
+        return unmet
+
+    def apply_step(self, step, directory=None, dir_fd=None):
+        """
+        Applies a single step if its preconditions hold.
+
+        With ``dir_fd`` (a file descriptor of ``directory``), the step's
+        path is given relative to it.
+        """
+        unmet = self.unmet_preconditions(step['preconditions'], directory,
+                                         dir_fd)
+        if unmet:
+            log("skipping %s(%r): %s", step['operation'], step['args'],
+                '; '.join(unmet))
+            self.skipped += 1
+            return
+
+        args, kwargs = list(step['args']), dict(step['kwargs'])
+        if step['operation'] == passwd_operation:
+            function = self.passwd.set_field if self.passwd else None
+        else:
+            function = operation_function(step['operation'])
+        if dir_fd is not None:
+            args[0] = basename(args[0])
+            kwargs['dir_fd'] = dir_fd
+
+        log("executing %s(%s)", step['operation'], ', '.join(
+            repr(arg) for arg in step['args']))
+        try:
+            if function is None:
+                raise ValueError("no passwd file in plan")
+            function(*args, **kwargs)
+            self.applied += 1
+        except Exception as exception:
+            error("%s failed: %s", step['operation'], exception)
+            self.failed += 1
+
+    def apply(self):
+        """
+        Applies all steps, grouped (see ``Plan.groups``).
+
+        Groups of ``dir_fd_operations`` are done relative to a file
+        descriptor of their directory, which is opened once.
+        """
+        for operation, directory, steps in self.plan.groups():
+            debug("applying %u steps %s in '%s'",
+                  len(steps), operation, directory)
+            dir_fd = None
+            if directory and operation in dir_fd_operations:
+                try:
+                    dir_fd = os_open(directory, O_RDONLY | O_DIRECTORY)
+                except OSError as exception:
+                    debug("cannot open '%s': %s", directory, exception)
+            try:
+                for step in steps:
+                    self.apply_step(step, directory, dir_fd)
+            finally:
+                if dir_fd is not None:
+                    close(dir_fd)
+
+        if self.passwd is not None:
+            self.passwd.apply()
+
+        log("applied %u steps, skipped %u, %u failed",
+            self.applied, self.skipped, self.failed)
+        return not (self.skipped or self.failed)
@@ -0,0 +1,122 @@
+"""
+Running requests (e.g. ``stat`` calls on NFS) ahead of the loop that
+needs their results, with a bounded number of requests in flight, and
+recording their latency.
+"""
+
+from collections import deque
+from threading import Lock
+from time import perf_counter
+
+default_bounds = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                  0.025, 0.05, 0.1, 0.25, 1.0)
+"""upper bounds of the buckets of ``LatencyHistogram`` in seconds"""
+
+class LatencyHistogram():
+    """
+    Histogram of latencies, cumulative like the ones of Prometheus.
+    """
+
+    def __init__(self, bounds=default_bounds):
+
+        self.bounds = bounds
+        """upper bounds of the buckets in seconds, ascending"""
+
+        self.counts = [0] * (len(bounds) + 1)
+        """number of observations per bucket (not cumulative), the last
+        one for observations above all bounds"""
+
+        self.sum = 0.0
+        """sum of all observations in seconds"""
+
+        self.lock = Lock()
+        """requests are timed in several threads"""
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def observe(self, seconds):
+        index = 0
+        for bound in self.bounds:
+            if seconds <= bound:
+                break
+            index += 1
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += seconds
+
+    def timed(self, function, *args):
+        """
+        Returns ``function(*args)``, observing how long it took (also
+        if it raised).
+        """
+        start = perf_counter()
+        try:
+            return function(*args)
+        finally:
+            self.observe(perf_counter() - start)
+
+    def cumulative_counts(self):
+        """
+        Returns a list of tuples (upper bound or ``'+Inf'``, number of
+        observations up to it).
+        """
+        result = []
+        total = 0
+        for bound, count in zip(self.bounds + ('+Inf', ), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def as_dict(self):
+        return {
+            'buckets': [[bound, count]
+                        for bound, count in self.cumulative_counts()],
+            'count': self.count,
+            'sum': self.sum,
+        }
+
+def prefetch(items, function, in_flight, needed=None):
+    """
+    Yields tuples (item, ``function(item)``) in the order of ``items``.
+
+    ``function`` is called by a pool of threads for up to ``in_flight``
+    items ahead of the one yielded, so that the latency of the calls
+    overlaps. For items for which ``needed(item)`` is false, function is
+    not called (the result is ``None``). Exceptions of ``function`` are
+    raised when its item is due.
+    """
+    if needed is None:
+        needed = lambda item: True
+    if in_flight <= 1:
+        for item in items:
+            yield item, function(item) if needed(item) else None
+        return
+
+    # serial runs do without the thread pool (and importing it)
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(in_flight) as executor:
+        pending = deque()
+        submitted = 0
+        """number of futures in ``pending``"""
+        for item in items:
+            if needed(item):
+                if submitted >= in_flight:
+                    while True:
+                        done_item, future = pending.popleft()
+                        if future is None:
+                            yield done_item, None
+                            continue
+                        submitted -= 1
+                        yield done_item, future.result()
+                        break
+                pending.append((item, executor.submit(function, item)))
+                submitted += 1
+            elif pending:
+                pending.append((item, None))
+            else:
+                yield item, None
+        for item, future in pending:
+            yield item, None if future is None else future.result()
@@ -0,0 +1,203 @@
+"""
+Creating complete home directories in one step: populated from a
+skeleton directory and with their final mode, owner and group before
+they appear under their name.
+
+Functions in here are meant to be run in worker threads as well.
+"""
+
+from os import chown, chmod, fchown, fchmod, utime, link, symlink, \
+    readlink, mkdir, rename, close, open as os_open, strerror, fsencode, \
+    O_RDONLY, O_WRONLY, O_CREAT, O_EXCL, O_NOFOLLOW
+from os.path import join as path_join, dirname, basename, lexists
+from errno import EEXIST, ENOTEMPTY, EINVAL, ENOSYS
+from stat import S_ISDIR, S_ISREG, S_ISLNK, S_IMODE
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Lock
+
+from lib.copying import copy_file_contents
+from lib.tree import walk_tree
+
+provisioning_methods = ('copy', 'hardlink')
+"""
+How files of a skeleton get into homes: 'copy' gives every home its own
+files (shared on disk where the file system supports copy-on-write
+clones, see ``lib.copying.copy_file_contents``), 'hardlink' links all
+homes to the skeleton's files (which keep the skeleton's owner).
+"""
+
+skeletons = {}
+"""Dictionary of {skeleton path: list of ``SkeletonEntry``'s}"""
+
+skeletons_lock = Lock()
+
+AT_FDCWD = -100
+RENAME_NOREPLACE = 1
+
+libc = None
+"""the C library, loaded for ``rename_noreplace``"""
+
+class SkeletonEntry():
+    """
+    An entry of a skeleton directory, as listed by ``skeleton_entries``.
+    """
+
+    __slots__ = ('relative_path', 'stat', 'target', 'first_link')
+
+    def __init__(self, relative_path, stat_result, target=None,
+                 first_link=None):
+
+        self.relative_path = relative_path
+        """path relative to the skeleton"""
+
+        self.stat = stat_result
+        """``stat`` result of the entry (not following symlinks)"""
+
+        self.target = target
+        """target of a symlink"""
+
+        self.first_link = first_link
+        """relative path of an earlier entry with the same inode"""
+
+def skeleton_entries(skeleton_path, refresh=False):
+    """
+    Returns the list of ``SkeletonEntry``'s of the skeleton directory
+    (directories before their contents), listed only once unless
+    ``refresh`` is set.
+    """
+    with skeletons_lock:
+        if not refresh and skeleton_path in skeletons:
+            return skeletons[skeleton_path]
+        entries = []
+        inodes = {}
+        """Dictionary of {(device, inode): relative path}"""
+        for tree_entry in walk_tree(skeleton_path):
+            stat_result = tree_entry.stat
+            entry = SkeletonEntry(tree_entry.relative_path, stat_result)
+            if S_ISLNK(stat_result.st_mode):
+                entry.target = readlink(tree_entry.name,
+                                        dir_fd=tree_entry.dir_fd)
+            elif S_ISREG(stat_result.st_mode) and stat_result.st_nlink > 1:
+                key = (stat_result.st_dev, stat_result.st_ino)
+                entry.first_link = inodes.get(key, None)
+                inodes.setdefault(key, entry.relative_path)
+            entries.append(entry)
+        skeletons[skeleton_path] = entries
+        return entries
+
+def copy_into(src_path, dst_path, stat_result, uid, gid):
+    """
+    Copies the regular file ``src_path`` to the new file ``dst_path``
+    owned by ``uid`` and ``gid``. Returns the number of bytes copied.
+    """
+    src_fd = os_open(src_path, O_RDONLY | O_NOFOLLOW)
+    try:
+        dst_fd = os_open(dst_path, O_WRONLY | O_CREAT | O_EXCL | O_NOFOLLOW,
+                         0o600)
+        try:
+            copied = copy_file_contents(src_fd, dst_fd, stat_result.st_size)
+            fchown(dst_fd, uid, gid)
+            # after chown, which might clear set-user/group-ID bits
+            fchmod(dst_fd, S_IMODE(stat_result.st_mode))
+            utime(dst_fd, ns=(stat_result.st_atime_ns,
+                              stat_result.st_mtime_ns))
+        finally:
+            close(dst_fd)
+    finally:
+        close(src_fd)
+    return copied
+
+def populate(path, skeleton_path, uid, gid, method='copy'):
+    """
+    Fills the (new, empty) directory ``path`` with the contents of the
+    skeleton, owned by ``uid`` and ``gid``. Files that are hard links of
+    each other in the skeleton are copied once and linked.
+
+    Returns the number of bytes copied.
+    """
+    if method not in provisioning_methods:
+        raise ValueError("Unknown provisioning method '%s'" % method)
+    copied = 0
+    for entry in skeleton_entries(skeleton_path):
+        src_path = path_join(skeleton_path, entry.relative_path)
+        dst_path = path_join(path, entry.relative_path)
+        mode = entry.stat.st_mode
+        if S_ISDIR(mode):
+            mkdir(dst_path, 0o700)
+            chown(dst_path, uid, gid)
+            chmod(dst_path, S_IMODE(mode))
+        elif S_ISLNK(mode):
+            symlink(entry.target, dst_path)
+            chown(dst_path, uid, gid, follow_symlinks=False)
+        elif not S_ISREG(mode):
+            continue
+        elif method == 'hardlink':
+            link(src_path, dst_path)
+        elif entry.first_link is not None:
+            link(path_join(path, entry.first_link), dst_path)
+        else:
+            copied += copy_into(src_path, dst_path, entry.stat, uid, gid)
+    return copied
+
+def rename_noreplace(src_path, dst_path):
+    """
+    Renames ``src_path`` to ``dst_path`` if nothing exists there, raises
+    ``FileExistsError`` otherwise.
+
+    Uses ``renameat2(2)`` with ``RENAME_NOREPLACE``, which checks and
+    renames atomically. Where the C library or the file system does not
+    support it, ``dst_path`` is checked right before a plain rename.
+    """
+    # only needed when provisioning, like in ``lib.inotify``
+    from ctypes import CDLL, get_errno
+    from ctypes.util import find_library
+
+    global libc
+    if libc is None:
+        libc = CDLL(find_library('c') or 'libc.so.6', use_errno=True)
+    renameat2 = getattr(libc, 'renameat2', None)
+    if renameat2 is not None:
+        if renameat2(AT_FDCWD, fsencode(src_path), AT_FDCWD,
+                     fsencode(dst_path), RENAME_NOREPLACE) == 0:
+            return
+        errno = get_errno()
+        if errno not in (EINVAL, ENOSYS):
+            raise OSError(errno, strerror(errno), dst_path)
+
+    if lexists(dst_path):
+        raise FileExistsError(EEXIST, strerror(EEXIST), dst_path)
+    try:
+        rename(src_path, dst_path)
+    except OSError as exception:
+        if exception.errno in (EEXIST, ENOTEMPTY):
+            raise FileExistsError(EEXIST, strerror(EEXIST), dst_path)
+        raise
+
+def provision_home(path, mode, uid, gid, skeleton_path=None,
+                   method='copy'):
+    """
+    Creates the home directory ``path`` with ``mode``, ``uid`` and
+    ``gid``, populated from ``skeleton_path`` (if any, see
+    ``populate``).
+
+    The home is built under a temporary name next to ``path`` and
+    renamed when complete, so it never appears empty or half populated.
+    If anything (even an empty directory) appeared at ``path`` meanwhile,
+    ``FileExistsError`` is raised and nothing is replaced (see
+    ``rename_noreplace``).
+
+    Returns the number of bytes copied.
+    """
+    temp_path = mkdtemp(dir=dirname(path), prefix='.%s.' % basename(path))
+    try:
+        copied = 0
+        if skeleton_path:
+            copied = populate(temp_path, skeleton_path, uid, gid, method)
+        chown(temp_path, uid, gid)
+        chmod(temp_path, mode)
+        rename_noreplace(temp_path, path)
+    except BaseException:
+        rmtree(temp_path, ignore_errors=True)
+        raise
+    return copied
@@ -0,0 +1,232 @@
+"""
+Registry of the available checks: which class in which module of
+``lib.checks`` handles which configuration section.
+
+The registry is generated by parsing (not importing) the modules and
+cached in ``lib/checks/__pycache__/registry.json``, so that runs only
+import the checks that are configured.
+"""
+
+from os import listdir, stat, makedirs
+from os.path import join as path_join, dirname
+from importlib import import_module
+from json import dump as dump_json, load as load_json
+
+from lib.util import debug, atomic_write
+
+checks_path = path_join(dirname(__file__), 'checks')
+"""directory of the package ``lib.checks``"""
+
+default_order = 1000
+"""``order`` of checks which do not define one (see ``AbstractCheckBase``)"""
+
+cache_version = 1
+"""version of the format of the cache"""
+
+class CheckEntry():
+    """
+    A check in the registry.
+    """
+
+    def __init__(self, config_section, module_name, class_name, order):
+
+        self.config_section = config_section
+        """configuration section of the check"""
+
+        self.module_name = module_name
+        """module of the check, e.g. ``lib.checks.home_owner``"""
+
+        self.class_name = class_name
+        """name of the check's class"""
+
+        self.order = order
+        """see ``AbstractCheckBase.order``"""
+
+    def as_dict(self):
+        return {
+            'config_section': self.config_section,
+            'module': self.module_name,
+            'class': self.class_name,
+            'order': self.order,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['config_section'], data['module'], data['class'],
+                   data['order'])
+
+    def load(self):
+        """
+        Imports the check's module and returns the class.
+        """
+        return getattr(import_module(self.module_name), self.class_name)
+
+class CheckRegistry():
+    """
+    Finds checks by parsing the modules of a package.
+
+    A check is a class not starting with "Abstract" whose base is
+    either one of the abstract classes of ``lib.checks`` or another
+    check, with ``config_section`` (and ``order``, if any) assigned
+    literally in its body or inherited from its base check.
+    """
+
+    def __init__(self, package_path=checks_path, package_name='lib.checks'):
+
+        self.package_path = package_path
+        """directory of the package"""
+
+        self.package_name = package_name
+        """name of the package"""
+
+        self.cache_path = path_join(package_path, '__pycache__',
+                                    'registry.json')
+        """where the registry is cached"""
+
+        self.entries = None
+        """list of ``CheckEntry``'s, sorted by order (after ``load``)"""
+
+    def module_stats(self):
+        """
+        Returns a dictionary of {module name: [mtime in ns, size]} of
+        all modules of the package (except the package itself).
+        """
+        stats = {}
+        for file_name in listdir(self.package_path):
+            if not file_name.endswith('.py') or file_name == '__init__.py':
+                continue
+            stat_result = stat(path_join(self.package_path, file_name))
+            stats[file_name[:-3]] = [stat_result.st_mtime_ns,
+                                     stat_result.st_size]
+        return stats
+
+    def load(self):
+        """
+        Loads the registry from the cache or, if any module changed,
+        by parsing all modules (and updates the cache).
+        """
+        stats = self.module_stats()
+        try:
+            with open(self.cache_path, 'r') as cache_file:
+                cached = load_json(cache_file)
+            if cached['version'] == cache_version and \
+                    cached['modules'] == stats:
+                self.entries = [CheckEntry.from_dict(data)
+                                for data in cached['checks']]
+                return self
+        except (OSError, ValueError, KeyError):
+            pass
+
+        debug("generating registry of checks")
+        self.entries = self.scan(sorted(stats))
+        self.save(stats)
+        return self
+
+    def save(self, stats):
+        """
+        Writes the registry to the cache, if possible.
+        """
+        try:
+            makedirs(dirname(self.cache_path), exist_ok=True)
+            with atomic_write(self.cache_path) as cache_file:
+                dump_json({
+                    'version': cache_version,
+                    'modules': stats,
+                    'checks': [entry.as_dict() for entry in self.entries],
+                }, cache_file, indent=1)
+        except OSError as exception:
+            debug("cannot cache registry of checks: %s", exception)
+
+    def scan(self, module_names):
+        """
+        Returns the ``CheckEntry``'s of all checks in the modules,
+        sorted by order (and class name).
+        """
+        # only needed if a module changed, importing it takes longer than
+        # loading the cached registry
+        import ast
+
+        classes = {}
+        """Dictionary of {class name: (module name, base names, body
+        assignments)}"""
+        for module_name in module_names:
+            with open(path_join(self.package_path, module_name + '.py'),
+                      'rb') as module_file:
+                tree = ast.parse(module_file.read())
+            for node in tree.body:
+                if isinstance(node, ast.ClassDef):
+                    classes[node.name] = (
+                        module_name,
+                        [base.id for base in node.bases
+                         if isinstance(base, ast.Name)],
+                        self.literal_assignments(node),
+                    )
+
+        attributes = {}
+        """Dictionary of {class name: attributes} of the checks found so
+        far, abstract bases have none"""
+
+        def check_attributes(class_name):
+            if class_name.startswith('Abstract'):
+                return {}
+            if class_name in attributes or class_name not in classes:
+                return attributes.get(class_name, None)
+            _, base_names, assignments = classes[class_name]
+            attributes[class_name] = None
+            for base_name in base_names:
+                inherited = check_attributes(base_name)
+                if inherited is not None:
+                    attributes[class_name] = dict(inherited, **assignments)
+                    break
+            return attributes[class_name]
+
+        entries = []
+        for class_name, (module_name, _, _) in sorted(classes.items()):
+            found = check_attributes(class_name)
+            if found is None or class_name.startswith('Abstract'):
+                continue
+            if not isinstance(found.get('config_section', None), str):
+                debug("%s has no literal config_section, ignoring it",
+                      class_name)
+                continue
+            entries.append(CheckEntry(
+                found['config_section'],
+                '%s.%s' % (self.package_name, module_name),
+                class_name,
+                found.get('order', default_order),
+            ))
+        entries.sort(key=lambda entry: (entry.order, entry.class_name))
+        return entries
+
+    @staticmethod
+    def literal_assignments(class_node):
+        """
+        Returns a dictionary of {name: value} of the assignments of
+        literals in the body of a class.
+        """
+        import ast
+
+        assignments = {}
+        for node in class_node.body:
+            if not isinstance(node, ast.Assign) or len(node.targets) != 1:
+                continue
+            target = node.targets[0]
+            if not isinstance(target, ast.Name):
+                continue
+            try:
+                assignments[target.id] = ast.literal_eval(node.value)
+            except (ValueError, TypeError):
+                continue
+        return assignments
+
+    def entries_for(self, sections=None):
+        """
+        Returns the entries of the checks for ``sections`` (all if
+        ``None``), sorted by order.
+        """
+        if self.entries is None:
+            self.load()
+        if sections is None:
+            return list(self.entries)
+        return [entry for entry in self.entries
+                if entry.config_section in sections]
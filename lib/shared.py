@@ -0,0 +1,61 @@
+"""
+Users, groups and snapshots of homes shared by the runs of several
+configurations in one process.
+"""
+
+from lib.util import debug
+from lib.homes import HomesSnapshot
+
+class SharedResources():
+    """
+    Loads users and groups and lists directories of homes once for all
+    ``ChecksRunner``'s using it, e.g. one per group of users.
+
+    Users and groups are shared per source (the name service or an NSS
+    snapshot file), snapshots of homes per base directory. Everything
+    configuration specific (selecting users, ``minimum_users_count``,
+    ``simulate``) stays with the runners.
+    """
+
+    def __init__(self):
+
+        self.expanders = {}
+        """
+        Dictionary of {NSS snapshot path or ``None`` for the name
+        service: ``TemplateExpander``}, the expanders hold the
+        ``NssIndex`` and the expansions of templates
+        """
+
+        self.homes = {}
+        """Dictionary of {base path: ``HomesSnapshot``}"""
+
+    def expander(self, source):
+        """
+        Returns the ``TemplateExpander`` (and so the ``NssIndex``) of
+        ``source``, ``None`` if not loaded yet.
+        """
+        return self.expanders.get(source, None)
+
+    def add_expander(self, source, expander):
+        self.expanders[source] = expander
+
+    def forget_accounts(self):
+        """
+        Drops all users and groups, e.g. after passwd entries changed.
+        """
+        debug("dropping shared users and groups")
+        self.expanders = {}
+
+    def homes_snapshot(self, home_path, in_flight=1):
+        """
+        Returns the loaded ``HomesSnapshot`` of the base directory of
+        the (unexpanded) ``home_path``, listing the directory only if
+        no other runner did (with ``in_flight`` of the first one).
+        """
+        homes = HomesSnapshot.for_home_path(home_path, in_flight)
+        try:
+            return self.homes[homes.base_path]
+        except KeyError:
+            homes.load()
+            self.homes[homes.base_path] = homes
+            return homes
@@ -0,0 +1,110 @@
+"""
+State of the last run, so that the next run only needs to check what
+changed since (incremental mode).
+"""
+
+from os.path import exists
+from time import time
+from hashlib import sha1
+from json import load as load_json, dump as dump_json
+
+from lib.util import debug, atomic_write
+
+class RunState():
+    """
+    Journal of the inputs of a run: a digest of the configuration and,
+    for every user and home that was found (or made) correct, a digest
+    of the passwd and group entry or a fingerprint of the home's
+    ``stat``, respectively.
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+        """path to the file the state is stored in"""
+
+        self.config_digest = None
+        """digest of the configuration of the run"""
+
+        self.full_sweep_time = 0
+        """when all users and directories have been checked the last time"""
+
+        self.users = {}
+        """Dictionary of {login name: digest}"""
+
+        self.homes = {}
+        """Dictionary of {path: fingerprint}"""
+
+    def load(self):
+        """
+        Loads the state from ``path``, if the file exists.
+        """
+        if not exists(self.path):
+            debug("no state in '%s' yet", self.path)
+            return
+        with open(self.path, 'r') as state_file:
+            state = load_json(state_file)
+        self.config_digest = state['config_digest']
+        self.full_sweep_time = state['full_sweep_time']
+        self.users = state['users']
+        self.homes = state['homes']
+
+    def save(self):
+        """
+        Atomically writes the state to ``path``.
+        """
+        with atomic_write(self.path) as state_file:
+            dump_json({
+                'config_digest': self.config_digest,
+                'full_sweep_time': self.full_sweep_time,
+                'users': self.users,
+                'homes': self.homes,
+            }, state_file)
+        debug("saved state of %u users and %u homes",
+              len(self.users), len(self.homes))
+
+    def needs_full_sweep(self, config_digest, interval):
+        """
+        Returns whether everything has to be checked, because the
+        configuration changed or the last full sweep is older than
+        ``interval`` seconds.
+        """
+        if config_digest != self.config_digest:
+            debug("configuration changed since last run")
+            return True
+        return time() - self.full_sweep_time > interval
+
+    @staticmethod
+    def config_digest_for(configs):
+        """
+        Returns the digest of a ``ConfigDict``.
+        """
+        return sha1(repr(sorted(
+            (section, sorted(options.items()))
+            for section, options in configs.items()
+        )).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def user_digest(user, group_name):
+        """
+        Returns the digest of a users passwd entry and primary group.
+        """
+        return sha1(repr(
+            (tuple(user), group_name)
+        ).encode('utf-8', 'surrogateescape')).hexdigest()
+
+    @staticmethod
+    def home_fingerprint(stat_result):
+        """
+        Returns the fingerprint of a home, ``None`` if it does not exist.
+        """
+        if stat_result is None:
+            return None
+        return [
+            stat_result.st_mode,
+            stat_result.st_uid,
+            stat_result.st_gid,
+            stat_result.st_ino,
+            stat_result.st_mtime_ns,
+            stat_result.st_ctime_ns,
+        ]
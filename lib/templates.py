@@ -0,0 +1,116 @@
+"""
+Strings with variables ($u: login name, $h: users home,
+$g: users primary group name) as used in the configuration.
+"""
+
+from re import compile as compile_regex
+
+from lib.util import debug
+
+class Template():
+    """
+    A string with variables, parsed once into literal parts and
+    variables.
+    """
+
+    variable_regex = compile_regex(r'(\$[uhg])')
+    """matches all variables, used to split strings"""
+
+    def __init__(self, string):
+
+        self.string = string
+        """the unexpanded string"""
+
+        self.parts = tuple(
+            part for part in self.variable_regex.split(string) if part
+        )
+        """literal strings and variables, in order"""
+
+        self.needs_group = '$g' in self.parts
+        """whether the group name is required for expansion"""
+
+        self.has_variables = any(
+            self.variable_regex.fullmatch(part) for part in self.parts
+        )
+        """whether the string contains variables at all"""
+
+    def expand(self, user, group_name=None):
+        """
+        Returns the string with all variables expanded for ``user``.
+
+        ``group_name`` is the name of the users primary group and only
+        required if ``needs_group``.
+        """
+        values = {
+            '$u': user.pw_name,
+            '$h': user.pw_dir,
+            '$g': group_name,
+        }
+        return ''.join(values.get(part, part) for part in self.parts)
+
+class TemplateExpander():
+    """
+    Compiles strings to ``Template``'s and memoizes their expansions
+    per user for the whole run (only of strings with variables).
+    """
+
+    def __init__(self, nss):
+
+        self.nss = nss
+        """``NssIndex`` used to look up group names"""
+
+        self.templates = {}
+        """Dictionary of {string: Template}"""
+
+        self.expansions = {}
+        """Dictionary of {(string, user): expanded string} of strings
+        with variables"""
+
+    def compile(self, string):
+        """
+        Returns the ``Template`` for ``string``.
+        """
+        try:
+            return self.templates[string]
+        except KeyError:
+            template = Template(string)
+            self.templates[string] = template
+            return template
+
+    def compile_options(self, configs):
+        """
+        Compiles all options in ``configs`` (a ``ConfigDict``) which
+        contain variables.
+        """
+        for options in configs.values():
+            for value in options.values():
+                if '$' in value:
+                    self.compile(value)
+        debug("compiled %u templates", len(self.templates))
+
+    def expand(self, string, user, memoize=True):
+        """
+        Expands variables in ``string`` according to ``user``.
+
+        Unless ``memoize`` is false, the result is remembered. Strings
+        without variables are returned as they are (and not remembered,
+        file lists contain lots of them).
+        """
+        if '$' not in string:
+            return string
+        key = (string, user)
+        try:
+            return self.expansions[key]
+        except KeyError:
+            pass
+
+        template = self.compile(string)
+        if not template.has_variables:
+            return string
+        group_name = None
+        if template.needs_group:
+            group_name = self.nss.getgrgid(user.pw_gid).gr_name
+        expanded = template.expand(user, group_name)
+        if memoize:
+            self.expansions[key] = expanded
+        return expanded
@@ -0,0 +1,129 @@
+"""
+Walking the trees below homes without following symlinks: every
+directory is opened relative to the file descriptor of its parent and
+read once, every entry is ``stat``'ed once (relative to the descriptor
+of its directory).
+"""
+
+from os import open as os_open, close, scandir, fstat, chmod, \
+    O_RDONLY, O_DIRECTORY, O_NOFOLLOW, O_PATH
+from os.path import join as path_join
+from stat import S_ISDIR, S_ISLNK
+from fnmatch import translate
+from re import compile as compile_regex
+
+from lib.util import debug
+
+class TreeEntry():
+    """
+    An entry below the top of a tree, as yielded by ``walk_tree``.
+    """
+
+    __slots__ = ('dir_fd', 'name', 'path', 'relative_path', 'stat')
+
+    def __init__(self, dir_fd, name, path, relative_path, stat_result):
+
+        self.dir_fd = dir_fd
+        """file descriptor of the entry's directory (valid while the
+        entry is being handled)"""
+
+        self.name = name
+        """name of the entry in its directory"""
+
+        self.path = path
+        """full path, for messages and plans only"""
+
+        self.relative_path = relative_path
+        """path relative to the top of the tree"""
+
+        self.stat = stat_result
+        """``stat`` result of the entry itself (not following symlinks)"""
+
+exclusion_regexes = {}
+"""Dictionary of {patterns: compiled regex} (see ``exclusion_regex``)"""
+
+def exclusion_regex(patterns):
+    """
+    Returns a regular expression matching relative paths that match any
+    of the whitespace separated glob ``patterns``, ``None`` if there are
+    none.
+    """
+    try:
+        return exclusion_regexes[patterns]
+    except KeyError:
+        pass
+    parts = ['(?:%s)' % translate(pattern) for pattern in patterns.split()]
+    regex = compile_regex('|'.join(parts)) if parts else None
+    exclusion_regexes[patterns] = regex
+    return regex
+
+def walk_tree(top, excluded=None):
+    """
+    Yields ``TreeEntry``'s of everything below the directory ``top``,
+    depth first, directories before their contents.
+
+    Entries whose relative path matches ``excluded`` (see
+    ``exclusion_regex``) are skipped, excluded directories including
+    their contents. Symlinks are yielded but never followed. At most
+    one file descriptor per level of the tree is open at a time.
+    """
+    open_flags = O_RDONLY | O_DIRECTORY | O_NOFOLLOW
+    top_fd = os_open(top, open_flags)
+    try:
+        with scandir(top_fd) as entries:
+            top_entries = list(entries)
+    except OSError:
+        close(top_fd)
+        raise
+    stack = [(top_fd, top, '', iter(top_entries))]
+    try:
+        while stack:
+            dir_fd, dir_path, dir_relative_path, entries = stack[-1]
+            entry = next(entries, None)
+            if entry is None:
+                stack.pop()
+                close(dir_fd)
+                continue
+
+            relative_path = dir_relative_path + entry.name
+            if excluded is not None and excluded.match(relative_path):
+                continue
+            try:
+                stat_result = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            path = path_join(dir_path, entry.name)
+            yield TreeEntry(dir_fd, entry.name, path, relative_path,
+                            stat_result)
+
+            if not S_ISDIR(stat_result.st_mode):
+                continue
+            try:
+                fd = os_open(entry.name, open_flags, dir_fd=dir_fd)
+            except OSError as exception:
+                debug("cannot open '%s': %s", path, exception)
+                continue
+            try:
+                with scandir(fd) as child_entries:
+                    stack.append((fd, path, relative_path + '/',
+                                  iter(list(child_entries))))
+            except OSError as exception:
+                close(fd)
+                debug("cannot list '%s': %s", path, exception)
+    finally:
+        for dir_fd, _, _, _ in stack:
+            close(dir_fd)
+
+def chmod_nofollow(path, mode, dir_fd=None):
+    """
+    Like ``os.chmod`` but never follows a symlink at ``path`` (which
+    Linux does not support natively): the entry is opened with
+    ``O_PATH`` and changed via its descriptor in ``/proc``.
+    """
+    fd = os_open(path, O_PATH | O_NOFOLLOW, dir_fd=dir_fd)
+    try:
+        if S_ISLNK(fstat(fd).st_mode):
+            raise OSError("'%s' is a symlink" % path)
+        chmod('/proc/self/fd/%u' % fd, mode)
+    finally:
+        close(fd)
@@ -0,0 +1,208 @@
+"""
+Disk usage of trees (like ``du``): apparent and allocated size, number
+of inodes and newest modification time.
+
+What a directory contains directly (except its subdirectories) can be
+cached per directory (see ``UsageCache``), so that unchanged directories
+are neither listed nor are their files ``stat``'ed again.
+"""
+
+from os import scandir, lstat
+from os.path import join as path_join, exists
+from stat import S_ISDIR
+from time import time
+from json import load as load_json, dump as dump_json
+
+from lib.util import debug, atomic_write
+
+size_units = ('', 'K', 'M', 'G', 'T', 'P')
+
+def format_size(size):
+    """
+    Returns a human readable size, e.g. ``1.5G``.
+    """
+    unit = 0
+    while size >= 1024 and unit < len(size_units) - 1:
+        size /= 1024
+        unit += 1
+    if unit == 0:
+        return '%u' % size
+    return '%.1f%s' % (size, size_units[unit])
+
+class TreeUsage():
+    """
+    Totals of a tree, as returned by ``tree_usage``.
+    """
+
+    __slots__ = ('apparent', 'allocated', 'inodes', 'newest_mtime',
+                 'directories_read', 'directories_cached')
+
+    def __init__(self):
+
+        self.apparent = 0
+        """sum of the sizes in bytes"""
+
+        self.allocated = 0
+        """bytes allocated on disk (from the number of blocks)"""
+
+        self.inodes = 0
+        """number of entries, files with several links count once"""
+
+        self.newest_mtime = 0
+        """newest modification time of all entries (seconds)"""
+
+        self.directories_read = 0
+        """number of directories listed"""
+
+        self.directories_cached = 0
+        """number of directories taken from the cache"""
+
+    def add(self, apparent, allocated, inodes, newest_mtime_ns):
+        self.apparent += apparent
+        self.allocated += allocated
+        self.inodes += inodes
+        self.newest_mtime = max(self.newest_mtime, newest_mtime_ns / 1e9)
+
+def read_directory(path):
+    """
+    Lists the directory ``path`` and ``stat``'s its entries.
+
+    Returns a tuple (record, dictionary of {subdirectory name: ``stat``
+    result}), where ``record`` is a list [apparent size, allocated
+    size, number of inodes, newest modification time in ns, list of the
+    names of the subdirectories, list of [device, inode, apparent size,
+    allocated size, modification time in ns] of files with several
+    links] of everything but the subdirectories.
+    """
+    apparent = allocated = inodes = newest = 0
+    subdirectories = {}
+    linked = []
+    with scandir(path) as entries:
+        for entry in entries:
+            try:
+                stat_result = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            if S_ISDIR(stat_result.st_mode):
+                subdirectories[entry.name] = stat_result
+            elif stat_result.st_nlink > 1:
+                linked.append([stat_result.st_dev, stat_result.st_ino,
+                               stat_result.st_size,
+                               stat_result.st_blocks * 512,
+                               stat_result.st_mtime_ns])
+            else:
+                apparent += stat_result.st_size
+                allocated += stat_result.st_blocks * 512
+                inodes += 1
+                newest = max(newest, stat_result.st_mtime_ns)
+    record = [apparent, allocated, inodes, newest, sorted(subdirectories),
+              linked]
+    return record, subdirectories
+
+def tree_usage(top, cached=None, max_age=None, settle_seconds=2):
+    """
+    Returns a tuple (``TreeUsage`` of the tree below and including the
+    directory ``top``, cache of the tree) without following symlinks.
+
+    ``cached`` is a previously returned cache of the tree (see
+    ``UsageCache``). Directories whose inode and change time are the
+    ones of the cache (and whose record is younger than ``max_age``
+    seconds) are not read again. Unlike the modification time, the
+    change time cannot be set by users, but neither changes if files in
+    the directory grow or shrink: sizes of such files are updated once
+    the record expired. Directories changed less than
+    ``settle_seconds`` ago are not cached at all, they may change again
+    within the resolution of the timestamps.
+    """
+    now = time()
+    usage = TreeUsage()
+    cache = {}
+    linked = {}
+    """Dictionary of {(device, inode): (apparent size, allocated size,
+    modification time in ns)} of files with several links"""
+
+    stack = [('', top, lstat(top))]
+    while stack:
+        relative_path, path, stat_result = stack.pop()
+        usage.add(stat_result.st_size, stat_result.st_blocks * 512, 1,
+                  stat_result.st_mtime_ns)
+
+        subdirectories = None
+        entry = None if cached is None else cached.get(relative_path, None)
+        if entry is not None and \
+                entry[0] == stat_result.st_ino and \
+                entry[1] == stat_result.st_ctime_ns and \
+                (max_age is None or now - entry[2] < max_age):
+            usage.directories_cached += 1
+            record = entry[3:]
+        else:
+            try:
+                record, subdirectories = read_directory(path)
+            except OSError as exception:
+                debug("cannot list '%s': %s", path, exception)
+                continue
+            usage.directories_read += 1
+            entry = [stat_result.st_ino, stat_result.st_ctime_ns, now] + \
+                record
+        if stat_result.st_ctime_ns / 1e9 < now - settle_seconds:
+            cache[relative_path] = entry
+
+        apparent, allocated, inodes, newest, names, files = record
+        usage.add(apparent, allocated, inodes, newest)
+        for device, inode, *totals in files:
+            linked[(device, inode)] = totals
+
+        for name in reversed(names):
+            sub_path = path_join(path, name)
+            if subdirectories is not None:
+                sub_stat = subdirectories[name]
+            else:
+                try:
+                    sub_stat = lstat(sub_path)
+                except FileNotFoundError:
+                    continue
+                if not S_ISDIR(sub_stat.st_mode):
+                    continue
+            stack.append((relative_path + '/' + name if relative_path
+                          else name, sub_path, sub_stat))
+
+    for apparent, allocated, mtime_ns in linked.values():
+        usage.add(apparent, allocated, 1, mtime_ns)
+    return usage, cache
+
+class UsageCache():
+    """
+    Cache of the disk usage of homes, stored as JSON.
+
+    For every home, the cache holds a dictionary of {path relative to
+    the home (empty for the home itself): entry}, where ``entry`` is a
+    list [inode, change time in ns, time the directory was read] plus
+    the record returned by ``read_directory``.
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+        """path to the file the cache is stored in"""
+
+        self.homes = {}
+        """Dictionary of {home: cache of the tree} (see ``tree_usage``)"""
+
+    def load(self):
+        """
+        Loads the cache from ``path``, if the file exists.
+        """
+        if not exists(self.path):
+            debug("no disk usage cached in '%s' yet", self.path)
+            return
+        with open(self.path, 'r') as cache_file:
+            self.homes = load_json(cache_file)
+        debug("loaded disk usage of %u homes", len(self.homes))
+
+    def save(self):
+        """
+        Atomically writes the cache to ``path``.
+        """
+        with atomic_write(self.path) as cache_file:
+            dump_json(self.homes, cache_file)
+        debug("saved disk usage of %u homes", len(self.homes))
@@ -1,24 +1,271 @@
 """
 Module for everything that does not fit into one of the other modules.
+
+Output is leveled: ``debug``, ``log`` (info), ``warning`` and ``error``.
+Messages are formatted lazily (``debug("found %u users", count)``), i.e.
+only if their level is enabled. Levels can be set for all output and per
+channel (see ``log_channel``, every check has its own channel).
 """
 
-from inspect import stack
+import sys
+from sys import _getframe
+from os import register_at_fork, fchmod, fsync, rename, unlink, close, \
+    open as os_open, O_RDONLY, O_DIRECTORY
+from os.path import dirname, basename
+from atexit import register as register_at_exit
+from threading import local, Lock
+from contextlib import contextmanager
 
 COLOR_STD = '\033[0m'
 COLOR_FAIL = '\033[31m'
 COLOR_LIGHT = '\033[33m'
 
-def debug(msg):
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+level_names = {
+    'debug': DEBUG,
+    'info': INFO,
+    'warning': WARNING,
+    'error': ERROR,
+}
+"""Dictionary of {name in configuration: level}"""
+
+_initial_level = DEBUG if __debug__ else INFO
+"""explicit call of 'python3' turns on debug"""
+
+_level = _initial_level
+"""level of all channels without a level of their own"""
+
+_channel_levels = {}
+"""Dictionary of {channel name: level}"""
+
+class _OutputState(local):
+    """
+    Thread local state of the output.
+    """
+
+    lines = None
+    """list of lines while capturing output, ``None`` otherwise"""
+
+    channel = None
+    """name of the current channel (see ``log_channel``)"""
+
+    level = None
+    """level of the current channel, ``None`` for the default"""
+
+_output = _OutputState()
+
+class BufferedWriter():
+    """
+    Collects lines and writes them to ``sys.stdout`` in chunks (every
+    ``max_lines`` lines, on ``flush`` and at exit), or line by line if
+    ``sys.stdout`` is a terminal.
+    """
+
+    def __init__(self, max_lines=512):
+
+        self.max_lines = max_lines
+        """number of lines collected before writing them"""
+
+        self.lines = []
+        """lines not written yet"""
+
+        self.lock = Lock()
+        """lines are written from several threads"""
+
+        self.interactive = None
+        """whether ``sys.stdout`` is a terminal (set on first write)"""
+
+    def write_line(self, line):
+        with self.lock:
+            self.lines.append(line)
+            if self.interactive is None:
+                self.interactive = sys.stdout.isatty()
+            if self.interactive or len(self.lines) >= self.max_lines:
+                self._write()
+
+    def flush(self):
+        with self.lock:
+            self._write()
+
+    def discard(self):
+        """
+        Drops collected lines (in forked children, where the parent
+        writes them).
+        """
+        self.lines = []
+        self.lock = Lock()
+
+    def _write(self):
+        if not self.lines:
+            return
+        lines, self.lines = self.lines, []
+        sys.stdout.write('\n'.join(lines) + '\n')
+        sys.stdout.flush()
+
+_writer = BufferedWriter()
+register_at_exit(_writer.flush)
+register_at_fork(before=_writer.flush, after_in_child=_writer.discard)
+
+def flush_output():
+    """
+    Writes all collected output, e.g. before starting a process which
+    writes to the same output or before waiting a long time.
+    """
+    _writer.flush()
+
+def _print(line):
+    """
+    Writes or, if capturing in this thread, collects a line of output.
+    """
+    lines = _output.lines
+    if lines is None:
+        _writer.write_line(line)
+    else:
+        lines.append(line)
+
+def set_level(level, channel=None):
     """
-    helper method to honor __debug__ for debug printing
+    Sets the level (``DEBUG``, ... or its name in ``level_names``) of
+    ``channel`` or, if ``None``, of all channels without a level.
     """
-    if __debug__:
-        depth = len(stack()) - 3
-        print(' '*depth, msg)
+    global _level
+    if isinstance(level, str):
+        try:
+            level = level_names[level.lower()]
+        except KeyError:
+            raise ValueError("Unknown log level '%s'." % level)
+    if channel is None:
+        _level = level
+    else:
+        _channel_levels[channel] = level
 
-def log(msg):
+def reset_levels():
+    """
+    Restores the initial level and drops the levels of all channels.
+    """
+    global _level
+    _level = _initial_level
+    _channel_levels.clear()
+
+def is_enabled(level):
+    """
+    Returns whether output of ``level`` is enabled in the current
+    channel, to avoid preparing arguments for disabled output.
+    """
+    return (_output.level or _level) <= level
+
+def set_log_channel(name):
+    """
+    Output in the calling thread goes to channel ``name`` from now on
+    (``None`` for no channel), e.g. as initializer of worker threads.
+    """
+    _output.channel = name
+    _output.level = _channel_levels.get(name, None)
+
+@contextmanager
+def log_channel(name):
+    """
+    Context manager, output in the calling thread goes to channel
+    ``name`` while active.
+    """
+    previous_channel, previous_level = _output.channel, _output.level
+    set_log_channel(name)
+    try:
+        yield
+    finally:
+        _output.channel, _output.level = previous_channel, previous_level
+
+def call_capturing_output(function, *args, **kwargs):
+    """
+    Calls ``function`` and captures everything it would print via
+    ``debug`` and ``log`` in the calling thread.
+
+    Returns a tuple (result, exception, lines) so that callers can
+    replay the output (see ``replay_output``) in a deterministic order,
+    e.g. when calling from a thread pool.
+    """
+    _output.lines = []
+    try:
+        return function(*args, **kwargs), None, _output.lines
+    except Exception as exception:
+        return None, exception, _output.lines
+    finally:
+        _output.lines = None
+
+def replay_output(lines):
+    """
+    Prints lines as captured by ``call_capturing_output``.
+    """
+    for line in lines:
+        _print(line)
+
+def debug(msg, *args):
+    """
+    Prints ``msg % args`` if debug output is enabled, indented by the
+    depth of the stack.
+    """
+    if (_output.level or _level) > DEBUG:
+        return
+    if args:
+        msg = msg % args
+    depth = -2
+    frame = _getframe(1)
+    while frame is not None:
+        frame = frame.f_back
+        depth += 1
+    _print(' ' * depth + ' ' + msg)
+
+def log(msg, *args):
     """
     Since this script is used in cron and cron sends mails if there is
     stdout, we print ordinarily.
     """
-    print(msg)
+    if (_output.level or _level) > INFO:
+        return
+    _print(msg % args if args else msg)
+
+def warning(msg, *args):
+    if (_output.level or _level) > WARNING:
+        return
+    _print("WARNING: " + (msg % args if args else msg))
+
+def error(msg, *args):
+    """
+    Prints errors, and everything collected before them right away.
+    """
+    _print("ERROR: " + (msg % args if args else msg))
+    flush_output()
+
+@contextmanager
+def atomic_write(path, mode='w', permissions=0o644):
+    """
+    Replaces the file ``path`` atomically: yields a file object (opened
+    with ``mode``) of a temporary file next to it, which is synced and
+    renamed over ``path`` when the block is left, or removed if it
+    raises. The new file gets ``permissions``.
+    """
+    # only imported by runs writing files, it takes a while
+    from tempfile import mkstemp
+
+    directory = dirname(path) or '.'
+    fd, temp_path = mkstemp(dir=directory, prefix='.%s.' % basename(path))
+    try:
+        with open(fd, mode) as temp_file:
+            yield temp_file
+            temp_file.flush()
+            fchmod(fd, permissions)
+            fsync(fd)
+        rename(temp_path, path)
+    except BaseException:
+        unlink(temp_path)
+        raise
+
+    directory_fd = os_open(directory, O_RDONLY | O_DIRECTORY)
+    try:
+        fsync(directory_fd)
+    finally:
+        close(directory_fd)
@@ -0,0 +1,11 @@
+"""
+Unit tests, run with ``python3 -m unittest`` in the top directory.
+"""
+
+import lib.util
+from lib.util import set_level, ERROR
+
+# keep the output of the tests readable, also of runners (which reset the
+# level before applying the configured one)
+set_level(ERROR)
+lib.util._initial_level = ERROR
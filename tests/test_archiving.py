@@ -0,0 +1,40 @@
+import unittest
+from os import mkdir, listdir
+from os.path import join as path_join
+from tempfile import TemporaryDirectory
+from tarfile import open as open_tar
+
+from lib.archiving import create_archive, verify_archive
+
+class CreateArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.root = self.directory.name
+        self.trash = path_join(self.root, 'trash')
+        mkdir(self.trash)
+        mkdir(path_join(self.root, 'home'))
+        with open(path_join(self.root, 'home', 'file'), 'w') as home_file:
+            home_file.write('contents')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_create_archive(self):
+        path = create_archive(path_join(self.trash, 'home'), self.root,
+                              'home', 'gztar', 1)
+        self.assertEqual(path, path_join(self.trash, 'home.tar.gz'))
+        self.assertEqual(listdir(self.trash), ['home.tar.gz'])
+        self.assertEqual(verify_archive(path), 2)
+        with open_tar(path) as archive:
+            self.assertEqual(sorted(archive.getnames()),
+                             ['home', 'home/file'])
+
+    def test_no_partial_archive(self):
+        with self.assertRaises(FileNotFoundError):
+            create_archive(path_join(self.trash, 'missing'), self.root,
+                           'missing', 'tar')
+        self.assertEqual(listdir(self.trash), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import unittest
+from unittest import mock
+from os import stat, chmod, listdir, write, symlink
+from os.path import join as path_join
+from stat import S_IMODE
+from tempfile import TemporaryDirectory
+
+from lib import copying
+from lib.copying import copy_file
+
+DATA = bytes(range(256)) * 4099
+
+class CopyingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.src = path_join(self.directory.name, 'src')
+        self.dst = path_join(self.directory.name, 'dst')
+        with open(self.src, 'wb') as src_file:
+            src_file.write(DATA)
+        chmod(self.src, 0o751)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def read(self, path):
+        with open(path, 'rb') as copied_file:
+            return copied_file.read()
+
+    def test_copy_file(self):
+        with open(self.dst, 'w') as dst_file:
+            dst_file.write('old')
+        symlink(self.src, path_join(self.directory.name, 'link'))
+        self.assertEqual(copy_file(path_join(self.directory.name, 'link'),
+                                   self.dst), len(DATA))
+        self.assertEqual(self.read(self.dst), DATA)
+        self.assertEqual(S_IMODE(stat(self.dst).st_mode), 0o751)
+        self.assertEqual(stat(self.dst).st_mtime_ns,
+                         stat(self.src).st_mtime_ns)
+
+    def test_short_writes(self):
+        def unsupported(*args):
+            raise OSError('not supported')
+
+        def write_some(fd, data):
+            return write(fd, data[:1000])
+
+        with mock.patch.object(copying, 'copy_file_range', unsupported), \
+                mock.patch.object(copying, 'sendfile', unsupported), \
+                mock.patch.object(copying, 'write', write_some):
+            self.assertEqual(copy_file(self.src, self.dst), len(DATA))
+        self.assertEqual(self.read(self.dst), DATA)
+
+    def test_no_regular_file(self):
+        with self.assertRaises(ValueError):
+            copy_file('/dev/null', self.dst)
+
+    def test_failure_removes_temp_file(self):
+        with mock.patch.object(copying, 'fchown',
+                               side_effect=OSError('failed')):
+            with self.assertRaises(OSError):
+                copy_file(self.src, self.dst)
+        self.assertEqual(listdir(self.directory.name), ['src'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import unittest
+from collections import namedtuple
+from os import mkdir, chmod
+from os.path import join as path_join
+from tempfile import TemporaryDirectory
+
+from lib import ChecksRunner
+from lib.daemon import ChecksDaemon
+from lib.inotify import IN_ATTRIB
+from lib.nss import NssIndex
+from lib.plan import Plan
+
+User = namedtuple('User', 'pw_name pw_passwd pw_uid pw_gid pw_gecos pw_dir '
+                          'pw_shell')
+Group = namedtuple('Group', 'gr_name gr_passwd gr_gid gr_mem')
+
+USERS = [User(name, 'x', 1000 + uid, 1000, '', '/home/' + name, '/bin/sh')
+         for uid, name in enumerate(('alice', 'bob', 'carol'))]
+GROUPS = [Group('users', 'x', 1000, [])]
+
+class DaemonTest(unittest.TestCase):
+    """
+    Feeds synthetic inotify events to a daemon whose runner simulates
+    the checks for synthetic users.
+    """
+
+    config = """
+[main]
+home_path = %(root)s/homes/$u
+simulate = yes
+limit_to_primary_group = no
+minimum_users_count = 1
+plan_file = %(root)s/plan
+log_level = error
+
+[home_permissions]
+check = yes
+correct = yes
+octal_permissions = 711
+"""
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.root = self.directory.name
+        self.homes = path_join(self.root, 'homes')
+        mkdir(self.homes)
+        for user in USERS:
+            mkdir(self.home(user.pw_name))
+            chmod(self.home(user.pw_name), 0o711)
+        chmod(self.home('bob'), 0o777)
+        config_path = path_join(self.root, 'grequalizer.conf')
+        with open(config_path, 'w') as config_file:
+            config_file.write(self.config % {'root': self.root})
+        self.runner = ChecksRunner(config_path,
+                                   nss_loader=lambda: NssIndex(USERS, GROUPS))
+        self.runner.load()
+        self.daemon = ChecksDaemon(self.runner)
+        self.daemon.account_paths = set((path_join(self.root, 'passwd'),
+                                         path_join(self.root, 'group')))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def home(self, name):
+        return path_join(self.homes, name)
+
+    def planned_paths(self):
+        return [step['args'][0]
+                for step in Plan.load(path_join(self.root, 'plan')).steps]
+
+    def test_handle_events(self):
+        self.daemon.run_all()
+        self.assertEqual(self.planned_paths(), [self.home('bob')])
+
+        chmod(self.home('alice'), 0o777)
+        self.daemon.handle_events([(self.homes, IN_ATTRIB, 'alice')])
+        self.assertEqual([u.pw_name for u in self.runner.changed_users],
+                         ['alice'])
+        self.assertEqual(self.runner.changed_directories,
+                         set([self.home('alice')]))
+        # bob was not checked again, but his step is kept
+        self.assertEqual(self.planned_paths(),
+                         [self.home('bob'), self.home('alice')])
+
+        # events of unrelated files run nothing
+        self.daemon.handle_events([(self.root, IN_ATTRIB, 'unrelated')])
+        self.assertEqual(len(self.planned_paths()), 2)
+
+        # the full sweep plans everything anew
+        self.daemon.handle_events([])
+        self.assertIsNone(self.runner.changed_users)
+        self.assertEqual(sorted(self.planned_paths()),
+                         [self.home('alice'), self.home('bob')])
+
+if __name__ == '__main__':
+    unittest.main()
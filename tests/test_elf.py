@@ -0,0 +1,202 @@
+import unittest
+from os.path import join as path_join
+from struct import Struct
+from tempfile import TemporaryDirectory
+
+from lib.elf import ElfInfo, DependencyResolver, read_ld_so_cache, \
+    LD_SO_CACHE_MAGIC
+
+EM_X86_64 = 62
+
+def build_elf(interpreter=None, needed=(), soname=None, runpath=None,
+              elf_class=2, machine=EM_X86_64):
+    """
+    Returns the bytes of a minimal little endian ELF file with one
+    ``PT_LOAD`` segment covering the whole file, the string table
+    directly followed by the dynamic section.
+    """
+    is_64 = elf_class == 2
+    header = Struct('<16sHHIQQQIHHHHHH' if is_64 else
+                    '<16sHHIIIIIHHHHHH')
+    program_header = Struct('<IIQQQQQQ' if is_64 else '<IIIIIIII')
+    entry = Struct('<qQ' if is_64 else '<iI')
+
+    strings = b'\0'
+    def add_string(string):
+        nonlocal strings
+        offset = len(strings)
+        strings += string.encode() + b'\0'
+        return offset
+
+    dynamic = [(1, add_string(name)) for name in needed]
+    if soname is not None:
+        dynamic.append((14, add_string(soname)))
+    if runpath is not None:
+        dynamic.append((29, add_string(runpath)))
+
+    interp = b'' if interpreter is None else interpreter.encode() + b'\0'
+    segments = 2 + (interpreter is not None)
+    interp_offset = header.size + segments * program_header.size
+    strtab_offset = interp_offset + len(interp)
+    dynamic_offset = strtab_offset + len(strings)
+    dynamic.append((5, strtab_offset))
+    dynamic.append((0, 0))
+    dynamic_data = b''.join(entry.pack(*pair) for pair in dynamic)
+    size = dynamic_offset + len(dynamic_data)
+
+    def segment(p_type, offset, filesz):
+        if is_64:
+            return program_header.pack(p_type, 0, offset, offset, offset,
+                                       filesz, filesz, 0)
+        return program_header.pack(p_type, offset, offset, offset, filesz,
+                                   filesz, 0, 0)
+
+    ident = b'\x7fELF' + bytes([elf_class, 1, 1]) + b'\0' * 9
+    data = header.pack(ident, 3, machine, 1, 0, header.size, 0, 0,
+                       header.size, program_header.size, segments, 0, 0, 0)
+    data += segment(1, 0, size)
+    data += segment(2, dynamic_offset, len(dynamic_data))
+    if interpreter is not None:
+        data += segment(3, interp_offset, len(interp))
+    return data + interp + strings + dynamic_data
+
+def build_ld_so_cache(libraries):
+    """
+    Returns the bytes of an ``ld.so.cache`` in the glibc format for a
+    list of tuples (name, path).
+    """
+    entry = Struct('=iIIIQ')
+    strings_start = 48 + len(libraries) * entry.size
+    strings = b''
+    entries = b''
+    for name, path in libraries:
+        key = strings_start + len(strings)
+        strings += name.encode() + b'\0'
+        value = strings_start + len(strings)
+        strings += path.encode() + b'\0'
+        entries += entry.pack(0x303, key, value, 0, 0)
+    header = LD_SO_CACHE_MAGIC + Struct('=II').pack(len(libraries),
+                                                    len(strings))
+    header += b'\0' * (48 - len(header))
+    return header + entries + strings
+
+class ElfTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.root = self.directory.name
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, name, data):
+        path = path_join(self.root, name)
+        with open(path, 'wb') as elf_file:
+            elf_file.write(data)
+        return path
+
+    def resolver(self, libraries=()):
+        return DependencyResolver(ld_so_cache_path=self.write(
+            'ld.so.cache', build_ld_so_cache(libraries)
+        ))
+
+    def test_parse(self):
+        info = ElfInfo(self.write('bin', build_elf(
+            '/lib/ld.so', ['liba.so', 'libb.so'], runpath='$ORIGIN/lib:'
+        )))
+        self.assertEqual(info.elf_class, 2)
+        self.assertEqual(info.machine, EM_X86_64)
+        self.assertEqual(info.interpreter, '/lib/ld.so')
+        self.assertEqual(info.needed, ['liba.so', 'libb.so'])
+        self.assertEqual(info.runpath, ['$ORIGIN/lib', ''])
+        self.assertIsNone(info.soname)
+
+    def test_parse_32_bit(self):
+        info = ElfInfo(self.write('lib', build_elf(
+            needed=['libc.so.6'], soname='liba.so', elf_class=1, machine=3
+        )))
+        self.assertEqual((info.elf_class, info.machine), (1, 3))
+        self.assertEqual(info.needed, ['libc.so.6'])
+        self.assertEqual(info.soname, 'liba.so')
+
+    def test_no_elf(self):
+        with self.assertRaises(ValueError):
+            ElfInfo(self.write('script', b'#!/bin/sh\n'))
+
+    def test_read_ld_so_cache(self):
+        path = self.write('ld.so.cache', build_ld_so_cache([
+            ('liba.so', '/x/liba.so'), ('liba.so', '/y/liba.so'),
+            ('libb.so', '/x/libb.so'),
+        ]))
+        self.assertEqual(read_ld_so_cache(path), {
+            'liba.so': ['/x/liba.so', '/y/liba.so'],
+            'libb.so': ['/x/libb.so'],
+        })
+        self.assertEqual(read_ld_so_cache(path + '.missing'), {})
+
+    def test_resolve(self):
+        loader = self.write('ld.so', build_elf(soname='ld.so'))
+        liba = self.write('liba.so', build_elf(needed=['libb.so'],
+                                               soname='liba.so'))
+        self.write('lib32b.so', build_elf(elf_class=1, machine=3))
+        libb = self.write('libb.so', build_elf(needed=['ld.so']))
+        binary = self.write('bin', build_elf(loader, ['liba.so']))
+        resolver = self.resolver([
+            ('liba.so', liba),
+            ('libb.so', path_join(self.root, 'lib32b.so')),
+            ('libb.so', libb),
+        ])
+        self.assertEqual(resolver.resolve(binary), [loader, liba, libb])
+
+    def test_runpath_with_origin(self):
+        self.write('liba.so', build_elf())
+        binary = self.write('bin', build_elf(needed=['liba.so'],
+                                             runpath='$ORIGIN'))
+        self.assertEqual(self.resolver().resolve(binary),
+                         [path_join(self.root, 'liba.so')])
+
+    def test_needed_with_slash(self):
+        liba = self.write('liba.so', build_elf())
+        script = self.write('script', b'#!/bin/sh\n')
+        missing = path_join(self.root, 'missing.so')
+        binary = self.write('bin', build_elf(needed=[liba, script,
+                                                     missing]))
+        resolver = self.resolver()
+        requester = resolver.info(binary)
+        self.assertEqual(resolver.find_library(liba, requester, []), liba)
+        self.assertIsNone(resolver.find_library(script, requester, []))
+        self.assertIsNone(resolver.find_library(missing, requester, []))
+        self.assertEqual(resolver.resolve(binary), [liba])
+
+    def test_missing_interpreter(self):
+        binary = self.write('bin', build_elf(
+            path_join(self.root, 'missing-ld.so')
+        ))
+        resolver = self.resolver()
+        self.assertEqual(resolver.dependencies(binary), [])
+        self.assertEqual([path for path, _, _ in resolver.resolved[binary]],
+                         [binary])
+
+    def test_dependencies_validated_once(self):
+        liba = self.write('liba.so', build_elf(soname='liba.so'))
+        binary = self.write('bin', build_elf(needed=['liba.so']))
+        cache_path = path_join(self.root, 'dependencies')
+        resolver = DependencyResolver(cache_path, self.write(
+            'ld.so.cache', build_ld_so_cache([('liba.so', liba)])
+        ))
+        self.assertEqual(resolver.dependencies(binary), [liba])
+        resolver.save()
+
+        resolver = DependencyResolver(cache_path, resolver.ld_so_cache_path)
+        resolver.load()
+        signatures = []
+        signature = resolver._signature
+        resolver._signature = lambda path: signatures.append(path) or \
+            signature(path)
+        for _ in range(3):
+            self.assertEqual(resolver.dependencies(binary), [liba])
+        self.assertEqual(signatures, [binary, liba])
+        self.assertEqual(resolver.infos, {})
+
+if __name__ == '__main__':
+    unittest.main()
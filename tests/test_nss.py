@@ -0,0 +1,90 @@
+import unittest
+from collections import namedtuple
+from os import stat
+from os.path import join as path_join
+from stat import S_IMODE
+from tempfile import TemporaryDirectory
+
+from lib.nss import NssIndex, NssSnapshot
+
+User = namedtuple('User', 'pw_name pw_passwd pw_uid pw_gid pw_gecos '
+                         'pw_dir pw_shell')
+Group = namedtuple('Group', 'gr_name gr_passwd gr_gid gr_mem')
+
+users = [
+    User('alice', '$6$hash', 1000, 100, 'Alice', '/home/alice', '/bin/sh'),
+    User('bob', 'x', 1001, 100, '', '/home/bob', '/bin/bash'),
+    User('alice', 'x', 1002, 100, '', '/home/alice2', '/bin/sh'),
+]
+groups = [
+    Group('staff', '!', 100, ['alice', 'bob']),
+    Group('empty', 'x', 101, []),
+]
+
+class NssIndexTest(unittest.TestCase):
+
+    def test_first_entry_wins(self):
+        index = NssIndex(users, groups)
+        self.assertEqual(index.getpwnam('alice').pw_uid, 1000)
+        self.assertEqual(index.getpwuid(1002).pw_dir, '/home/alice2')
+        self.assertEqual(index.getgrnam('empty').gr_gid, 101)
+        self.assertEqual(index.getgrgid(100).gr_name, 'staff')
+
+    def test_misses_are_looked_up(self):
+        index = NssIndex()
+        self.assertEqual(index.getpwuid(0).pw_name, 'root')
+        self.assertIn(0, index.users_by_uid)
+        with self.assertRaises(KeyError):
+            index.getpwnam('no such user, really')
+
+class NssSnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.path = path_join(self.directory.name, 'nss')
+        self.snapshot = NssSnapshot(self.path)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_no_snapshot(self):
+        self.assertIsNone(self.snapshot.load())
+
+    def test_round_trip(self):
+        self.snapshot.update(NssIndex(users, groups), created=42.0)
+        self.assertEqual(S_IMODE(stat(self.path).st_mode), 0o600)
+
+        snapshot = NssSnapshot(self.path)
+        index = snapshot.load()
+        self.assertEqual(snapshot.created, 42.0)
+        self.assertEqual([tuple(user) for user in index.users], [
+            tuple(user._replace(pw_passwd='x')) for user in users
+        ])
+        self.assertEqual([tuple(group) for group in index.groups], [
+            tuple(group._replace(gr_passwd='x')) for group in groups
+        ])
+        with open(self.path, 'rb') as snapshot_file:
+            self.assertNotIn(b'$6$hash', snapshot_file.read())
+
+    def test_unchanged_snapshot_is_updated_in_place(self):
+        self.snapshot.update(NssIndex(users, groups), created=1.0)
+        inode = stat(self.path).st_ino
+        self.snapshot.update(NssIndex(users, groups), created=2.0)
+        self.assertEqual(stat(self.path).st_ino, inode)
+        self.assertEqual(NssSnapshot(self.path).load().users[1].pw_name,
+                         'bob')
+        self.snapshot.load()
+        self.assertEqual(self.snapshot.created, 2.0)
+
+        self.snapshot.update(NssIndex(users[:1], groups), created=3.0)
+        self.assertNotEqual(stat(self.path).st_ino, inode)
+        self.assertEqual(len(NssSnapshot(self.path).load().users), 1)
+
+    def test_invalid_snapshot(self):
+        with open(self.path, 'wb') as snapshot_file:
+            snapshot_file.write(b'\0' * NssSnapshot.header.size)
+        with self.assertRaises(ValueError):
+            self.snapshot.load()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import unittest
+from unittest import mock
+from os import chmod, stat, listdir, rename
+from os.path import join as path_join, exists
+from stat import S_IMODE
+from tempfile import TemporaryDirectory
+
+from lib.passwd import PasswdEditor
+
+PASSWD = """root:x:0:0:root:/root:/bin/bash
+# comment
+alice:x:1000:1000:Alice:/home/alice:/bin/sh
+broken:line
+bob:x:1001:1000:Bob:/home/bob:/bin/sh
+"""
+
+class PasswdEditorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.path = path_join(self.directory.name, 'passwd')
+        with open(self.path, 'w') as passwd_file:
+            passwd_file.write(PASSWD)
+        chmod(self.path, 0o644)
+        self.editor = PasswdEditor(self.path)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def read(self):
+        with open(self.path) as passwd_file:
+            return passwd_file.read()
+
+    def test_batched_edits(self):
+        self.editor.set_field('alice', 'shell', '/bin/false')
+        self.editor.set_field('alice', 'home', '/srv/alice')
+        self.editor.set_field('bob', 'shell', '/bin/zsh')
+        self.editor.apply()
+        self.assertEqual(self.read(), PASSWD.replace(
+            'Alice:/home/alice:/bin/sh', 'Alice:/srv/alice:/bin/false'
+        ).replace('Bob:/home/bob:/bin/sh', 'Bob:/home/bob:/bin/zsh'))
+        self.assertEqual(S_IMODE(stat(self.path).st_mode), 0o644)
+        self.assertEqual(self.editor.changes, {})
+
+    def test_one_rewrite(self):
+        self.editor.set_field('alice', 'shell', '/bin/false')
+        self.editor.set_field('bob', 'shell', '/bin/false')
+        with mock.patch('lib.passwd.rename', wraps=rename) as renamed:
+            self.editor.apply()
+        self.assertEqual(renamed.call_count, 1)
+
+    def test_unknown_user(self):
+        self.editor.set_field('carol', 'shell', '/bin/false')
+        self.editor.set_field('broken', 'shell', '/bin/false')
+        self.editor.apply()
+        self.assertEqual(self.read(), PASSWD)
+
+    def test_no_changes(self):
+        inode = stat(self.path).st_ino
+        self.editor.apply()
+        self.assertEqual(stat(self.path).st_ino, inode)
+        self.assertFalse(exists(self.editor.lock_path))
+
+    def test_lock(self):
+        self.editor.set_field('alice', 'shell', '/bin/false')
+        with mock.patch('lib.passwd.lockf') as lockf:
+            self.editor.apply()
+        self.assertEqual(self.editor.lock_path,
+                         path_join(self.directory.name, '.pwd.lock'))
+        self.assertEqual([call.args[0].name for call in lockf.call_args_list],
+                         [self.editor.lock_path] * 2)
+
+    def test_failure_removes_temp_file(self):
+        self.editor.set_field('alice', 'shell', '/bin/false')
+        with mock.patch('lib.passwd.fsync', side_effect=OSError('full')):
+            with self.assertRaises(OSError):
+                self.editor.apply()
+        self.assertEqual(self.read(), PASSWD)
+        self.assertEqual(sorted(listdir(self.directory.name)),
+                         ['.pwd.lock', 'passwd'])
+
+if __name__ == '__main__':
+    unittest.main()
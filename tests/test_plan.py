@@ -0,0 +1,142 @@
+import unittest
+from os import chmod, chown, mkdir, stat
+from os.path import join as path_join, exists
+from stat import S_IMODE
+from shutil import rmtree
+from subprocess import call
+from tempfile import TemporaryDirectory
+
+from lib.plan import Plan, PlanApplier, path_precondition, operations, \
+    operation_function
+
+class PlanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.root = self.directory.name
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def path(self, name):
+        return path_join(self.root, name)
+
+    def touch(self, name, mode=0o644):
+        path = self.path(name)
+        with open(path, 'w'):
+            pass
+        chmod(path, mode)
+        return path
+
+    def test_path_precondition(self):
+        path = self.touch('a', 0o640)
+        self.assertEqual(
+            path_precondition(path, stat(path), 'mode', exists=True),
+            {'path': path, 'mode': 0o640, 'exists': True}
+        )
+        self.assertEqual(path_precondition(path, exists=False),
+                         {'path': path, 'exists': False})
+
+    def test_operation_function(self):
+        for operation in operations:
+            function = operation_function(operation)
+            self.assertEqual('%s.%s' % (function.__module__,
+                                        function.__name__), operation)
+
+    def test_record(self):
+        plan = Plan()
+        plan.record('c', chmod, ('/a', 0o700), {}, {'path': '/a'})
+        plan.record('c', mkdir, ('/b', ), {})
+        self.assertEqual(plan.steps[0]['operation'], 'posix.chmod')
+        self.assertEqual(plan.steps[0]['preconditions'], [{'path': '/a'}])
+        self.assertEqual(plan.steps[1]['preconditions'], [])
+        with self.assertRaises(ValueError):
+            plan.record('c', print, ('/a', ), {})
+
+    def test_save_and_load(self):
+        plan = Plan('grequalizer.conf', '/etc/passwd')
+        plan.record('c', chmod, ('/a', 0o700), {}, {'path': '/a'})
+        plan.save(self.path('plan'))
+        self.assertFalse(exists(self.path('plan.tmp')))
+        loaded = Plan.load(self.path('plan'))
+        self.assertEqual(loaded.config_file, 'grequalizer.conf')
+        self.assertEqual(loaded.passwd_file, '/etc/passwd')
+        self.assertEqual(loaded.created, plan.created)
+        self.assertEqual(loaded.steps, plan.steps)
+
+    def test_accesses(self):
+        plan = Plan()
+        plan.record('c', chmod, ('/h/a', 0o700), {}, {'path': '/h/a'})
+        plan.record('c', mkdir, ('/h/b', ), {},
+                    {'path': '/h/b', 'exists': False})
+        plan.record('c', call, (['true'], ), {})
+        self.assertEqual(Plan.accesses(plan.steps[0]),
+                         ('/h', set(['/h/a', '/h']), set(['/h/a'])))
+        self.assertEqual(Plan.accesses(plan.steps[1]),
+                         ('/h', set(), set(['/h/b', '/h'])))
+        self.assertEqual(Plan.accesses(plan.steps[2]), (None, set(), None))
+
+    def test_groups(self):
+        plan = Plan()
+        for name in 'ab':
+            plan.record('c', chmod, ('/h/%s' % name, 0o700), {})
+        plan.record('c', chown, ('/h/a', 0, 0), {})
+        plan.record('c', chmod, ('/h/c', 0o700), {})
+        plan.record('c', chmod, ('/h/a', 0o750), {})
+        self.assertEqual([
+            (operation, directory, [step['args'][0] for step in steps])
+            for operation, directory, steps in plan.groups()
+        ], [
+            ('posix.chmod', '/h', ['/h/a', '/h/b', '/h/c']),
+            ('posix.chown', '/h', ['/h/a']),
+            ('posix.chmod', '/h', ['/h/a']),
+        ])
+
+    def test_groups_barrier(self):
+        plan = Plan()
+        plan.record('c', chmod, ('/h/a', 0o700), {})
+        plan.record('c', call, (['true'], ), {})
+        plan.record('c', chmod, ('/h/b', 0o700), {})
+        self.assertEqual([len(steps) for _, _, steps in plan.groups()],
+                         [1, 1, 1])
+
+    def test_unmet_preconditions(self):
+        path = self.touch('a', 0o640)
+        unmet = PlanApplier.unmet_preconditions
+        self.assertEqual(unmet([path_precondition(path, stat(path), 'mode',
+                                                  'uid')]), [])
+        self.assertEqual(len(unmet([{'path': path, 'mode': 0o600}])), 1)
+        self.assertEqual(len(unmet([{'path': path, 'exists': False}])), 1)
+        self.assertEqual(len(unmet([{'path': self.path('b')}])), 1)
+        self.assertEqual(unmet([{'path': self.path('b'),
+                                 'exists': False}]), [])
+        self.assertEqual(len(unmet([{'user': 'no such user, hopefully'}])),
+                         1)
+
+    def test_apply(self):
+        changed = self.touch('a', 0o644)
+        kept = self.touch('b', 0o644)
+        plan = Plan()
+        for path in changed, kept:
+            plan.record('c', chmod, (path, 0o600), {},
+                        path_precondition(path, stat(path), 'mode'))
+        plan.record('c', mkdir, (self.path('d'), 0o700), {},
+                    path_precondition(self.path('d'), exists=False))
+        chmod(kept, 0o640)
+        applier = PlanApplier(plan)
+        self.assertFalse(applier.apply())
+        self.assertEqual((applier.applied, applier.skipped, applier.failed),
+                         (2, 1, 0))
+        self.assertEqual(S_IMODE(stat(changed).st_mode), 0o600)
+        self.assertEqual(S_IMODE(stat(kept).st_mode), 0o640)
+        self.assertTrue(exists(self.path('d')))
+
+    def test_apply_failure(self):
+        plan = Plan()
+        plan.record('c', rmtree, (self.path('missing'), ), {})
+        applier = PlanApplier(plan)
+        self.assertFalse(applier.apply())
+        self.assertEqual(applier.failed, 1)
+
+if __name__ == '__main__':
+    unittest.main()
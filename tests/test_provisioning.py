@@ -0,0 +1,135 @@
+import unittest
+from collections import namedtuple
+from os import mkdir, link, symlink, stat, lstat, readlink, listdir
+from os.path import join as path_join
+from stat import S_IMODE
+from tempfile import TemporaryDirectory
+
+from lib.config import OptionsDict
+from lib.nss import NssIndex
+from lib import provisioning
+from lib.provisioning import provision_home, rename_noreplace
+from lib.checks.home_existence import HomeExistenceCheck
+
+User = namedtuple('User', 'pw_name pw_passwd pw_uid pw_gid pw_gecos pw_dir '
+                          'pw_shell')
+Group = namedtuple('Group', 'gr_name gr_passwd gr_gid gr_mem')
+
+class ProvisioningTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.root = self.directory.name
+        self.skeleton = self.path('skel')
+        self.homes = self.path('homes')
+        mkdir(self.homes)
+        mkdir(self.skeleton)
+        mkdir(path_join(self.skeleton, 'sub'), 0o750)
+        with open(path_join(self.skeleton, 'sub', 'f'), 'w') as skel_file:
+            skel_file.write('content')
+        link(path_join(self.skeleton, 'sub', 'f'),
+             path_join(self.skeleton, 'g'))
+        symlink('sub/f', path_join(self.skeleton, 'link'))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def path(self, name):
+        return path_join(self.root, name)
+
+    def test_provision_home(self):
+        home = path_join(self.homes, 'alice')
+        copied = provision_home(home, 0o711, 1000, 1001, self.skeleton)
+        self.assertEqual(copied, len('content'))
+        home_stat = stat(home)
+        self.assertEqual(S_IMODE(home_stat.st_mode), 0o711)
+        self.assertEqual((home_stat.st_uid, home_stat.st_gid), (1000, 1001))
+        self.assertEqual(S_IMODE(stat(path_join(home, 'sub')).st_mode),
+                         0o750)
+        copy = stat(path_join(home, 'sub', 'f'))
+        self.assertEqual((copy.st_uid, copy.st_nlink), (1000, 2))
+        self.assertEqual(copy.st_ino, stat(path_join(home, 'g')).st_ino)
+        self.assertNotEqual(copy.st_ino,
+                            stat(path_join(self.skeleton, 'g')).st_ino)
+        self.assertEqual(readlink(path_join(home, 'link')), 'sub/f')
+        self.assertEqual(lstat(path_join(home, 'link')).st_uid, 1000)
+        self.assertEqual(listdir(self.homes), ['alice'])
+
+    def test_existing_home(self):
+        home = path_join(self.homes, 'alice')
+        mkdir(home)
+        with self.assertRaises(FileExistsError):
+            provision_home(home, 0o711, 1000, 1000, self.skeleton)
+
+    def test_home_appearing_meanwhile(self):
+        home = path_join(self.homes, 'alice')
+        populate = provisioning.populate
+
+        def populate_and_log_in(*args):
+            copied = populate(*args)
+            # e.g. pam_mkhomedir creating an empty home
+            mkdir(home)
+            return copied
+
+        provisioning.populate = populate_and_log_in
+        try:
+            with self.assertRaises(FileExistsError):
+                provision_home(home, 0o711, 1000, 1000, self.skeleton)
+        finally:
+            provisioning.populate = populate
+        self.assertEqual(listdir(self.homes), ['alice'])
+        self.assertEqual(listdir(home), [])
+
+    def test_rename_noreplace_without_renameat2(self):
+        libc = provisioning.libc
+        provisioning.libc = object()
+        try:
+            self.test_rename_noreplace()
+        finally:
+            provisioning.libc = libc
+
+    def test_rename_noreplace(self):
+        for name in 'a', 'b', 'c':
+            mkdir(path_join(self.homes, name))
+        with open(path_join(self.homes, 'c', 'f'), 'w'):
+            pass
+        rename_noreplace(path_join(self.homes, 'a'),
+                         path_join(self.homes, 'd'))
+        for name in 'b', 'c':
+            with self.assertRaises(FileExistsError):
+                rename_noreplace(path_join(self.homes, 'd'),
+                                 path_join(self.homes, name))
+        self.assertEqual(sorted(listdir(self.homes)), ['b', 'c', 'd'])
+
+    def test_failure_leaves_nothing(self):
+        with self.assertRaises(ValueError):
+            provision_home(path_join(self.homes, 'alice'), 0o711, 1000,
+                           1000, self.skeleton, 'unknown')
+        self.assertEqual(listdir(self.homes), [])
+
+    def provision_homes(self, workers):
+        alice = User('alice', 'x', 1000, 1000, '', '', '/bin/sh')
+        bob = User('bob', 'x', 1001, 1000, '', '', '/bin/sh')
+        nss = NssIndex([alice], [Group('users', 'x', 1000, [])])
+        options = OptionsDict(
+            check='yes', correct='yes', provision='yes',
+            skeleton_path=self.skeleton, provision_workers=workers,
+        )
+        check = HomeExistenceCheck(path_join(self.homes, '$u'),
+                                   [alice, bob], False, options, nss=nss)
+        # bob is unknown to nss, which fails only the provisioning of his
+        # home
+        check.provision_homes([path_join(self.homes, 'bob'),
+                               path_join(self.homes, 'alice')])
+        self.assertEqual(listdir(self.homes), ['alice'])
+        self.assertEqual(stat(path_join(self.homes, 'alice')).st_uid, 1000)
+        self.assertEqual(check.metrics.bytes_copied, len('content'))
+
+    def test_provision_homes(self):
+        self.provision_homes('1')
+
+    def test_provision_homes_concurrently(self):
+        self.provision_homes('4')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+import unittest
+from collections import namedtuple
+from os import mkdir, chmod, stat
+from os.path import join as path_join
+from stat import S_IMODE
+from tempfile import TemporaryDirectory
+
+from lib import ChecksRunner
+from lib.nss import NssIndex, NssSnapshot
+
+User = namedtuple('User', 'pw_name pw_passwd pw_uid pw_gid pw_gecos pw_dir '
+                          'pw_shell')
+Group = namedtuple('Group', 'gr_name gr_passwd gr_gid gr_mem')
+
+USERS = [User(name, 'x', 1000 + uid, 1000, '', '/home/' + name, '/bin/sh')
+         for uid, name in enumerate(('alice', 'bob'))]
+GROUPS = [Group('users', 'x', 1000, [])]
+
+class RunnerTest(unittest.TestCase):
+    """
+    Runs whole configurations against homes in a temporary directory,
+    with synthetic users.
+    """
+
+    config = """
+[main]
+home_path = %(root)s/homes/$u
+simulate = no
+limit_to_primary_group = no
+minimum_users_count = 1
+state_file = %(root)s/state
+log_level = error
+
+[home_permissions]
+check = yes
+correct = yes
+octal_permissions = 711
+recursive = yes
+"""
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.root = self.directory.name
+        self.homes = self.path('homes')
+        mkdir(self.homes)
+        for user in USERS:
+            mkdir(self.home(user.pw_name, ''), 0o711)
+            chmod(self.home(user.pw_name, ''), 0o711)
+            mkdir(self.home(user.pw_name, 'a'))
+            mkdir(self.home(user.pw_name, 'a/b'))
+            with open(self.home(user.pw_name, 'a/b/f'), 'w'):
+                pass
+        self.config_path = self.path('grequalizer.conf')
+        with open(self.config_path, 'w') as config_file:
+            config_file.write(self.config % {'root': self.root})
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def path(self, name):
+        return path_join(self.root, name)
+
+    def home(self, name, relative_path):
+        return path_join(self.homes, name, relative_path)
+
+    def runner(self):
+        return ChecksRunner(self.config_path,
+                            nss_loader=lambda: NssIndex(USERS, GROUPS))
+
+    def mode(self, path):
+        return S_IMODE(stat(path).st_mode)
+
+    def test_recursive_in_incremental_mode(self):
+        deep = self.home('alice', 'a/b/f')
+        chmod(deep, 0o666)
+        self.runner().auto()
+        self.assertEqual(self.mode(deep), 0o664)
+
+        # the homes themselves do not change
+        chmod(deep, 0o666)
+        runner = self.runner()
+        runner.auto()
+        self.assertEqual(len(runner.changed_users), 0)
+        self.assertEqual(self.mode(deep), 0o664)
+
+class NssSnapshotFallbackTest(unittest.TestCase):
+
+    config = """
+[main]
+home_path = %(root)s/$u
+simulate = no
+limit_to_primary_group = no
+minimum_users_count = 1
+nss_snapshot_file = %(root)s/nss
+log_level = error
+"""
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.root = self.directory.name
+        self.config_path = path_join(self.root, 'grequalizer.conf')
+        with open(self.config_path, 'w') as config_file:
+            config_file.write(self.config % {'root': self.root})
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def load_with_snapshot(self, data):
+        with open(path_join(self.root, 'nss'), 'wb') as snapshot_file:
+            snapshot_file.write(data)
+        runner = ChecksRunner(self.config_path)
+        runner.load()
+        self.assertGreater(len(runner.users), 0)
+        # replaced by the fresh enumeration
+        self.assertIsNotNone(NssSnapshot(path_join(self.root, 'nss')).load())
+
+    def test_empty_snapshot(self):
+        self.load_with_snapshot(b'')
+
+    def test_short_snapshot(self):
+        self.load_with_snapshot(b'GRNS')
+
+    def test_invalid_snapshot(self):
+        self.load_with_snapshot(b'\0' * NssSnapshot.header.size)
+
+if __name__ == '__main__':
+    unittest.main()
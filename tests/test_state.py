@@ -0,0 +1,89 @@
+import unittest
+from collections import namedtuple
+from os import stat
+from os.path import join as path_join, exists
+from tempfile import TemporaryDirectory
+from time import time
+
+from lib.state import RunState
+
+User = namedtuple('User', 'pw_name pw_passwd pw_uid pw_gid pw_gecos pw_dir '
+                          'pw_shell')
+
+ALICE = User('alice', 'x', 1000, 1000, 'Alice', '/home/alice', '/bin/sh')
+
+class RunStateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.path = path_join(self.directory.name, 'state')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_user_digest(self):
+        digest = RunState.user_digest(ALICE, 'users')
+        self.assertEqual(digest, RunState.user_digest(ALICE, 'users'))
+        self.assertNotEqual(digest, RunState.user_digest(ALICE, 'staff'))
+        self.assertNotEqual(digest, RunState.user_digest(
+            ALICE._replace(pw_shell='/bin/bash'), 'users'
+        ))
+
+    def test_home_fingerprint(self):
+        self.assertIsNone(RunState.home_fingerprint(None))
+        stat_result = stat(self.directory.name)
+        fingerprint = RunState.home_fingerprint(stat_result)
+        self.assertEqual(fingerprint[:4], [
+            stat_result.st_mode, stat_result.st_uid, stat_result.st_gid,
+            stat_result.st_ino,
+        ])
+        with open(self.path, 'w'):
+            pass
+        self.assertNotEqual(
+            RunState.home_fingerprint(stat(self.directory.name)), fingerprint
+        )
+
+    def test_config_digest_for(self):
+        digest = RunState.config_digest_for({
+            'a': {'x': '1', 'y': '2'}, 'b': {},
+        })
+        self.assertEqual(digest, RunState.config_digest_for({
+            'b': {}, 'a': {'y': '2', 'x': '1'},
+        }))
+        self.assertNotEqual(digest, RunState.config_digest_for({
+            'a': {'x': '1', 'y': '3'}, 'b': {},
+        }))
+
+    def test_needs_full_sweep(self):
+        state = RunState(self.path)
+        self.assertTrue(state.needs_full_sweep('digest', 3600))
+        state.config_digest = 'digest'
+        self.assertTrue(state.needs_full_sweep('digest', 3600))
+        state.full_sweep_time = time()
+        self.assertFalse(state.needs_full_sweep('digest', 3600))
+        self.assertTrue(state.needs_full_sweep('other', 3600))
+        state.full_sweep_time -= 7200
+        self.assertTrue(state.needs_full_sweep('digest', 3600))
+
+    def test_save_and_load(self):
+        state = RunState(self.path)
+        state.load()
+        self.assertEqual((state.users, state.homes), ({}, {}))
+        state.config_digest = 'digest'
+        state.full_sweep_time = 1234.5
+        state.users = {'alice': RunState.user_digest(ALICE, 'users')}
+        state.homes = {'/home/alice': RunState.home_fingerprint(
+            stat(self.directory.name)
+        )}
+        state.save()
+        self.assertFalse(exists(self.path + '.tmp'))
+
+        loaded = RunState(self.path)
+        loaded.load()
+        self.assertEqual(loaded.config_digest, 'digest')
+        self.assertEqual(loaded.full_sweep_time, 1234.5)
+        self.assertEqual(loaded.users, state.users)
+        self.assertEqual(loaded.homes, state.homes)
+
+if __name__ == '__main__':
+    unittest.main()
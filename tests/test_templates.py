@@ -0,0 +1,48 @@
+import unittest
+from collections import namedtuple
+
+from lib.nss import NssIndex
+from lib.templates import Template, TemplateExpander
+
+User = namedtuple('User', 'pw_name pw_passwd pw_uid pw_gid pw_gecos '
+                         'pw_dir pw_shell')
+Group = namedtuple('Group', 'gr_name gr_passwd gr_gid gr_mem')
+
+alice = User('alice', 'x', 1000, 100, '', '/home/alice', '/bin/sh')
+staff = Group('staff', 'x', 100, [])
+
+class TemplateTest(unittest.TestCase):
+
+    def test_expand(self):
+        template = Template('/srv/$g/$u/x$h')
+        self.assertTrue(template.needs_group)
+        self.assertEqual(template.expand(alice, 'staff'),
+                         '/srv/staff/alice/x/home/alice')
+
+    def test_unknown_variables_are_literal(self):
+        template = Template('cost: $5 $x')
+        self.assertFalse(template.has_variables)
+        self.assertEqual(template.expand(alice), 'cost: $5 $x')
+
+class TemplateExpanderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.expander = TemplateExpander(NssIndex([alice], [staff]))
+
+    def test_expand_memoizes_strings_with_variables(self):
+        self.assertEqual(self.expander.expand('/home/$g/$u', alice),
+                         '/home/staff/alice')
+        self.assertEqual(self.expander.expansions,
+                         {('/home/$g/$u', alice): '/home/staff/alice'})
+
+    def test_expand_without_memoizing(self):
+        self.expander.expand('/home/$u', alice, memoize=False)
+        self.assertEqual(self.expander.expansions, {})
+
+    def test_plain_strings_are_not_remembered(self):
+        for string in ('/usr/bin/zsh', 'a $ b'):
+            self.assertEqual(self.expander.expand(string, alice), string)
+        self.assertEqual(self.expander.expansions, {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import unittest
+from collections import namedtuple
+from os import mkdir, chmod, symlink, link, stat, lstat
+from os.path import join as path_join
+from stat import S_IMODE
+from tempfile import TemporaryDirectory
+
+from lib.config import OptionsDict
+from lib.nss import NssIndex
+from lib.tree import walk_tree, exclusion_regex, chmod_nofollow
+from lib.checks.home_permissions import HomePermissionCheck
+
+User = namedtuple('User', 'pw_name pw_passwd pw_uid pw_gid pw_gecos pw_dir '
+                          'pw_shell')
+
+class TreeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.root = self.directory.name
+        self.home = self.path('alice')
+        mkdir(self.home)
+        mkdir(path_join(self.home, 'a'))
+        mkdir(path_join(self.home, 'a', 'b'))
+        mkdir(path_join(self.home, 'cache'))
+        for name in 'a/b/f', 'cache/g', 'h':
+            with open(path_join(self.home, name), 'w'):
+                pass
+        symlink(self.root, path_join(self.home, 'link'))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def path(self, name):
+        return path_join(self.root, name)
+
+    def walk(self, top, excluded=None):
+        return [entry.relative_path for entry in walk_tree(top, excluded)]
+
+    def test_walk_tree(self):
+        walked = self.walk(self.home)
+        self.assertEqual(sorted(walked), ['a', 'a/b', 'a/b/f', 'cache',
+                                          'cache/g', 'h', 'link'])
+        self.assertLess(walked.index('a'), walked.index('a/b'))
+        self.assertLess(walked.index('a/b'), walked.index('a/b/f'))
+
+    def test_exclusion(self):
+        self.assertIsNone(exclusion_regex(''))
+        self.assertEqual(sorted(self.walk(self.home, exclusion_regex(
+            'cache a/*/f'
+        ))), ['a', 'a/b', 'h', 'link'])
+
+    def test_symlinked_top(self):
+        symlink(self.home, self.path('bob'))
+        with self.assertRaises(OSError):
+            self.walk(self.path('bob'))
+
+    def test_chmod_nofollow(self):
+        path = path_join(self.home, 'h')
+        chmod_nofollow(path, 0o600)
+        self.assertEqual(S_IMODE(stat(path).st_mode), 0o600)
+        link_mode = lstat(path_join(self.home, 'link')).st_mode
+        with self.assertRaises(OSError):
+            chmod_nofollow(path_join(self.home, 'link'), 0o600)
+        self.assertEqual(lstat(path_join(self.home, 'link')).st_mode,
+                         link_mode)
+
+    def check(self):
+        options = OptionsDict(octal_permissions='755', recursive='yes')
+        return HomePermissionCheck(path_join(self.root, '$u'), [], True,
+                                   options, nss=NssIndex())
+
+    def test_walk_home(self):
+        chmod(self.home, 0o755)
+        check = self.check()
+        self.assertEqual(len(list(check.walk_home(self.home))), 7)
+        self.assertTrue(check.is_correct(User(
+            'alice', 'x', 1000, 1000, '', self.home, '/bin/sh'
+        )))
+        chmod(path_join(self.home, 'h'), 0o666)
+        self.assertFalse(check.is_correct(User(
+            'alice', 'x', 1000, 1000, '', self.home, '/bin/sh'
+        )))
+
+    def test_hardlinked_file(self):
+        chmod(self.home, 0o755)
+        outside = self.path('outside')
+        with open(outside, 'w'):
+            pass
+        chmod(outside, 0o666)
+        link(outside, path_join(self.home, 'a', 'linked'))
+        user = User('alice', 'x', 1000, 1000, '', self.home, '/bin/sh')
+        check = self.check()
+        # it would not be changed, so it does not make the home incorrect
+        self.assertTrue(check.is_correct(user))
+        chmod(path_join(self.home, 'h'), 0o666)
+        self.assertFalse(check.is_correct(user))
+        check.simulate = False
+        check.correct(user)
+        self.assertTrue(check.is_correct(user))
+        self.assertEqual(S_IMODE(stat(outside).st_mode), 0o666)
+
+    def test_walk_symlinked_home(self):
+        symlink(self.home, self.path('bob'))
+        check = self.check()
+        self.assertEqual(list(check.walk_home(self.path('bob'))), [])
+        # a file instead of a directory is skipped the same way
+        self.assertEqual(list(check.walk_home(path_join(self.home, 'h'))),
+                         [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import unittest
+from os import mkdir, link, symlink, lstat
+from os.path import join as path_join, exists
+from tempfile import TemporaryDirectory
+
+from lib.config import OptionsDict
+from lib.nss import NssIndex
+from lib.usage import format_size, tree_usage, UsageCache
+from lib.checks.disk_usage import DiskUsageCheck
+
+class UsageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.root = self.directory.name
+        self.home = path_join(self.root, 'alice')
+        mkdir(self.home)
+        mkdir(path_join(self.home, 'a'))
+        self.write('a/f', 1000)
+        self.write('g', 24)
+        link(path_join(self.home, 'a', 'f'), path_join(self.home, 'f'))
+        symlink(self.root, path_join(self.home, 'link'))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, name, size):
+        with open(path_join(self.home, name), 'w') as data_file:
+            data_file.write('x' * size)
+
+    def expected_apparent(self):
+        return sum(lstat(path_join(self.home, name)).st_size
+                   for name in ('', 'a', 'a/f', 'g', 'link'))
+
+    def test_format_size(self):
+        self.assertEqual(format_size(0), '0')
+        self.assertEqual(format_size(1023), '1023')
+        self.assertEqual(format_size(1536), '1.5K')
+        self.assertEqual(format_size(3 << 30), '3.0G')
+        self.assertEqual(format_size(1 << 60), '1024.0P')
+
+    def test_tree_usage(self):
+        usage, _ = tree_usage(self.home)
+        # the hardlinked file counts once, the symlink is not followed
+        self.assertEqual(usage.inodes, 5)
+        self.assertEqual(usage.apparent, self.expected_apparent())
+        self.assertEqual(usage.directories_read, 2)
+        self.assertEqual(usage.directories_cached, 0)
+        self.assertEqual(usage.newest_mtime, max(
+            lstat(path_join(self.home, name)).st_mtime_ns
+            for name in ('', 'a', 'a/f', 'g', 'link')
+        ) / 1e9)
+
+    def test_cache(self):
+        _, cache = tree_usage(self.home, settle_seconds=-1)
+        self.assertEqual(sorted(cache), ['', 'a'])
+        usage, _ = tree_usage(self.home, cache, settle_seconds=-1)
+        self.assertEqual((usage.directories_read, usage.directories_cached),
+                         (0, 2))
+        self.assertEqual(usage.inodes, 5)
+        self.assertEqual(usage.apparent, self.expected_apparent())
+
+        self.write('a/h', 100)
+        usage, _ = tree_usage(self.home, cache, settle_seconds=-1)
+        self.assertEqual((usage.directories_read, usage.directories_cached),
+                         (1, 1))
+        self.assertEqual(usage.inodes, 6)
+
+        usage, _ = tree_usage(self.home, cache, max_age=0,
+                              settle_seconds=-1)
+        self.assertEqual(usage.directories_read, 2)
+
+    def test_unsettled_not_cached(self):
+        _, cache = tree_usage(self.home, settle_seconds=3600)
+        self.assertEqual(cache, {})
+
+    def test_usage_cache(self):
+        path = path_join(self.root, 'cache')
+        cache = UsageCache(path)
+        cache.load()
+        self.assertEqual(cache.homes, {})
+        cache.homes[self.home] = tree_usage(self.home, settle_seconds=-1)[1]
+        cache.save()
+        loaded = UsageCache(path)
+        loaded.load()
+        self.assertEqual(loaded.homes, cache.homes)
+
+    def check(self, simulate):
+        options = OptionsDict(
+            check='yes', correct='yes', threshold_megabytes='1',
+            report_file=path_join(self.root, 'report'),
+            cache_file=path_join(self.root, 'cache'),
+        )
+        return DiskUsageCheck(path_join(self.root, '$u'), [], simulate,
+                              options, nss=NssIndex())
+
+    def test_simulation_writes_nothing(self):
+        self.check(True).check()
+        self.assertFalse(exists(path_join(self.root, 'report')))
+        self.assertFalse(exists(path_join(self.root, 'cache')))
+        self.check(False).check()
+        with open(path_join(self.root, 'report')) as report_file:
+            self.assertIn(self.home, report_file.read())
+        self.assertTrue(exists(path_join(self.root, 'cache')))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import unittest
+from os import stat, listdir
+from os.path import join as path_join
+from stat import S_IMODE
+from tempfile import TemporaryDirectory
+
+from lib.util import atomic_write
+
+class AtomicWriteTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.path = path_join(self.directory.name, 'file')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def read(self):
+        with open(self.path) as written_file:
+            return written_file.read()
+
+    def test_write(self):
+        with atomic_write(self.path) as written_file:
+            written_file.write('first')
+        self.assertEqual(self.read(), 'first')
+        self.assertEqual(S_IMODE(stat(self.path).st_mode), 0o644)
+
+        inode = stat(self.path).st_ino
+        with atomic_write(self.path, 'wb', 0o600) as written_file:
+            written_file.write(b'second')
+        self.assertEqual(self.read(), 'second')
+        self.assertEqual(S_IMODE(stat(self.path).st_mode), 0o600)
+        self.assertNotEqual(stat(self.path).st_ino, inode)
+        self.assertEqual(listdir(self.directory.name), ['file'])
+
+    def test_failure_keeps_original(self):
+        with atomic_write(self.path) as written_file:
+            written_file.write('original')
+        with self.assertRaises(KeyError):
+            with atomic_write(self.path) as written_file:
+                written_file.write('partial')
+                raise KeyError('failed')
+        self.assertEqual(self.read(), 'original')
+        self.assertEqual(listdir(self.directory.name), ['file'])
+
+if __name__ == '__main__':
+    unittest.main()